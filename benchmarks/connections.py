@@ -0,0 +1,102 @@
+"""连接复用检查：复用连接（WAL）保存和读取账单的吞吐量与每次新建连接的对比
+
+用法：
+    python benchmarks/connections.py [--ops 1000] [--reads 4] [--min-speedup 2.0]
+
+每次操作保存一条账单（一次提交）并读取 --reads 次最近的记录。复用组通过 BillCalculator
+的 ConnectionManager 使用同一个连接；对照组按原来的方式每次读写都新建连接（默认的回滚
+日志和 synchronous=FULL），用完即关闭。两组各用自己的临时数据库。复用组的吞吐量低于对照组
+的 --min-speedup 倍时退出码为 1。
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from electricity_bill_calculator import INSERT_BILL_SQL, BillCalculator, compute_split  # noqa: E402
+
+LATEST_SQL = "SELECT * FROM bill_records ORDER BY date DESC, id DESC LIMIT 1"
+
+
+def make_values(i):
+    record = compute_split((i, i + 150, i, i + 250), 500.0)
+    return (f"2024-01-01 {i // 3600 % 24:02d}:{i // 60 % 60:02d}:{i % 60:02d}",) + record.values()
+
+
+def create_database(db_name):
+    """用 BillCalculator 建表（执行全部迁移）"""
+    calculator = BillCalculator(db_name)
+    calculator.db.connection()
+    calculator.close()
+
+
+def run_reused(db_name, ops, reads):
+    """复用组：同一个连接完成全部读写，返回耗时（秒）"""
+    calculator = BillCalculator(db_name)
+    db = calculator.db
+    try:
+        start = time.perf_counter()
+        for i in range(ops):
+            with db.transaction() as conn:
+                conn.execute(INSERT_BILL_SQL, make_values(i))
+            for _ in range(reads):
+                db.connection().execute(LATEST_SQL).fetchone()
+        return time.perf_counter() - start
+    finally:
+        calculator.close()
+
+
+def run_per_operation(db_name, ops, reads):
+    """对照组：每次读写都新建连接，返回耗时（秒）"""
+    conn = sqlite3.connect(db_name)
+    conn.execute("PRAGMA journal_mode=DELETE")
+    conn.close()
+    start = time.perf_counter()
+    for i in range(ops):
+        conn = sqlite3.connect(db_name)
+        try:
+            conn.execute(INSERT_BILL_SQL, make_values(i))
+            conn.commit()
+        finally:
+            conn.close()
+        for _ in range(reads):
+            conn = sqlite3.connect(db_name)
+            try:
+                conn.execute(LATEST_SQL).fetchone()
+            finally:
+                conn.close()
+    return time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="比较复用连接和每次新建连接的读写吞吐量")
+    parser.add_argument("--ops", type=int, default=1000, help="操作次数（每次保存一条账单）")
+    parser.add_argument("--reads", type=int, default=4, help="每次操作读取最近记录的次数")
+    parser.add_argument("--min-speedup", type=float, default=2.0, help="复用连接相对对照组的最低吞吐量倍数")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        reused_db = os.path.join(tmp, "reused.db")
+        baseline_db = os.path.join(tmp, "baseline.db")
+        create_database(reused_db)
+        create_database(baseline_db)
+        reused = run_reused(reused_db, args.ops, args.reads)
+        baseline = run_per_operation(baseline_db, args.ops, args.reads)
+
+    speedup = baseline / reused if reused else 0.0
+    print(f"复用连接:     {reused * 1000:8.1f} ms（{args.ops / reused:,.0f} 次操作/秒）")
+    print(f"每次新建连接: {baseline * 1000:8.1f} ms（{args.ops / baseline:,.0f} 次操作/秒）")
+    print(f"{args.ops} 次操作（每次 1 次写入、{args.reads} 次读取），复用连接的吞吐量为对照组的 "
+          f"{speedup:.1f} 倍（最低 {args.min_speedup:.1f} 倍）")
+    ok = speedup >= args.min_speedup
+    print("通过" if ok else "未通过")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
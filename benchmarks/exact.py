@@ -0,0 +1,78 @@
+"""精确模式检查：按分精确分摊（--exact）的批量计算速度是否跟得上默认的四舍五入模式
+
+用法：
+    python benchmarks/exact.py [--bills 100000] [--max-ratio 2.0]
+
+用同一批随机账单（含水费）分别以默认模式和精确模式调用 compute_many，取多次运行的最短
+耗时比较；同时检查精确模式下两户金额之和总是等于总金额。精确模式的耗时超过默认模式的
+--max-ratio 倍或合计不符时退出码为 1。
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from electricity_bill_calculator import compute_many, to_cents  # noqa: E402
+
+
+def make_bills(count):
+    bills = []
+    for _ in range(count):
+        your_old, my_old = random.randint(0, 5000), random.randint(0, 5000)
+        readings = (your_old, your_old + random.randint(0, 800), my_old, my_old + random.randint(0, 800))
+        water = (random.randint(0, 900), random.randint(900, 1000), random.randint(0, 900), random.randint(900, 1000))
+        bills.append((readings, round(random.uniform(100, 3000), 2), water, round(random.uniform(50, 800), 2)))
+    return bills
+
+
+def best_time(bills, exact, runs):
+    """多次运行中最短的耗时（秒）和最后一次的结果"""
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        records = compute_many(bills, exact=exact)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, records
+
+
+def count_mismatches(bills, records):
+    """两户金额之和（按分）不等于总金额的记录数"""
+    mismatches = 0
+    for (_, amount, _, water_amount), record in zip(bills, records):
+        if record.total_usage and to_cents(record.your_share) + to_cents(record.my_share) != to_cents(amount):
+            mismatches += 1
+        elif record.total_water_usage and to_cents(record.your_water_share) + to_cents(record.my_water_share) != to_cents(water_amount):
+            mismatches += 1
+    return mismatches
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="比较精确模式和默认模式的批量计算速度")
+    parser.add_argument("--bills", type=int, default=100000, help="账单数")
+    parser.add_argument("--runs", type=int, default=3, help="运行次数（取最短耗时）")
+    parser.add_argument("--max-ratio", type=float, default=2.0, help="精确模式耗时相对默认模式的上限倍数")
+    args = parser.parse_args(argv)
+
+    random.seed(1)
+    bills = make_bills(args.bills)
+    rounded, _ = best_time(bills, False, args.runs)
+    exact, records = best_time(bills, True, args.runs)
+    mismatches = count_mismatches(bills, records)
+    ratio = exact / rounded if rounded else 0.0
+
+    print(f"默认模式: {rounded * 1000:7.1f} ms（{args.bills / rounded:,.0f} 张/秒）")
+    print(f"精确模式: {exact * 1000:7.1f} ms（{args.bills / exact:,.0f} 张/秒）")
+    print(f"{args.bills} 张账单，精确模式耗时为默认模式的 {ratio:.2f} 倍（上限 {args.max_ratio:.2f} 倍），"
+          f"合计不等于总金额的记录 {mismatches} 条")
+    ok = ratio <= args.max_ratio and not mismatches
+    print("通过" if ok else "未通过")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,171 @@
+"""HTTP 服务压力测试：报告 p50/p99 延迟和每秒请求数
+
+用法：
+    python benchmarks/load_test.py [--url http://127.0.0.1:8080] [--endpoint split]
+                                   [--concurrency 50] [--duration 10] [--batch-size 100]
+
+不指定 --url 时会用临时数据库在本机随机端口启动 bill_service.py，测试结束后关闭。
+每个并发客户端使用一个 keep-alive 连接连续发送请求。
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _random_bill():
+    your_old, my_old = random.randint(0, 5000), random.randint(0, 5000)
+    return {
+        'readings': [your_old, your_old + random.randint(0, 800), my_old, my_old + random.randint(0, 800)],
+        'amount': round(random.uniform(100, 3000), 1),
+    }
+
+
+def build_request(endpoint, host, batch_size):
+    """生成一个请求（字节串）"""
+    if endpoint == 'split':
+        method, path, body = 'POST', '/split', _random_bill()
+    elif endpoint == 'batch':
+        method, path, body = 'POST', '/split/batch', {'bills': [_random_bill() for _ in range(batch_size)]}
+    elif endpoint == 'save':
+        method, path, body = 'POST', '/split', dict(_random_bill(), save=True)
+    elif endpoint == 'history':
+        method, path, body = 'GET', f'/history?limit={batch_size}', None
+    else:
+        method, path, body = 'GET', '/health', None
+    payload = json.dumps(body).encode() if body is not None else b""
+    head = f"{method} {path} HTTP/1.1\r\nHost: {host}\r\nContent-Length: {len(payload)}\r\n\r\n"
+    return head.encode('latin-1') + payload
+
+
+async def read_response(reader):
+    """读取一个响应，返回状态码（支持 Content-Length 和分块传输）"""
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("连接已关闭")
+    status = int(status_line.split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode('latin-1').partition(":")
+        headers[name.strip().lower()] = value.strip()
+    if headers.get('transfer-encoding') == 'chunked':
+        while True:
+            size = int((await reader.readline()).strip(), 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    else:
+        await reader.readexactly(int(headers.get('content-length', 0)))
+    return status
+
+
+async def client(host, port, endpoint, batch_size, deadline, latencies, errors):
+    reader, writer = await asyncio.open_connection(host, port)
+    requests = [build_request(endpoint, host, batch_size) for _ in range(20)]
+    i = 0
+    try:
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            writer.write(requests[i % len(requests)])
+            i += 1
+            status = await read_response(reader)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+async def run_load(host, port, endpoint, concurrency, duration, batch_size):
+    latencies, errors = [], []
+    deadline = time.perf_counter() + duration
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        client(host, port, endpoint, batch_size, deadline, latencies, errors) for _ in range(concurrency)
+    ))
+    return latencies, errors, time.perf_counter() - start
+
+
+def _percentile(sorted_values, percent):
+    index = min(len(sorted_values) - 1, int(round(percent / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def _wait_for_port(host, port, timeout=10):
+    async def probe():
+        end = time.perf_counter() + timeout
+        while True:
+            try:
+                _, writer = await asyncio.open_connection(host, port)
+                writer.close()
+                return
+            except OSError:
+                if time.perf_counter() > end:
+                    raise
+                await asyncio.sleep(0.05)
+    asyncio.run(probe())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="HTTP 服务压力测试")
+    parser.add_argument("--url", help="服务地址；不指定时启动一个本地实例")
+    parser.add_argument("--endpoint", choices=("health", "split", "batch", "save", "history"), default="split")
+    parser.add_argument("--concurrency", type=int, default=50, help="并发连接数")
+    parser.add_argument("--duration", type=float, default=10, help="持续时间（秒）")
+    parser.add_argument("--batch-size", type=int, default=100, help="batch 每次的账单数 / history 的记录数")
+    parser.add_argument("--workers", type=int, default=4, help="本地实例的数据库线程数")
+    args = parser.parse_args(argv)
+
+    server = None
+    tmp = None
+    if args.url:
+        url = urllib.parse.urlsplit(args.url)
+        host, port = url.hostname, url.port or 80
+    else:
+        import socket
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            host, port = sock.getsockname()
+        tmp = tempfile.TemporaryDirectory()
+        server = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, "bill_service.py"), "--port", str(port),
+             "--db", os.path.join(tmp.name, "load.db"), "--workers", str(args.workers)],
+            stdout=subprocess.DEVNULL,
+        )
+    try:
+        _wait_for_port(host, port)
+        latencies, errors, elapsed = asyncio.run(
+            run_load(host, port, args.endpoint, args.concurrency, args.duration, args.batch_size)
+        )
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+            tmp.cleanup()
+
+    if not latencies:
+        print("没有完成任何请求")
+        return 1
+    latencies.sort()
+    print(f"接口: {args.endpoint}  并发: {args.concurrency}  时长: {elapsed:.1f} 秒")
+    print(f"请求数: {len(latencies)}  错误: {len(errors)}  每秒请求数: {len(latencies) / elapsed:.0f}")
+    print(f"延迟 p50: {_percentile(latencies, 50) * 1000:.2f} ms  "
+          f"p99: {_percentile(latencies, 99) * 1000:.2f} ms  "
+          f"平均: {statistics.mean(latencies) * 1000:.2f} ms")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,102 @@
+"""查询计划检查：历史记录查询的每种条件组合都使用索引查找，不做全表扫描
+
+用法：
+    python benchmarks/query_plan.py [--db utility_bills.db] [--time]
+
+对 compile_history_query 的全部条件组合执行 EXPLAIN QUERY PLAN：没有任何条件时允许按
+日期索引顺序读取（SCAN ... USING INDEX），有条件时计划中不能出现 SCAN bill_records。
+不指定 --db 时使用临时的空数据库（INDEXED BY 保证计划与数据量无关）。--time 时还报告
+每种组合读到第一批结果和读完全部结果的耗时。检查失败时退出码为 1。
+"""
+import argparse
+import itertools
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from electricity_bill_calculator import BillCalculator  # noqa: E402
+
+# 每个条件的示例取值
+FILTER_VALUES = (
+    ('start', '2024-01-01'),
+    ('end', '2024-06-30'),
+    ('min_usage', 500),
+    ('max_usage', 900),
+    ('water', True),
+    ('min_imbalance', 70),
+)
+
+
+def filter_combinations():
+    for size in range(len(FILTER_VALUES) + 1):
+        for combination in itertools.combinations(FILTER_VALUES, size):
+            yield dict(combination)
+    yield {'water': False}
+
+
+def check_plan(plan, filters):
+    """返回计划中的问题，没有问题时返回 None"""
+    for line in plan:
+        if line.startswith('SCAN bill_records'):
+            if 'INDEX' not in line:
+                return "全表扫描"
+            if filters:
+                return "有条件时按索引顺序扫描了全部记录"
+    return None
+
+
+def time_query(calculator, filters):
+    """读到第一条结果和读完全部结果的耗时（秒）及结果数"""
+    start = time.perf_counter()
+    first = None
+    count = 0
+    for _ in calculator.query_history(**filters):
+        if first is None:
+            first = time.perf_counter() - start
+        count += 1
+    return first or 0.0, time.perf_counter() - start, count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="检查历史记录查询的执行计划")
+    parser.add_argument("--db", help="数据库文件；不指定时使用临时的空数据库")
+    parser.add_argument("--time", action="store_true", help="同时测量每种组合的查询耗时")
+    args = parser.parse_args(argv)
+
+    tmp = None
+    db_name = args.db
+    if db_name is None:
+        tmp = tempfile.TemporaryDirectory()
+        db_name = os.path.join(tmp.name, "plan.db")
+    calculator = BillCalculator(db_name)
+    failures = 0
+    checked = 0
+    try:
+        for filters in filter_combinations():
+            plan = calculator.explain_history_query(**filters)
+            problem = check_plan(plan, filters)
+            checked += 1
+            line = f"{', '.join(f'{k}={v}' for k, v in filters.items()) or '（无条件）'}: {' / '.join(plan)}"
+            if args.time:
+                first, total, count = time_query(calculator, filters)
+                line += f"  [{count} 条，首条 {first * 1000:.1f} ms，全部 {total * 1000:.0f} ms]"
+            if problem:
+                failures += 1
+                line += f"  <-- {problem}"
+            print(line)
+    finally:
+        calculator.close()
+        if tmp is not None:
+            tmp.cleanup()
+
+    print(f"检查了 {checked} 种条件组合，{failures} 种没有使用索引查找")
+    print("通过" if not failures else "未通过")
+    return 0 if not failures else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,102 @@
+"""渲染检查：把 10000 条历史记录渲染为各种显示格式的耗时和写入次数
+
+用法：
+    python benchmarks/render.py [--records 10000] [--budget-ms 500]
+
+输出写到一个模拟终端的流（行缓冲，每次写入计为一次系统调用）。对照组按原来的方式
+逐行 print 同样的内容。任何格式超出预算时退出码为 1。
+"""
+import argparse
+import io
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from electricity_bill_calculator import FORMATTERS, compute_split, write_buffer  # noqa: E402
+
+
+class CountingSink(io.RawIOBase):
+    """丢弃写入的内容，只记录写入次数"""
+
+    def __init__(self):
+        self.writes = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.writes += 1
+        return len(data)
+
+
+def terminal_stream():
+    """与终端相同的行缓冲文本流：每个换行都会触发一次写入"""
+    sink = CountingSink()
+    return sink, io.TextIOWrapper(io.BufferedWriter(sink), encoding='utf-8', line_buffering=True)
+
+
+def make_records(count):
+    records = []
+    for i in range(count):
+        your_old, my_old = random.randint(0, 5000), random.randint(0, 5000)
+        water = None
+        if i % 2:
+            water = (random.randint(0, 900), random.randint(900, 1000), random.randint(0, 900), random.randint(900, 1000))
+        record = compute_split(
+            (your_old, your_old + random.randint(0, 800), my_old, my_old + random.randint(0, 800)),
+            round(random.uniform(100, 3000), 1), water, round(random.uniform(50, 800), 1),
+        )
+        record.id = i + 1
+        record.date = f"2024-{i % 12 + 1:02d}-01 00:00:00"
+        records.append(record)
+    return records
+
+
+def render(formatter, records):
+    """整页渲染到缓冲后一次写出，返回 (耗时, 写入次数)"""
+    sink, stream = terminal_stream()
+    start = time.perf_counter()
+    out = []
+    formatter.history_page(out, records, 1, 1)
+    write_buffer(out, stream)
+    return time.perf_counter() - start, sink.writes
+
+
+def render_line_by_line(formatter, records):
+    """对照组：同样的内容逐行 print（包括渲染的耗时）"""
+    sink, stream = terminal_stream()
+    start = time.perf_counter()
+    out = []
+    formatter.history_page(out, records, 1, 1)
+    for line in "".join(out).split("\n"):
+        print(line, file=stream)
+    stream.flush()
+    return time.perf_counter() - start, sink.writes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="检查显示格式的渲染耗时")
+    parser.add_argument("--records", type=int, default=10000, help="记录数")
+    parser.add_argument("--budget-ms", type=float, default=500.0, help="每种格式的渲染耗时预算（毫秒）")
+    args = parser.parse_args(argv)
+
+    random.seed(1)
+    records = make_records(args.records)
+    ok = True
+    for name, formatter in FORMATTERS.items():
+        elapsed, writes = render(formatter, records)
+        baseline, baseline_writes = render_line_by_line(formatter, records)
+        print(f"{name:6s} 缓冲: {elapsed * 1000:7.1f} ms，写入 {writes} 次   "
+              f"逐行 print: {baseline * 1000:7.1f} ms，写入 {baseline_writes} 次")
+        ok = ok and elapsed * 1000 <= args.budget_ms
+    print(f"{args.records} 条记录，预算 {args.budget_ms:.0f} ms")
+    print("通过" if ok else "未通过")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,79 @@
+"""冷启动检查：import 本程序和创建 BillCalculator 的耗时是否在预算之内
+
+用法：
+    python benchmarks/startup.py [--budget-ms 30] [--runs 5]
+
+用 python -X importtime 测量 import electricity_bill_calculator 的累计耗时（取多次运行的
+中位数），并检查创建 BillCalculator 时没有打开数据库、没有导入 sqlite3/NumPy 等模块。
+超出预算或检查失败时退出码为 1。
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULE = "electricity_bill_calculator"
+
+# 创建 BillCalculator 后不应加载的模块
+DEFERRED_MODULES = ("sqlite3", "csv", "json", "logging", "numpy")
+
+CONSTRUCT_SCRIPT = """
+import os, sys
+import electricity_bill_calculator as m
+db_name = sys.argv[1]
+calculator = m.BillCalculator(db_name)
+loaded = [name for name in sys.argv[2:] if name in sys.modules]
+print(os.path.exists(db_name), ",".join(loaded))
+"""
+
+
+def import_time_us():
+    """运行一次 python -X importtime，返回本模块的累计 import 耗时（微秒）"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {MODULE}"],
+        cwd=ROOT, capture_output=True, text=True, check=True,
+    )
+    for line in result.stderr.splitlines():
+        fields = [field.strip() for field in line.split("|")]
+        if len(fields) == 3 and fields[2] == MODULE:
+            return int(fields[1])
+    raise RuntimeError("importtime 输出中找不到本模块")
+
+
+def check_constructor():
+    """在子进程中创建 BillCalculator，返回 (是否创建了数据库文件, 已加载的延迟模块)"""
+    with tempfile.TemporaryDirectory() as tmp:
+        db_name = os.path.join(tmp, "startup.db")
+        result = subprocess.run(
+            [sys.executable, "-c", CONSTRUCT_SCRIPT, db_name, *DEFERRED_MODULES],
+            cwd=ROOT, capture_output=True, text=True, check=True,
+        )
+    created, _, loaded = result.stdout.strip().partition(" ")
+    return created == "True", [name for name in loaded.split(",") if name]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="检查冷启动耗时")
+    parser.add_argument("--budget-ms", type=float, default=30.0, help="import 耗时预算（毫秒）")
+    parser.add_argument("--runs", type=int, default=5, help="测量次数")
+    args = parser.parse_args(argv)
+
+    # 第一次运行会生成 .pyc，不计入结果
+    import_time_us()
+    samples = [import_time_us() / 1000 for _ in range(args.runs)]
+    median = statistics.median(samples)
+    print(f"import {MODULE}: 中位数 {median:.1f} ms（{', '.join(f'{t:.1f}' for t in samples)}），预算 {args.budget_ms:.0f} ms")
+
+    created, loaded = check_constructor()
+    print(f"BillCalculator(): 创建数据库文件={created}，已加载的延迟模块={loaded or '无'}")
+
+    ok = median <= args.budget_ms and not created and not loaded
+    print("通过" if ok else "未通过")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
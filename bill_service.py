@@ -0,0 +1,308 @@
+"""电费分摊 HTTP 服务（只使用标准库 asyncio）
+
+    python bill_service.py --port 8080 [--db utility_bills.db] [--workers 4] [--exact]
+
+接口（请求和响应均为 JSON）：
+    GET  /health                 服务状态和分摊结果缓存的命中、未命中、淘汰次数
+    POST /split                  计算一张账单，"save": true 时同时保存
+    POST /split/batch            批量计算，{"bills": [账单, ...]}
+    GET  /history                按日期倒序流式返回历史记录（JSON Lines，分块传输）
+                                 参数：limit、page_size、after_date + after_id（从该记录之后开始）
+    GET  /report                 用量和费用统计，参数：period、start、end
+
+账单格式：{"readings": [你家旧, 你家新, 我家旧, 我家新], "amount": 电费,
+           "water_readings": [...], "water_amount": 水费}（水费两项可省略）。
+
+计算在事件循环中完成（分摊结果的 LRU 缓存因此只在一个线程中使用）；数据库操作交给
+有界的线程池执行，同时等待的数据库任务数也有上限，超出时新的请求排队等待。
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import math
+import sys
+import urllib.parse
+
+from electricity_bill_calculator import DEFAULT_CACHE_SIZE, BillCalculator, compute_split
+
+MAX_HEADER_LINES = 100
+MAX_BODY_SIZE = 10 * 1024 * 1024
+MAX_BATCH_SIZE = 10000
+
+STATUS_TEXT = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+}
+
+
+class HTTPError(Exception):
+    """以指定状态码返回给客户端的错误"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _parse_bill(data, exact=False, cache=None):
+    """把请求中的一张账单转换为 BillRecord"""
+    if not isinstance(data, dict):
+        raise ValueError("账单必须是 JSON 对象")
+    readings = data.get('readings')
+    if not isinstance(readings, list) or len(readings) != 4:
+        raise ValueError("readings 必须是4个表读数")
+    water_readings = data.get('water_readings')
+    if water_readings is not None and (not isinstance(water_readings, list) or len(water_readings) != 4):
+        raise ValueError("water_readings 必须是4个表读数")
+    amount = float(data['amount'])
+    water_amount = float(data.get('water_amount') or 0)
+    if not (math.isfinite(amount) and math.isfinite(water_amount)):
+        raise ValueError("金额必须是有限的数字")
+    if amount < 0 or water_amount < 0:
+        raise ValueError("金额不能为负数")
+    return compute_split(
+        tuple(int(value) for value in readings), amount,
+        None if water_readings is None else tuple(int(value) for value in water_readings),
+        water_amount, exact=exact, cache=cache,
+    )
+
+
+def _encode(data):
+    return json.dumps(data, ensure_ascii=False).encode('utf-8')
+
+
+class BillService:
+    """HTTP 请求处理：解析请求、分发到各接口并写回响应（支持 keep-alive）"""
+
+    def __init__(self, calculator, max_workers=4, max_pending=64):
+        self.calculator = calculator
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="bill-db"
+        )
+        self._pending = asyncio.Semaphore(max_pending)
+        self.routes = {
+            ('GET', '/health'): self.health,
+            ('POST', '/split'): self.split,
+            ('POST', '/split/batch'): self.split_batch,
+            ('GET', '/history'): self.history,
+            ('GET', '/report'): self.report,
+        }
+
+    async def run_db(self, func, *args):
+        """在线程池中执行数据库操作"""
+        async with self._pending:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.calculator.close()
+
+    # ---- 接口 ----
+
+    async def health(self, query, body, writer):
+        return {'status': 'ok', 'cache': self.calculator.cache.stats()}
+
+    async def split(self, query, body, writer):
+        bill = _parse_bill(body, self.calculator.exact, self.calculator.cache)
+        if body.get('save'):
+            bill = await self.run_db(self.calculator.store_bill, bill)
+        return bill.as_dict()
+
+    async def split_batch(self, query, body, writer):
+        bills = body.get('bills') if isinstance(body, dict) else None
+        if not isinstance(bills, list):
+            raise ValueError("bills 必须是账单列表")
+        if len(bills) > MAX_BATCH_SIZE:
+            raise HTTPError(413, f"每次最多 {MAX_BATCH_SIZE} 张账单")
+        results = []
+        for index, data in enumerate(bills):
+            try:
+                results.append(_parse_bill(data, self.calculator.exact, self.calculator.cache).as_dict())
+            except (KeyError, TypeError, ValueError) as e:
+                raise ValueError(f"第 {index + 1} 张账单无效: {e}") from e
+        return {'results': results}
+
+    async def history(self, query, body, writer):
+        limit = int(query.get('limit', 0)) or None
+        page_size = min(int(query.get('page_size', 500)), 5000)
+        if page_size <= 0:
+            raise ValueError("page_size 必须大于0")
+        after = None
+        if 'after_id' in query:
+            after = (query.get('after_date') or None, int(query['after_id']))
+
+        await self._start_response(writer, 200, 'application/x-ndjson; charset=utf-8', chunked=True)
+        sent = 0
+        try:
+            # 每次只从数据库取一页，写出并等待发送缓冲区排空后再取下一页
+            while limit is None or sent < limit:
+                size = page_size if limit is None else min(page_size, limit - sent)
+                records = await self.run_db(self.calculator.fetch_history_page, size, None, after)
+                if not records:
+                    break
+                chunk = b"".join(_encode(record.as_dict()) + b"\n" for record in records)
+                writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                await writer.drain()
+                sent += len(records)
+                after = (records[-1].date, records[-1].id)
+                if len(records) < size:
+                    break
+        except ConnectionError:
+            raise
+        except Exception as e:
+            # 响应头已经发出，只能断开连接，客户端会收到不完整的分块响应
+            raise ConnectionResetError(f"读取历史记录失败: {e}") from e
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+        return None
+
+    async def report(self, query, body, writer):
+        return await self.run_db(
+            self.calculator.usage_report, query.get('period', 'month'), query.get('start'), query.get('end')
+        )
+
+    # ---- HTTP ----
+
+    async def _start_response(self, writer, status, content_type, length=None, chunked=False, keep_alive=True):
+        headers = [
+            f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}",
+            f"Content-Type: {content_type}",
+            "Connection: keep-alive" if keep_alive else "Connection: close",
+        ]
+        if chunked:
+            headers.append("Transfer-Encoding: chunked")
+        else:
+            headers.append(f"Content-Length: {length}")
+        writer.write(("\r\n".join(headers) + "\r\n\r\n").encode('latin-1'))
+
+    async def _send_json(self, writer, status, data, keep_alive=True):
+        payload = _encode(data)
+        await self._start_response(writer, status, 'application/json; charset=utf-8', len(payload),
+                                   keep_alive=keep_alive)
+        writer.write(payload)
+        await writer.drain()
+
+    async def _read_request(self, reader):
+        """读取一个请求，返回 (方法, 路径, 查询参数, 请求体, 是否保持连接)；连接关闭时返回 None"""
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        try:
+            method, target, version = request_line.decode('latin-1').split()
+        except ValueError:
+            raise HTTPError(400, "无效的请求行")
+
+        headers = {}
+        for _ in range(MAX_HEADER_LINES):
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode('latin-1').partition(":")
+            headers[name.strip().lower()] = value.strip()
+        else:
+            raise HTTPError(400, "请求头过多")
+
+        connection = headers.get('connection', '').lower()
+        keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+
+        try:
+            length = int(headers.get('content-length', 0) or 0)
+        except ValueError:
+            raise HTTPError(400, "无效的 Content-Length")
+        if length < 0:
+            raise HTTPError(400, "无效的 Content-Length")
+        if length > MAX_BODY_SIZE:
+            raise HTTPError(413, "请求体过大")
+        body = {}
+        if length:
+            try:
+                body = json.loads(await reader.readexactly(length))
+            except ValueError:
+                raise HTTPError(400, "请求体不是有效的 JSON")
+
+        url = urllib.parse.urlsplit(target)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        return method.upper(), url.path, query, body, keep_alive
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except HTTPError as e:
+                    await self._send_json(writer, e.status, {'error': str(e)}, keep_alive=False)
+                    break
+                if request is None:
+                    break
+                method, path, query, body, keep_alive = request
+
+                handler = self.routes.get((method, path))
+                try:
+                    if handler is None:
+                        if any(route_path == path for _, route_path in self.routes):
+                            raise HTTPError(405, "不支持的请求方法")
+                        raise HTTPError(404, "找不到该接口")
+                    result = await handler(query, body, writer)
+                except HTTPError as e:
+                    await self._send_json(writer, e.status, {'error': str(e)}, keep_alive)
+                except (KeyError, TypeError, ValueError) as e:
+                    await self._send_json(writer, 400, {'error': str(e)}, keep_alive)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    break
+                except Exception as e:
+                    await self._send_json(writer, 500, {'error': str(e)}, keep_alive=False)
+                    break
+                else:
+                    # 流式接口自己写响应，返回 None
+                    if result is not None:
+                        await self._send_json(writer, 200, result, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(service, host="127.0.0.1", port=8080):
+    """启动服务并一直运行"""
+    server = await asyncio.start_server(service.handle_connection, host, port)
+    addresses = ", ".join(str(sock.getsockname()) for sock in server.sockets)
+    print(f"电费分摊服务已启动: {addresses}", flush=True)
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="电费分摊 HTTP 服务")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址（默认 127.0.0.1）")
+    parser.add_argument("--port", type=int, default=8080, help="端口（默认 8080）")
+    parser.add_argument("--db", default="utility_bills.db", help="数据库文件（默认 utility_bills.db）")
+    parser.add_argument("--workers", type=int, default=4, help="数据库线程数（默认 4）")
+    parser.add_argument("--max-pending", type=int, default=64, help="同时等待的数据库任务上限（默认 64）")
+    parser.add_argument("--exact", action="store_true", help="分摊金额以分为单位精确计算")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE,
+                        help=f"缓存的分摊结果条数（默认 {DEFAULT_CACHE_SIZE}，0 表示不缓存）")
+    args = parser.parse_args(argv)
+
+    async def run():
+        calculator = BillCalculator(args.db, exact=args.exact, cache_size=args.cache_size)
+        service = BillService(calculator, args.workers, args.max_pending)
+        try:
+            await serve(service, args.host, args.port)
+        finally:
+            service.close()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,84 +1,1681 @@
+# sqlite3、csv、json 和 NumPy 在第一次使用时才导入，import 本模块和创建 BillCalculator
+# 都不需要加载它们（见 benchmarks/startup.py）
 import os
-import sqlite3
+import sys
+import math
 import datetime
-import re
+import time
+import threading
+import contextlib
+import operator
+import collections
+import decimal
+import bisect
 
-class BillCalculator:
-    def __init__(self, db_name="utility_bills.db"):
+# NumPy 为可选依赖，导入较慢，第一次按列批量计算时才导入（见 _load_numpy）
+np = None
+_numpy_checked = False
+
+
+def _load_numpy():
+    """导入 NumPy，返回模块；没有安装时返回 None（纯 Python 计算）"""
+    global np, _numpy_checked
+    if not _numpy_checked:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        np = numpy
+        _numpy_checked = True
+    return np
+
+
+def _logger():
+    """数据库迁移日志，只有执行迁移时才导入 logging"""
+    import logging
+    return logging.getLogger(__name__)
+
+
+# 账单字段顺序（与 save_to_database 的参数顺序一致）
+BILL_FIELDS = (
+    'your_old_reading', 'your_new_reading', 'your_usage',
+    'my_old_reading', 'my_new_reading', 'my_usage',
+    'total_usage', 'total_bill_amount', 'your_share', 'my_share',
+    'water_calculated', 'water_bill_amount', 'your_water_share', 'my_water_share',
+    'your_old_water', 'your_new_water', 'your_water_usage',
+    'my_old_water', 'my_new_water', 'my_water_usage', 'total_water_usage',
+)
+
+
+# 金额字段（REAL），其余 BILL_FIELDS 为整数
+BILL_AMOUNT_FIELDS = frozenset((
+    'total_bill_amount', 'your_share', 'my_share',
+    'water_bill_amount', 'your_water_share', 'my_water_share',
+))
+
+# 按 BillRecord 字段顺序读取 bill_records 的列
+RECORD_COLUMNS = "id, date, " + ", ".join(BILL_FIELDS)
+
+# 插入一条账单记录（date + BILL_FIELDS）
+INSERT_BILL_SQL = '''
+INSERT INTO bill_records (
+    date, your_old_reading, your_new_reading, your_usage,
+    my_old_reading, my_new_reading, my_usage,
+    total_usage, total_bill_amount, your_share, my_share,
+    water_calculated, water_bill_amount, your_water_share, my_water_share,
+    your_old_water, your_new_water, your_water_usage,
+    my_old_water, my_new_water, my_water_usage, total_water_usage
+) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+# 按 id 更新一条账单记录的 BILL_FIELDS
+UPDATE_BILL_SQL = "UPDATE bill_records SET " + ", ".join(f"{field} = ?" for field in BILL_FIELDS) + " WHERE id = ?"
+
+# 一致性检查项（bill_record_issues 视图中的列）及说明
+AUDIT_CHECKS = (
+    ('usage_mismatch', '用电量与表读数不一致'),
+    ('total_usage_mismatch', '总用电量不等于两家之和'),
+    ('share_mismatch', '电费分摊与用电比例不符'),
+    ('water_reversed', '水表读数颠倒'),
+    ('water_usage_mismatch', '用水量与表读数不一致'),
+    ('water_share_mismatch', '水费分摊与用水比例不符'),
+)
+
+# 分摊金额与按用量比例计算的金额之差超过此值时视为不一致。split_amount 先把两户金额
+# 四舍五入到 0.1，再把合计的误差（最多 0.1）加到用量较大的一方，因此正常的分摊结果
+# 最多相差 0.1（另加浮点误差）
+SHARE_TOLERANCE = 0.11
+
+
+def _share_mismatch(amount, your_usage, my_usage, your_share, my_share):
+    """分摊金额是否与用量比例不符（规则与 bill_record_issues 视图相同）"""
+    total_usage = your_usage + my_usage
+    if total_usage <= 0 or amount <= 0:
+        return False
+    return (abs(your_share - amount * your_usage / total_usage) > SHARE_TOLERANCE
+            or abs(my_share - amount * my_usage / total_usage) > SHARE_TOLERANCE)
+
+
+def _adjustment_sql(field):
+    """一条记录某个用量列的调整值（换表、读数归零，见 reading_adjustments 表）"""
+    return ("IFNULL((SELECT adjustment FROM reading_adjustments AS a "
+            f"WHERE a.record_id = bill_records.id AND a.field = '{field}'), 0)")
+
+
+# 在 SQLite 中计算每条记录的一致性检查结果，规则与 repair_bill_values 相同。
+# 用量 = 新读数 - 旧读数 + 调整值；有调整值的水表读数变小不算颠倒
+AUDIT_VIEW_SQL = f'''
+CREATE VIEW IF NOT EXISTS bill_record_issues AS
+SELECT
+    id,
+    (IFNULL(your_usage, 0) != IFNULL(your_new_reading, 0) - IFNULL(your_old_reading, 0) + {_adjustment_sql('your_usage')}
+     OR IFNULL(my_usage, 0) != IFNULL(my_new_reading, 0) - IFNULL(my_old_reading, 0) + {_adjustment_sql('my_usage')}) AS usage_mismatch,
+    (IFNULL(total_usage, 0) != IFNULL(your_usage, 0) + IFNULL(my_usage, 0)) AS total_usage_mismatch,
+    (total_usage > 0 AND total_bill_amount > 0
+     AND (ABS(IFNULL(your_share, 0) - total_bill_amount * your_usage / total_usage) > {SHARE_TOLERANCE}
+          OR ABS(IFNULL(my_share, 0) - total_bill_amount * my_usage / total_usage) > {SHARE_TOLERANCE})) AS share_mismatch,
+    (IFNULL(water_calculated, 0) = 1
+     AND ((IFNULL(your_new_water, 0) < IFNULL(your_old_water, 0) AND {_adjustment_sql('your_water_usage')} = 0)
+          OR (IFNULL(my_new_water, 0) < IFNULL(my_old_water, 0) AND {_adjustment_sql('my_water_usage')} = 0))) AS water_reversed,
+    (IFNULL(water_calculated, 0) = 1
+     AND (IFNULL(your_water_usage, 0) != IFNULL(your_new_water, 0) - IFNULL(your_old_water, 0) + {_adjustment_sql('your_water_usage')}
+          OR IFNULL(my_water_usage, 0) != IFNULL(my_new_water, 0) - IFNULL(my_old_water, 0) + {_adjustment_sql('my_water_usage')}
+          OR IFNULL(total_water_usage, 0) != IFNULL(your_water_usage, 0) + IFNULL(my_water_usage, 0))) AS water_usage_mismatch,
+    (IFNULL(water_calculated, 0) = 1 AND total_water_usage > 0 AND water_bill_amount > 0
+     AND (ABS(IFNULL(your_water_share, 0) - water_bill_amount * your_water_usage / total_water_usage) > {SHARE_TOLERANCE}
+          OR ABS(IFNULL(my_water_share, 0) - water_bill_amount * my_water_usage / total_water_usage) > {SHARE_TOLERANCE})) AS water_share_mismatch
+FROM bill_records
+'''
+
+# 月度汇总表的累加列及其对应的 bill_records 表达式（{row} 为 NEW 或 OLD）
+ROLLUP_COLUMNS = (
+    ('bill_count', '1'),
+    ('your_usage', 'IFNULL({row}.your_usage, 0)'),
+    ('my_usage', 'IFNULL({row}.my_usage, 0)'),
+    ('total_usage', 'IFNULL({row}.total_usage, 0)'),
+    ('total_bill_amount', 'IFNULL({row}.total_bill_amount, 0)'),
+    ('your_share', 'IFNULL({row}.your_share, 0)'),
+    ('my_share', 'IFNULL({row}.my_share, 0)'),
+    ('water_bill_count', '(IFNULL({row}.water_calculated, 0) = 1)'),
+    ('total_water_usage', 'IFNULL({row}.total_water_usage, 0)'),
+    ('water_bill_amount', 'IFNULL({row}.water_bill_amount, 0)'),
+    ('your_water_share', 'IFNULL({row}.your_water_share, 0)'),
+    ('my_water_share', 'IFNULL({row}.my_water_share, 0)'),
+)
+
+# 汇总的月份键，日期为空的记录归入 ''
+ROLLUP_MONTH_SQL = "IFNULL(substr({row}.date, 1, 7), '')"
+
+
+def _rollup_schema_sql():
+    """生成月度汇总表以及在插入、修改、删除时增量维护它的触发器"""
+    columns = [name for name, _ in ROLLUP_COLUMNS]
+    add_row = (
+        f"INSERT INTO bill_monthly_rollups (month, {', '.join(columns)}) "
+        f"VALUES ({ROLLUP_MONTH_SQL.format(row='NEW')}, "
+        f"{', '.join(expr.format(row='NEW') for _, expr in ROLLUP_COLUMNS)}) "
+        f"ON CONFLICT(month) DO UPDATE SET "
+        f"{', '.join(f'{name} = {name} + excluded.{name}' for name in columns)};"
+    )
+    remove_row = (
+        f"UPDATE bill_monthly_rollups SET "
+        f"{', '.join(f'{name} = {name} - ' + expr.format(row='OLD') for name, expr in ROLLUP_COLUMNS)} "
+        f"WHERE month = {ROLLUP_MONTH_SQL.format(row='OLD')};"
+    )
+    return [
+        "CREATE TABLE IF NOT EXISTS bill_monthly_rollups (month TEXT PRIMARY KEY, "
+        + ", ".join(f"{name} {'INTEGER' if name.endswith(('count', 'usage')) else 'REAL'} NOT NULL DEFAULT 0"
+                    for name in columns)
+        + ")",
+        f"CREATE TRIGGER IF NOT EXISTS bill_rollup_insert AFTER INSERT ON bill_records BEGIN {add_row} END",
+        f"CREATE TRIGGER IF NOT EXISTS bill_rollup_delete AFTER DELETE ON bill_records BEGIN {remove_row} END",
+        f"CREATE TRIGGER IF NOT EXISTS bill_rollup_update AFTER UPDATE ON bill_records BEGIN {remove_row} {add_row} END",
+    ]
+
+_bill_values = operator.attrgetter(*BILL_FIELDS)
+
+
+class BillRecord:
+    """一条账单记录，字段与 bill_records 表的列一一对应"""
+
+    __slots__ = ('id', 'date') + BILL_FIELDS
+
+    def __init__(self, id=None, date=None,
+                 your_old_reading=0, your_new_reading=0, your_usage=0,
+                 my_old_reading=0, my_new_reading=0, my_usage=0,
+                 total_usage=0, total_bill_amount=0, your_share=0, my_share=0,
+                 water_calculated=0, water_bill_amount=0, your_water_share=0, my_water_share=0,
+                 your_old_water=0, your_new_water=0, your_water_usage=0,
+                 my_old_water=0, my_new_water=0, my_water_usage=0, total_water_usage=0):
+        self.id = id
+        self.date = date
+        self.your_old_reading = your_old_reading
+        self.your_new_reading = your_new_reading
+        self.your_usage = your_usage
+        self.my_old_reading = my_old_reading
+        self.my_new_reading = my_new_reading
+        self.my_usage = my_usage
+        self.total_usage = total_usage
+        self.total_bill_amount = total_bill_amount
+        self.your_share = your_share
+        self.my_share = my_share
+        self.water_calculated = water_calculated
+        self.water_bill_amount = water_bill_amount
+        self.your_water_share = your_water_share
+        self.my_water_share = my_water_share
+        self.your_old_water = your_old_water
+        self.your_new_water = your_new_water
+        self.your_water_usage = your_water_usage
+        self.my_old_water = my_old_water
+        self.my_new_water = my_new_water
+        self.my_water_usage = my_water_usage
+        self.total_water_usage = total_water_usage
+
+    @classmethod
+    def from_row(cls, cursor, row):
+        """sqlite3 的 row_factory：把 SELECT {RECORD_COLUMNS} 的结果直接构造成记录，空值按0处理"""
+        return cls(row[0], row[1], *[0 if value is None else value for value in row[2:]])
+
+    def values(self):
+        """按 BILL_FIELDS 顺序返回字段值"""
+        return _bill_values(self)
+
+    def copy(self):
+        return BillRecord(self.id, self.date, *_bill_values(self))
+
+    def coerce_types(self):
+        """把字段转换为数据库中的类型（用量为整数，金额为浮点数）"""
+        for field in BILL_FIELDS:
+            value = getattr(self, field)
+            setattr(self, field, float(value) if field in BILL_AMOUNT_FIELDS else int(value))
+
+    def as_dict(self):
+        return dict(zip(('id', 'date') + BILL_FIELDS, (self.id, self.date) + _bill_values(self)))
+
+    def __eq__(self, other):
+        if not isinstance(other, BillRecord):
+            return NotImplemented
+        return (self.id, self.date) + _bill_values(self) == (other.id, other.date) + _bill_values(other)
+
+    def __repr__(self):
+        return f"BillRecord({', '.join(f'{key}={value!r}' for key, value in self.as_dict().items())})"
+
+# 公用事业类型及其用量单位，新增类型只需在 utility_types 表中插入一行
+UTILITY_TYPES = (
+    ('electricity', '度'),
+    ('water', '单位'),
+    ('gas', '度'),
+)
+
+# 规范化的数据结构：公用事业类型、分表、账单（每种公用事业一张）和每户读数
+HOUSEHOLD_SCHEMA_SQL = (
+    '''
+    CREATE TABLE IF NOT EXISTS utility_types (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE,
+        unit TEXT NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS meters (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        household TEXT NOT NULL,
+        utility_id INTEGER NOT NULL REFERENCES utility_types(id),
+        UNIQUE (household, utility_id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS bills (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        date TEXT,
+        utility_id INTEGER NOT NULL REFERENCES utility_types(id),
+        total_usage INTEGER NOT NULL,
+        total_amount REAL NOT NULL,
+        record_id INTEGER
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS readings (
+        bill_id INTEGER NOT NULL REFERENCES bills(id) ON DELETE CASCADE,
+        meter_id INTEGER NOT NULL REFERENCES meters(id),
+        old_reading INTEGER NOT NULL,
+        new_reading INTEGER NOT NULL,
+        usage INTEGER NOT NULL,
+        share REAL NOT NULL,
+        PRIMARY KEY (bill_id, meter_id)
+    ) WITHOUT ROWID
+    ''',
+    "CREATE INDEX IF NOT EXISTS idx_readings_meter ON readings(meter_id, bill_id)",
+    "CREATE INDEX IF NOT EXISTS idx_bills_date ON bills(utility_id, date)",
+)
+
+# 由 bill_records 迁移而来的账单，bills.record_id 为原记录 id
+# 旧记录中两户的名称，以及每种公用事业对应的 bill_records 列：
+# (总用量, 总金额, 条件, {户: (旧读数, 新读数, 用量, 分摊金额)})
+LEGACY_HOUSEHOLDS = (('your', '你家'), ('my', '我家'))
+LEGACY_UTILITY_COLUMNS = (
+    ('electricity', 'total_usage', 'total_bill_amount', '1', {
+        'your': ('your_old_reading', 'your_new_reading', 'your_usage', 'your_share'),
+        'my': ('my_old_reading', 'my_new_reading', 'my_usage', 'my_share'),
+    }),
+    ('water', 'total_water_usage', 'water_bill_amount', 'water_calculated = 1', {
+        'your': ('your_old_water', 'your_new_water', 'your_water_usage', 'your_water_share'),
+        'my': ('my_old_water', 'my_new_water', 'my_water_usage', 'my_water_share'),
+    }),
+)
+
+# 两户账单中每个分表对应的列：(用量列, 户名, 公用事业, 旧读数列, 新读数列)
+LEGACY_METER_FIELDS = (
+    ('your_usage', '你家', 'electricity', 'your_old_reading', 'your_new_reading'),
+    ('my_usage', '我家', 'electricity', 'my_old_reading', 'my_new_reading'),
+    ('your_water_usage', '你家', 'water', 'your_old_water', 'your_new_water'),
+    ('my_water_usage', '我家', 'water', 'my_old_water', 'my_new_water'),
+)
+
+# 多户账单中一户的计算结果
+HouseholdShare = collections.namedtuple('HouseholdShare', 'household old_reading new_reading usage share')
+
+# 分摊和电价计算结果缓存的默认条目数
+DEFAULT_CACHE_SIZE = 16384
+
+
+class LRUCache:
+    """有界的 LRU 缓存，记录命中、未命中、淘汰和失效次数
+
+    超过 maxsize 时淘汰最久未使用的条目；maxsize 为0时不缓存。缓存的内容依赖于
+    某个配置（例如电价）时，用 bind() 绑定该配置，配置改变时整个缓存失效。
+    不是线程安全的，每个线程或进程使用自己的缓存。
+    """
+    __slots__ = ('maxsize', 'hits', 'misses', 'evictions', 'invalidations', '_data', '_tag')
+
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE):
+        if maxsize < 0:
+            raise ValueError("缓存大小不能为负数")
+        self.maxsize = maxsize
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+        self._data = collections.OrderedDict()
+        self._tag = None
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """查找缓存，命中时把该条目标记为最近使用"""
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """保存一个条目，超出容量时淘汰最久未使用的条目"""
+        if not self.maxsize:
+            return
+        data = self._data
+        data[key] = value
+        data.move_to_end(key)
+        if len(data) > self.maxsize:
+            data.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """清空缓存（计数不变）"""
+        if self._data:
+            self.invalidations += 1
+            self._data.clear()
+
+    def bind(self, tag):
+        """缓存的内容依赖于 tag；tag 与上次绑定的不同时清空缓存"""
+        if tag != self._tag:
+            self.clear()
+            self._tag = tag
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data), 'maxsize': self.maxsize,
+            'hits': self.hits, 'misses': self.misses,
+            'evictions': self.evictions, 'invalidations': self.invalidations,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+def _split_with_correction(amount, your_usage, my_usage):
+    """分摊金额，同时返回四舍五入误差的调整值"""
+    total_usage = your_usage + my_usage
+    your_share = round(amount * your_usage / total_usage, 1) if total_usage > 0 else 0
+    my_share = round(amount * my_usage / total_usage, 1) if total_usage > 0 else 0
+
+    # 确保合计等于总金额，调整四舍五入误差
+    correction = 0
+    total_shares = round(your_share + my_share, 1)
+    if abs(total_shares - amount) > 0.01:
+        correction = amount - total_shares
+        # 将差额分配给较大的份额，避免较小份额变成负数
+        if your_usage >= my_usage:
+            your_share = round(your_share + correction, 1)
+        else:
+            my_share = round(my_share + correction, 1)
+    return your_share, my_share, correction
+
+
+def to_cents(amount):
+    """把金额转换为整数（分），四舍五入到分"""
+    if isinstance(amount, int):
+        return amount * 100
+    if isinstance(amount, float):
+        # 两位小数以内的金额乘以100后与整数的误差远小于0.5，round 的结果是精确的
+        return round(amount * 100)
+    return int(decimal.Decimal(amount).quantize(decimal.Decimal('0.01'), rounding=decimal.ROUND_HALF_UP) * 100)
+
+
+def split_cents(amount_cents, your_usage, my_usage):
+    """以分为单位按用量比例分摊金额，全部使用整数运算
+
+    两户各取比例的整数部分，剩下的1分给余数较大的一方（余数相同时给用量较大的一方），
+    因此两户金额之和总是等于总金额，不需要再调整误差。
+    """
+    total_usage = your_usage + my_usage
+    if total_usage <= 0:
+        return 0, 0
+    your_cents, your_remainder = divmod(amount_cents * your_usage, total_usage)
+    my_cents, my_remainder = divmod(amount_cents * my_usage, total_usage)
+    leftover = amount_cents - your_cents - my_cents
+    if leftover:
+        if your_remainder > my_remainder or (your_remainder == my_remainder and your_usage >= my_usage):
+            your_cents += leftover
+        else:
+            my_cents += leftover
+    return your_cents, my_cents
+
+
+def _cached_split(amount, your_usage, my_usage, exact, cache):
+    """分摊一张账单，结果 (your_share, my_share, correction) 按 (exact, 金额, 两户用量) 缓存"""
+    key = (exact, amount, your_usage, my_usage)
+    result = cache.get(key)
+    if result is None:
+        if exact:
+            your_cents, my_cents = split_cents(to_cents(amount), your_usage, my_usage)
+            result = (your_cents / 100, my_cents / 100, 0)
+        else:
+            result = _split_with_correction(amount, your_usage, my_usage)
+        cache.put(key, result)
+    return result
+
+
+def split_amount(amount, your_usage, my_usage, exact=False, cache=None):
+    """按用量比例分摊金额，四舍五入误差调整到用量较大的一方
+
+    exact=True 时以分为单位用整数计算（见 split_cents），结果精确到分。
+    提供 cache（LRUCache）时相同的金额和用量只计算一次。
+    """
+    if cache is not None:
+        your_share, my_share, _ = _cached_split(amount, your_usage, my_usage, exact, cache)
+        return your_share, my_share
+    if exact:
+        your_cents, my_cents = split_cents(to_cents(amount), your_usage, my_usage)
+        return your_cents / 100, my_cents / 100
+    your_share, my_share, _ = _split_with_correction(amount, your_usage, my_usage)
+    return your_share, my_share
+
+
+def _round1_array(values):
+    """对数组逐项执行 round(x, 1)，结果与 Python 的 round 完全一致"""
+    scaled = values * 10
+    result = np.rint(scaled) / 10
+    # x*10 接近 .5 时 rint 可能与 round 的结果不同，这些值改用 round 逐个计算
+    near_half = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    for i in np.flatnonzero(near_half):
+        result[i] = round(float(values[i]), 1)
+    return result
+
+
+def _split_cents_columns(amounts, your_usage, my_usage, use_numpy, cache=None):
+    """split_columns 的整数（分）计算版本，correction 列全部为0"""
+    if not use_numpy and cache is not None:
+        rows = [_cached_split(a, y, m, True, cache) for a, y, m in zip(amounts, your_usage, my_usage)]
+        return tuple(list(column) for column in zip(*rows)) if rows else ([], [], [])
+    if not use_numpy:
+        your_share, my_share = [], []
+        for amount, your, my in zip(amounts, your_usage, my_usage):
+            your_cents, my_cents = split_cents(to_cents(amount), your, my)
+            your_share.append(your_cents / 100)
+            my_share.append(my_cents / 100)
+        return your_share, my_share, [0] * len(your_share)
+
+    amount_cents = np.rint(np.asarray(amounts, dtype=np.float64) * 100).astype(np.int64)
+    your_usage = np.asarray(your_usage, dtype=np.int64)
+    my_usage = np.asarray(my_usage, dtype=np.int64)
+    total_usage = your_usage + my_usage
+    has_usage = total_usage > 0
+    divisor = np.where(has_usage, total_usage, 1)
+
+    your_cents, your_remainder = np.divmod(amount_cents * your_usage, divisor)
+    my_cents, my_remainder = np.divmod(amount_cents * my_usage, divisor)
+    leftover = np.where(has_usage, amount_cents - your_cents - my_cents, 0)
+    to_your = (your_remainder > my_remainder) | ((your_remainder == my_remainder) & (your_usage >= my_usage))
+    your_cents = np.where(has_usage, your_cents + np.where(to_your, leftover, 0), 0)
+    my_cents = np.where(has_usage, my_cents + np.where(to_your, 0, leftover), 0)
+    return your_cents / 100, my_cents / 100, np.zeros(len(amount_cents))
+
+
+def _split_columns_cached(amounts, your_usage, my_usage, use_numpy, exact, cache):
+    """split_columns 的缓存版本：先逐条查缓存，只对未命中的金额和用量计算（NumPy 时向量化）
+
+    同一批中重复的金额和用量只查一次缓存、只计算一次。返回列表。
+    """
+    rows = [None] * len(amounts)
+    pending = {}
+    for i, key in enumerate(zip(amounts, your_usage, my_usage)):
+        if key in pending:
+            pending[key].append(i)
+            continue
+        result = cache.get((exact,) + key)
+        if result is None:
+            pending[key] = [i]
+        else:
+            rows[i] = result
+    if pending:
+        keys = list(pending)
+        columns = split_columns(*zip(*keys), use_numpy=use_numpy, exact=exact)
+        if not isinstance(columns[0], list):
+            columns = tuple(column.tolist() for column in columns)
+        for key, result in zip(keys, zip(*columns)):
+            cache.put((exact,) + key, result)
+            for i in pending[key]:
+                rows[i] = result
+    return tuple(list(column) for column in zip(*rows)) if rows else ([], [], [])
+
+
+def split_columns(amounts, your_usage, my_usage, use_numpy=None, exact=False, cache=None):
+    """按列批量分摊金额，结果与逐条调用 split_amount 相同
+
+    返回 (your_share, my_share, correction) 三列。安装了 NumPy 时一次向量化计算
+    整个账期并返回数组，否则（或 use_numpy=False 时）逐条计算并返回列表。
+    提供 cache 时先查缓存，只计算未命中的部分，返回列表。
+    """
+    if use_numpy is None or use_numpy:
+        use_numpy = _load_numpy() is not None
+    if cache is not None and use_numpy:
+        return _split_columns_cached(amounts, your_usage, my_usage, use_numpy, exact, cache)
+    if exact:
+        return _split_cents_columns(amounts, your_usage, my_usage, use_numpy, cache)
+    if not use_numpy:
+        if cache is not None:
+            rows = [_cached_split(a, y, m, False, cache) for a, y, m in zip(amounts, your_usage, my_usage)]
+        else:
+            rows = [_split_with_correction(a, y, m) for a, y, m in zip(amounts, your_usage, my_usage)]
+        return tuple(list(column) for column in zip(*rows)) if rows else ([], [], [])
+
+    amounts = np.asarray(amounts, dtype=np.float64)
+    your_usage = np.asarray(your_usage, dtype=np.int64)
+    my_usage = np.asarray(my_usage, dtype=np.int64)
+    total_usage = your_usage + my_usage
+    has_usage = total_usage > 0
+    divisor = np.where(has_usage, total_usage, 1)
+
+    your_share = np.where(has_usage, _round1_array(amounts * your_usage / divisor), 0.0)
+    my_share = np.where(has_usage, _round1_array(amounts * my_usage / divisor), 0.0)
+
+    # 确保合计等于总金额，把差额分配给用量较大的一方
+    total_shares = _round1_array(your_share + my_share)
+    needs_fix = np.abs(total_shares - amounts) > 0.01
+    correction = np.where(needs_fix, amounts - total_shares, 0.0)
+    your_fix = needs_fix & (your_usage >= my_usage)
+    my_fix = needs_fix & ~(your_usage >= my_usage)
+    your_share = np.where(your_fix, _round1_array(your_share + correction), your_share)
+    my_share = np.where(my_fix, _round1_array(my_share + correction), my_share)
+    return your_share, my_share, correction
+
+
+def compute_columns(your_old, your_new, my_old, my_new, amounts, use_numpy=None, exact=False):
+    """按列计算整个账期的用量和分摊金额
+
+    参数均为等长的列（列表或数组）。返回字典，包含 your_usage、my_usage、
+    total_usage、your_share、my_share 和 correction（四舍五入调整值）。
+    """
+    if use_numpy is None or use_numpy:
+        use_numpy = _load_numpy() is not None
+    if use_numpy:
+        your_usage = np.asarray(your_new, dtype=np.int64) - np.asarray(your_old, dtype=np.int64)
+        my_usage = np.asarray(my_new, dtype=np.int64) - np.asarray(my_old, dtype=np.int64)
+        if (your_usage < 0).any() or (my_usage < 0).any():
+            raise ValueError("新表读数不能小于旧表读数")
+        total_usage = your_usage + my_usage
+    else:
+        your_usage = [new - old for old, new in zip(your_old, your_new)]
+        my_usage = [new - old for old, new in zip(my_old, my_new)]
+        if any(usage < 0 for usage in your_usage) or any(usage < 0 for usage in my_usage):
+            raise ValueError("新表读数不能小于旧表读数")
+        total_usage = [y + m for y, m in zip(your_usage, my_usage)]
+
+    your_share, my_share, correction = split_columns(amounts, your_usage, my_usage, use_numpy=use_numpy, exact=exact)
+    return {
+        'your_usage': your_usage,
+        'my_usage': my_usage,
+        'total_usage': total_usage,
+        'your_share': your_share,
+        'my_share': my_share,
+        'correction': correction,
+    }
+
+
+def _segment_usage(start, end, digits):
+    """一块表从 start 走到 end 的用量；读数变小时按 digits 位的表归零计算"""
+    if end >= start:
+        return end - start
+    if digits:
+        capacity = 10 ** digits
+        usage = end + capacity - start
+        # 归零后的用量超过表容量的一半，更可能是读数输入有误
+        if start < capacity and usage <= capacity // 2:
+            return usage
+    raise ValueError("新表读数不能小于旧表读数")
+
+
+def meter_usage(old_reading, new_reading, digits=None, replacements=()):
+    """计算一个分表两次抄表之间的用量，考虑换表和读数归零
+
+    replacements 为期间的换表事件 [(旧表最后读数, 新表初始读数), ...]，按时间顺序：
+    用量 = 旧表从 old_reading 走到最后读数 + 新表从初始读数走到 new_reading。
+    digits 为表的位数，某一段读数变小时视为走到 10**digits 后归零；
+    不知道位数时读数变小是错误。
+    """
+    usage = 0
+    start = old_reading
+    for final_reading, initial_reading in replacements:
+        usage += _segment_usage(start, final_reading, digits)
+        start = initial_reading
+    return usage + _segment_usage(start, new_reading, digits)
+
+
+def _field_usage(field, old_reading, new_reading, meters):
+    """按 meters 中该用量列的 (位数, 换表事件) 计算用量；没有时为新读数 - 旧读数"""
+    rule = meters.get(field) if meters else None
+    if rule is None:
+        if new_reading < old_reading:
+            raise ValueError("新表读数不能小于旧表读数")
+        return new_reading - old_reading
+    return meter_usage(old_reading, new_reading, *rule)
+
+
+def compute_split(readings, amount, water_readings=None, water_amount=0, exact=False, cache=None, meters=None):
+    """根据表读数计算一张账单（不需要交互输入）
+
+    readings 和 water_readings 均为 (你家旧读数, 你家新读数, 我家旧读数, 我家新读数)，
+    不计算水费时 water_readings 为 None。exact=True 时分摊金额以分为单位精确计算。
+    cache 为分摊结果的 LRUCache（可选）。meters 为 {用量列: (表的位数, 换表事件)}，
+    用于读数归零或换过表的分表（见 meter_usage）。返回 BillRecord（id 和 date 为空）。
+    """
+    your_old_reading, your_new_reading, my_old_reading, my_new_reading = readings
+    if meters:
+        your_usage = _field_usage('your_usage', your_old_reading, your_new_reading, meters)
+        my_usage = _field_usage('my_usage', my_old_reading, my_new_reading, meters)
+    else:
+        if your_new_reading < your_old_reading or my_new_reading < my_old_reading:
+            raise ValueError("新表读数不能小于旧表读数")
+        your_usage = your_new_reading - your_old_reading
+        my_usage = my_new_reading - my_old_reading
+    your_share, my_share = split_amount(amount, your_usage, my_usage, exact, cache)
+
+    if water_readings is None:
+        water_calculated = 0
+        water_amount = 0
+        your_old_water = your_new_water = my_old_water = my_new_water = 0
+        your_water_usage = my_water_usage = 0
+        your_water_share = my_water_share = 0
+    else:
+        water_calculated = 1
+        your_old_water, your_new_water, my_old_water, my_new_water = water_readings
+        if meters:
+            your_water_usage = _field_usage('your_water_usage', your_old_water, your_new_water, meters)
+            my_water_usage = _field_usage('my_water_usage', my_old_water, my_new_water, meters)
+        else:
+            if your_new_water < your_old_water or my_new_water < my_old_water:
+                raise ValueError("新表读数不能小于旧表读数")
+            your_water_usage = your_new_water - your_old_water
+            my_water_usage = my_new_water - my_old_water
+        your_water_share, my_water_share = split_amount(water_amount, your_water_usage, my_water_usage, exact, cache)
+
+    return BillRecord(
+        None, None,
+        your_old_reading, your_new_reading, your_usage,
+        my_old_reading, my_new_reading, my_usage,
+        your_usage + my_usage, amount, your_share, my_share,
+        water_calculated, water_amount, your_water_share, my_water_share,
+        your_old_water, your_new_water, your_water_usage,
+        my_old_water, my_new_water, my_water_usage, your_water_usage + my_water_usage,
+    )
+
+
+def allocate_shares(amount, usages, decimals=2):
+    """按用量比例把金额分给 N 户（最大余数法）
+
+    以 10**-decimals 元为单位用整数计算：每户先取比例的整数部分，剩余的单位
+    按余数从大到小（余数相同时用量大的优先）逐个补足，因此各户金额之和严格等于
+    总金额。只有一次排序，复杂度 O(N log N)。总用量为0时平均分摊。
+    """
+    if amount < 0:
+        raise ValueError("金额不能为负数")
+    if any(usage < 0 for usage in usages):
+        raise ValueError("用量不能为负数")
+    if not usages:
+        return []
+
+    scale = 10 ** decimals
+    total_units = round(amount * scale)
+    total_usage = sum(usages)
+    weights = usages if total_usage > 0 else [1] * len(usages)
+    total_weight = total_usage if total_usage > 0 else len(usages)
+
+    units = []
+    remainders = []
+    for weight in weights:
+        quotient, remainder = divmod(total_units * weight, total_weight)
+        units.append(quotient)
+        remainders.append(remainder)
+
+    leftover = total_units - sum(units)
+    if leftover:
+        order = sorted(range(len(weights)), key=lambda i: (-remainders[i], -weights[i], i))
+        for i in order[:leftover]:
+            units[i] += 1
+    return [unit / scale for unit in units]
+
+
+def compute_household_split(readings, amount, decimals=2):
+    """计算 N 户共用一个总表时的分摊
+
+    readings 为 [(户名, 旧读数, 新读数), ...]。返回 HouseholdShare 列表，顺序与输入相同。
+    """
+    households = [household for household, _, _ in readings]
+    if len(set(households)) != len(households):
+        raise ValueError("户名不能重复")
+    usages = []
+    for household, old_reading, new_reading in readings:
+        if new_reading < old_reading:
+            raise ValueError(f"{household}: 新表读数不能小于旧表读数")
+        usages.append(new_reading - old_reading)
+    shares = allocate_shares(amount, usages, decimals)
+    return [
+        HouseholdShare(household, old_reading, new_reading, usage, share)
+        for (household, old_reading, new_reading), usage, share in zip(readings, usages, shares)
+    ]
+
+
+def compute_many(bills, exact=False, cache=None):
+    """批量计算账单
+
+    bills 中每一项为 compute_split 的参数元组：
+    (readings, amount) 或 (readings, amount, water_readings, water_amount)。
+    cache 为分摊结果的 LRUCache（可选），批量中重复的金额和用量只计算一次。
+    """
+    return [compute_split(*bill, exact=exact, cache=cache) for bill in bills]
+
+
+def _old_reading(row, column, previous):
+    """旧读数列；留空或没有该列时使用 previous 中上一张账单的新读数"""
+    value = (row.get(column) or '').strip()
+    if value:
+        return int(value)
+    if previous is None or previous.get(column) is None:
+        raise ValueError(f"{column} 为空，也没有上一张账单的读数")
+    return previous[column]
+
+
+def _default_prompt(label, default):
+    """输入提示；有默认值时提示直接按Enter使用"""
+    return f"{label}: " if default is None else f"{label}（直接按Enter使用 {default}）: "
+
+
+def parse_reading_row(row, tariff=None, previous=None, meters=None):
+    """把 CSV 的一行读数转换为 compute_split 的参数元组
+
+    必需列: your_new_reading, my_new_reading, total_bill_amount，以及 your_old_reading,
+    my_old_reading。water_bill_amount 不为空时还需要水表的新旧读数列。
+    提供 tariff 时 total_bill_amount 可以留空，按电价和总用电量计算。
+    提供 previous（{旧读数列: 上一张账单的新读数}，见 BillCalculator.latest_readings）时
+    旧读数列可以留空或省略，并且 previous 会更新为本行的新读数，供下一行使用。
+    meters 为该行的分表规则（见 compute_split），按电价计算电费时用于计算用电量。
+    """
+    readings = (
+        _old_reading(row, 'your_old_reading', previous), int(row['your_new_reading']),
+        _old_reading(row, 'my_old_reading', previous), int(row['my_new_reading']),
+    )
+    amount = (row.get('total_bill_amount') or '').strip()
+    if not amount and tariff is not None:
+        amount = tariff.amount(_field_usage('your_usage', readings[0], readings[1], meters)
+                               + _field_usage('my_usage', readings[2], readings[3], meters))
+    else:
+        amount = float(row['total_bill_amount'])
+    if not math.isfinite(amount):
+        raise ValueError("总电费金额必须是有限的数字")
+    if amount < 0:
+        raise ValueError("总电费金额不能为负数")
+
+    water_amount = (row.get('water_bill_amount') or '').strip()
+    if not water_amount:
+        if previous is not None:
+            previous['your_old_reading'], previous['my_old_reading'] = readings[1], readings[3]
+        return readings, amount
+    water_readings = (
+        _old_reading(row, 'your_old_water', previous), int(row['your_new_water']),
+        _old_reading(row, 'my_old_water', previous), int(row['my_new_water']),
+    )
+    water_amount = float(water_amount)
+    if not math.isfinite(water_amount):
+        raise ValueError("总水费金额必须是有限的数字")
+    if water_amount < 0:
+        raise ValueError("总水费金额不能为负数")
+    if previous is not None:
+        previous['your_old_reading'], previous['my_old_reading'] = readings[1], readings[3]
+        previous['your_old_water'], previous['my_old_water'] = water_readings[1], water_readings[3]
+    return readings, amount, water_readings, water_amount
+
+
+class Tariff:
+    """分段电价：按用电量分级计算的电费，加上燃料调整费、回扣、固定费用和最低收费
+
+    tiers 为 [(上限度数, 每度电费), ...]，上限递增，最后一级的上限为 None（不封顶）；
+    Tariff(rate, fixed_charge) 相当于只有一级的电价。创建时预先计算各级起点的累计电费，
+    amount() 用 bisect 在各级上限中查找所在级别，每张账单只需一次二分查找和一次乘法。
+    对象可以被 pickle，供 rebill 的工作进程使用。
+    """
+    __slots__ = ('tiers', 'fixed_charge', 'fuel_clause', 'rebate', 'bill_rebate', 'minimum_charge',
+                 '_bounds', '_starts', '_base', '_rates')
+
+    FIELDS = ('tiers', 'fixed_charge', 'fuel_clause', 'rebate', 'bill_rebate', 'minimum_charge')
+
+    def __init__(self, rate=None, fixed_charge=0.0, tiers=None, fuel_clause=0.0, rebate=0.0,
+                 bill_rebate=0.0, minimum_charge=0.0):
+        if (rate is None) == (tiers is None):
+            raise ValueError("需要提供 rate 或 tiers 其中之一")
+        if tiers is None:
+            tiers = [(None, rate)]
+        tiers = [(None if limit is None else float(limit), float(tier_rate)) for limit, tier_rate in tiers]
+        if not tiers or tiers[-1][0] is not None:
+            raise ValueError("最后一级电价的上限必须为空（不封顶）")
+        if any(limit is None for limit, _ in tiers[:-1]):
+            raise ValueError("只有最后一级电价的上限可以为空")
+        bounds = [limit for limit, _ in tiers[:-1]]
+        if any(limit <= 0 for limit in bounds) or bounds != sorted(set(bounds)):
+            raise ValueError("各级电价的上限必须为正数并且递增")
+        if any(tier_rate < 0 for _, tier_rate in tiers):
+            raise ValueError("电价不能为负数")
+        if fixed_charge < 0 or rebate < 0 or bill_rebate < 0 or minimum_charge < 0:
+            raise ValueError("固定费用、回扣和最低收费不能为负数")
+
+        self.tiers = tiers
+        self.fixed_charge = fixed_charge
+        # 燃料调整费可以为负数（燃料价格下跌时退还）
+        self.fuel_clause = fuel_clause
+        self.rebate = rebate
+        self.bill_rebate = bill_rebate
+        self.minimum_charge = minimum_charge
+
+        # 第 i 级从 _starts[i] 度开始，_base[i] 为用满前面各级的累计电费
+        self._bounds = bounds
+        self._starts = [0.0] + bounds
+        self._rates = [tier_rate for _, tier_rate in tiers]
+        self._base = [0.0]
+        for i, limit in enumerate(bounds):
+            self._base.append(self._base[i] + (limit - self._starts[i]) * self._rates[i])
+
+    def energy_charge(self, usage):
+        """按分段电价计算的电费（不含燃料调整费、回扣和固定费用）"""
+        if usage < 0:
+            raise ValueError("用电量不能为负数")
+        i = bisect.bisect_left(self._bounds, usage)
+        return self._base[i] + (usage - self._starts[i]) * self._rates[i]
+
+    def amount(self, usage):
+        """按用电量计算一张账单的总电费（四舍五入到分）"""
+        if usage < 0:
+            raise ValueError("用电量不能为负数")
+        i = bisect.bisect_left(self._bounds, usage)
+        total = (self._base[i] + (usage - self._starts[i]) * self._rates[i]
+                 + (self.fuel_clause - self.rebate) * usage + self.fixed_charge - self.bill_rebate)
+        return round(max(total, self.minimum_charge), 2)
+
+    def amounts(self, usages, cache=None):
+        """批量计算多张账单的总电费，结果与逐个调用 amount() 相同
+
+        提供 cache（LRUCache）时按用电量缓存计算结果。缓存绑定到本电价的配置，
+        换用配置不同的电价时缓存自动失效。
+        """
+        if cache is not None:
+            cache.bind(self.as_dict())
+            result = []
+            for usage in usages:
+                amount = cache.get(usage)
+                if amount is None:
+                    amount = self.amount(usage)
+                    cache.put(usage, amount)
+                result.append(amount)
+            return result
+        bisect_left = bisect.bisect_left
+        bounds, starts, base, rates = self._bounds, self._starts, self._base, self._rates
+        per_unit = self.fuel_clause - self.rebate
+        fixed = self.fixed_charge - self.bill_rebate
+        minimum = self.minimum_charge
+        result = []
+        for usage in usages:
+            if usage < 0:
+                raise ValueError("用电量不能为负数")
+            i = bisect_left(bounds, usage)
+            total = base[i] + (usage - starts[i]) * rates[i] + per_unit * usage + fixed
+            result.append(round(total if total > minimum else minimum, 2))
+        return result
+
+    def breakdown(self, usage):
+        """一张账单的电费明细，用于显示和核对"""
+        energy = self.energy_charge(usage)
+        subtotal = energy + (self.fuel_clause - self.rebate) * usage + self.fixed_charge - self.bill_rebate
+        return {
+            'usage': usage,
+            'energy_charge': round(energy, 2),
+            'fuel_clause': round(self.fuel_clause * usage, 2),
+            'rebate': round(self.rebate * usage + self.bill_rebate, 2),
+            'fixed_charge': self.fixed_charge,
+            'minimum_charge_applied': subtotal < self.minimum_charge,
+            'total': self.amount(usage),
+        }
+
+    def as_dict(self):
+        data = {'tiers': [[limit, tier_rate] for limit, tier_rate in self.tiers]}
+        for field in self.FIELDS[1:]:
+            data[field] = getattr(self, field)
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        """从字典（JSON 配置）创建电价；兼容只有 rate 和 fixed_charge 的旧格式"""
+        unknown = set(data) - set(cls.FIELDS) - {'rate', 'description'}
+        if unknown:
+            raise ValueError(f"未知的电价配置项: {', '.join(sorted(unknown))}")
+        options = {field: data[field] for field in cls.FIELDS if field in data}
+        return cls(data.get('rate'), **options)
+
+    def __repr__(self):
+        return f"Tariff.from_dict({self.as_dict()!r})"
+
+
+def load_tariff(path):
+    """从 JSON 文件读取电价配置"""
+    import json
+    with open(path, encoding='utf-8') as f:
+        return Tariff.from_dict(json.load(f))
+
+
+class AnomalyDetector:
+    """按分表累计用量统计，检测异常用量
+
+    每个分表保存 [读数个数, 用量的 EWMA, 指数加权平均绝对偏差, 中位数, MAD]。中位数和
+    MAD 用随机逼近估计：每个读数向新值的方向移动一步，步长与当前的 MAD 成正比（MAD 为0时
+    按平均绝对偏差），因此一个异常读数最多使 MAD 改变 alpha 倍，不会使它骤增或骤减。
+    每个读数只更新这五个数（O(1)），不需要重新扫描历史记录。稳健 z 分数
+    (用量 - 中位数) / (1.4826 × MAD) 的绝对值超过 threshold 时为异常；读数个数少于
+    warmup 时只更新统计，不做判断。
+    """
+    __slots__ = ('alpha', 'threshold', 'warmup', 'stats', 'changed')
+
+    def __init__(self, alpha=0.1, threshold=3.5, warmup=8):
+        self.alpha = alpha
+        self.threshold = threshold
+        self.warmup = warmup
+        self.stats = {}
+        # 统计有变化、需要写回数据库的分表
+        self.changed = set()
+
+    def score(self, meter_id, usage):
+        """返回 (预期用量, 稳健 z 分数)；统计的读数不足 warmup 个时返回 None"""
+        stats = self.stats.get(meter_id)
+        if stats is None or stats[0] < self.warmup:
+            return None
+        return self._score(stats, usage)
+
+    @staticmethod
+    def _score(stats, usage):
+        _, _, ewmad, median, mad = stats
+        # MAD 为0（例如大多数读数相同）时改用平均绝对偏差，并且不小于中位数的5%或1个单位
+        spread = 1.4826 * mad if mad > 0 else 1.2533 * ewmad
+        floor = 0.05 * abs(median)
+        if spread < floor:
+            spread = floor
+        if spread < 1.0:
+            spread = 1.0
+        return median, (usage - median) / spread
+
+    def is_anomaly(self, score):
+        return score is not None and abs(score[1]) > self.threshold
+
+    def update(self, meter_id, usage):
+        """把一个用量计入统计"""
+        self.changed.add(meter_id)
+        stats = self.stats.get(meter_id)
+        if stats is None:
+            self.stats[meter_id] = [1, float(usage), 0.0, float(usage), 0.0]
+            return
+        count, ewma, ewmad, median, mad = stats
+        count += 1
+        # 前几个读数按累计平均计算，之后按 alpha 指数加权
+        rate = 1.0 / count if count * self.alpha < 1 else self.alpha
+        ewmad += rate * (abs(usage - ewma) - ewmad)
+        ewma += rate * (usage - ewma)
+        # 步长按 MAD 而不是平均绝对偏差计算：平均绝对偏差会被一次异常读数放大，按它计算的
+        # 步长会让中位数大幅跳动，随后 MAD 被压到接近0
+        spread = mad if mad > 0 else ewmad
+        step = rate * spread if spread > 1.0 else rate
+        if usage > median:
+            median = min(median + step, usage)
+        elif usage < median:
+            median = max(median - step, usage)
+        deviation = abs(usage - median)
+        if deviation > mad:
+            mad = min(mad + step, deviation)
+        elif deviation < mad:
+            mad = max(mad - step, deviation)
+        stats[:] = [count, ewma, ewmad, median, mad]
+
+    def observe(self, meter_id, usage):
+        """先判断再计入统计，返回 score() 的结果"""
+        stats = self.stats.get(meter_id)
+        score = self._score(stats, usage) if stats is not None and stats[0] >= self.warmup else None
+        self.update(meter_id, usage)
+        return score
+
+    def load(self, conn):
+        """从 meter_usage_stats 表读取全部分表的统计"""
+        self.stats = {
+            row[0]: list(row[1:])
+            for row in conn.execute("SELECT meter_id, count, ewma, ewmad, median, mad FROM meter_usage_stats")
+        }
+        self.changed = set()
+
+    def save(self, conn):
+        """把有变化的统计写回 meter_usage_stats 表"""
+        conn.executemany(
+            "INSERT INTO meter_usage_stats (meter_id, count, ewma, ewmad, median, mad) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(meter_id) DO UPDATE SET count = excluded.count, ewma = excluded.ewma, "
+            "ewmad = excluded.ewmad, median = excluded.median, mad = excluded.mad",
+            [(meter_id, *self.stats[meter_id]) for meter_id in self.changed]
+        )
+        self.changed = set()
+
+
+def _legacy_usages(record):
+    """两户账单中各分表的 (户名, 公用事业, 用量)"""
+    return [
+        (household, utility, getattr(record, field))
+        for field, household, utility, _, _ in LEGACY_METER_FIELDS
+        if utility == 'electricity' or record.water_calculated
+    ]
+
+
+# rebill 工作进程的缓存（电价、分摊），同一进程处理的各个分区共用
+_rebill_caches = None
+
+
+def _rebill_worker_caches(cache_size):
+    """返回本进程的 (电价缓存, 分摊缓存)；缓存大小改变时重新创建"""
+    global _rebill_caches
+    if _rebill_caches is None or _rebill_caches[0].maxsize != cache_size:
+        _rebill_caches = (LRUCache(cache_size), LRUCache(cache_size))
+    return _rebill_caches
+
+
+def _cache_delta(cache, before):
+    """缓存计数相对于 before（stats() 的结果）的增量"""
+    after = cache.stats()
+    return {key: after[key] - before[key] for key in ('hits', 'misses', 'evictions', 'invalidations')}
+
+
+def _rebill_partition(task):
+    """rebill 的工作进程：按新电价重新计算 id 在 [first_id, last_id] 之间的记录
+
+    用只读连接读取分区，结果写到 work_dir 下该分区自己的临时数据库（各进程并行写入，
+    主进程再用一条 INSERT ... SELECT 复制）。电价和分摊结果缓存在进程内，同一进程
+    处理后续分区时继续使用。返回 (临时数据库路径, 记录数, 新电费合计, 缓存计数)。
+    """
+    import pathlib
+    import sqlite3
+    db_name, work_dir, scenario_id, first_id, last_id, tariff, exact, cache_size = task
+    tariff_cache, split_cache = _rebill_worker_caches(cache_size)
+    tariff_before, split_before = tariff_cache.stats(), split_cache.stats()
+    uri = pathlib.Path(db_name).resolve().as_uri() + "?mode=ro"
+    conn = sqlite3.connect(uri, uri=True)
+    try:
+        rows = conn.execute(
+            "SELECT id, IFNULL(your_usage, 0), IFNULL(my_usage, 0) FROM bill_records "
+            "WHERE id BETWEEN ? AND ? ORDER BY id",
+            (first_id, last_id)
+        ).fetchall()
+    finally:
+        conn.close()
+
+    path = os.path.join(work_dir, f"partition-{first_id}.db")
+    if not rows:
+        return path, 0, 0.0, None
+    record_ids, your_usage, my_usage = zip(*rows)
+    amounts = tariff.amounts([your + my for your, my in zip(your_usage, my_usage)], tariff_cache)
+    your_share, my_share, _ = split_columns(amounts, your_usage, my_usage, exact=exact, cache=split_cache)
+    if not isinstance(your_share, list):
+        your_share, my_share = your_share.tolist(), my_share.tolist()
+
+    out = sqlite3.connect(path)
+    try:
+        # 临时文件，不需要日志和同步
+        out.execute("PRAGMA journal_mode=OFF")
+        out.execute("PRAGMA synchronous=OFF")
+        out.execute("CREATE TABLE results (scenario_id, record_id, total_bill_amount, your_share, my_share)")
+        out.executemany(
+            "INSERT INTO results VALUES (?, ?, ?, ?, ?)",
+            zip([scenario_id] * len(rows), record_ids, amounts, your_share, my_share)
+        )
+        out.commit()
+    finally:
+        out.close()
+    cache_stats = {'tariff': _cache_delta(tariff_cache, tariff_before),
+                   'split': _cache_delta(split_cache, split_before)}
+    return path, len(rows), sum(amounts), cache_stats
+
+
+def repair_bill_values(record, exact=False, adjustments=None):
+    """按修复规则重新计算一条 bill_records 记录
+
+    record 为从数据库读取的 BillRecord。用电量、用水量按表读数重新计算（加上
+    adjustments 中换表、读数归零的调整值 {用量列: 调整值}），颠倒的水表读数会被交换，
+    分摊金额与用量比例之差超过 SHARE_TOLERANCE 时重新分摊（exact=True 时按分精确分摊）。
+    返回按 BILL_FIELDS 排列的修正值；总金额为0或水表读数无法自动修正时返回 None，
+    需要人工处理。
+    """
+    bill = dict(zip(BILL_FIELDS, record.values()))
+    adjustments = adjustments or {}
+
+    bill['your_usage'] = bill['your_new_reading'] - bill['your_old_reading'] + adjustments.get('your_usage', 0)
+    bill['my_usage'] = bill['my_new_reading'] - bill['my_old_reading'] + adjustments.get('my_usage', 0)
+    bill['total_usage'] = bill['your_usage'] + bill['my_usage']
+    if bill['total_bill_amount'] <= 0:
+        return None
+    if _share_mismatch(bill['total_bill_amount'], bill['your_usage'], bill['my_usage'],
+                       bill['your_share'], bill['my_share']):
+        bill['your_share'], bill['my_share'] = split_amount(
+            bill['total_bill_amount'], bill['your_usage'], bill['my_usage'], exact
+        )
+
+    if bill['water_calculated']:
+        for side in ('your', 'my'):
+            old_key, new_key, usage_key = f'{side}_old_water', f'{side}_new_water', f'{side}_water_usage'
+            adjustment = adjustments.get(usage_key, 0)
+            calc_usage = bill[new_key] - bill[old_key] + adjustment
+            # 检查水表读数是否可能颠倒了（换表、读数归零的记录有调整值，不是颠倒）
+            if not adjustment and calc_usage < 0 and bill[usage_key] > 0:
+                bill[old_key], bill[new_key] = bill[new_key], bill[old_key]
+                calc_usage = -calc_usage
+            if calc_usage < 0:
+                return None
+            bill[usage_key] = calc_usage
+        bill['total_water_usage'] = bill['your_water_usage'] + bill['my_water_usage']
+        if bill['water_bill_amount'] <= 0:
+            return None
+        if _share_mismatch(bill['water_bill_amount'], bill['your_water_usage'], bill['my_water_usage'],
+                           bill['your_water_share'], bill['my_water_share']):
+            bill['your_water_share'], bill['my_water_share'] = split_amount(
+                bill['water_bill_amount'], bill['your_water_usage'], bill['my_water_usage'], exact
+            )
+    else:
+        for field in BILL_FIELDS[BILL_FIELDS.index('water_bill_amount'):]:
+            bill[field] = 0
+
+    return tuple(bill[field] for field in BILL_FIELDS)
+
+
+def _rebuild_rollups(conn):
+    """根据 bill_records 重新生成月度汇总"""
+    columns = [name for name, _ in ROLLUP_COLUMNS]
+    sums = ["SUM(" + expr.format(row='r') + ")" for _, expr in ROLLUP_COLUMNS]
+    conn.execute("DELETE FROM bill_monthly_rollups")
+    conn.execute(
+        f"INSERT INTO bill_monthly_rollups (month, {', '.join(columns)}) "
+        f"SELECT {ROLLUP_MONTH_SQL.format(row='r')}, {', '.join(sums)} "
+        f"FROM bill_records AS r GROUP BY 1"
+    )
+
+
+def _migrate_bill_records(conn):
+    """创建 bill_records 表；旧版本的数据库补齐水费相关列"""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS bill_records (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        date TEXT,
+        your_old_reading INTEGER,
+        your_new_reading INTEGER,
+        your_usage INTEGER,
+        my_old_reading INTEGER,
+        my_new_reading INTEGER,
+        my_usage INTEGER,
+        total_usage INTEGER,
+        total_bill_amount REAL,
+        your_share REAL,
+        my_share REAL,
+        water_calculated INTEGER,
+        water_bill_amount REAL,
+        your_water_share REAL,
+        my_water_share REAL,
+        your_old_water INTEGER,
+        your_new_water INTEGER,
+        your_water_usage INTEGER,
+        my_old_water INTEGER,
+        my_new_water INTEGER,
+        my_water_usage INTEGER,
+        total_water_usage INTEGER
+    )
+    ''')
+    existing_columns = [row[1] for row in conn.execute("PRAGMA table_info(bill_records)")]
+    for column_name in BILL_FIELDS:
+        if column_name not in existing_columns:
+            column_type = 'REAL' if column_name in BILL_AMOUNT_FIELDS else 'INTEGER'
+            conn.execute(f"ALTER TABLE bill_records ADD COLUMN {column_name} {column_type}")
+            _logger().info("已添加列: %s", column_name)
+
+
+def _migrate_history_index(conn):
+    """历史记录按日期排序和分页的索引，以及一致性检查视图"""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bill_records_date ON bill_records(date)")
+    conn.execute(AUDIT_VIEW_SQL)
+
+
+def _migrate_rollups(conn):
+    """月度汇总表及维护触发器，并根据已有记录生成汇总"""
+    for statement in _rollup_schema_sql():
+        conn.execute(statement)
+    _rebuild_rollups(conn)
+
+
+def _migrate_normalized(conn):
+    """规范化的公用事业、分表、账单和读数表"""
+    for statement in HOUSEHOLD_SCHEMA_SQL:
+        conn.execute(statement)
+    conn.executemany("INSERT OR IGNORE INTO utility_types (name, unit) VALUES (?, ?)", UTILITY_TYPES)
+
+
+def _migrate_rebill(conn):
+    """按新电价重新计算历史电费的方案表和结果表"""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS rebill_scenarios (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL UNIQUE,
+        tariff TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'running',
+        record_count INTEGER NOT NULL DEFAULT 0,
+        original_amount REAL NOT NULL DEFAULT 0,
+        total_amount REAL NOT NULL DEFAULT 0
+    )
+    ''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS rebill_results (
+        scenario_id INTEGER NOT NULL REFERENCES rebill_scenarios(id) ON DELETE CASCADE,
+        record_id INTEGER NOT NULL,
+        total_bill_amount REAL NOT NULL,
+        your_share REAL NOT NULL,
+        my_share REAL NOT NULL,
+        PRIMARY KEY (scenario_id, record_id)
+    ) WITHOUT ROWID
+    ''')
+
+
+def _migrate_anomalies(conn):
+    """每个分表的用量统计（AnomalyDetector）和检测到的异常用量"""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS meter_usage_stats (
+        meter_id INTEGER PRIMARY KEY REFERENCES meters(id),
+        count INTEGER NOT NULL,
+        ewma REAL NOT NULL,
+        ewmad REAL NOT NULL,
+        median REAL NOT NULL,
+        mad REAL NOT NULL
+    )
+    ''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS usage_anomalies (
+        id INTEGER PRIMARY KEY,
+        record_id INTEGER NOT NULL REFERENCES bill_records(id) ON DELETE CASCADE,
+        meter_id INTEGER NOT NULL REFERENCES meters(id),
+        usage INTEGER NOT NULL,
+        expected REAL NOT NULL,
+        score REAL NOT NULL
+    )
+    ''')
+    # 删除账单记录时按 record_id 级联删除
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_usage_anomalies_record ON usage_anomalies(record_id)")
+
+
+def _migrate_meter_events(conn):
+    """分表的位数（读数归零）、换表事件，以及账单用量的调整值"""
+    conn.execute("ALTER TABLE meters ADD COLUMN digits INTEGER")
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS meter_replacements (
+        id INTEGER PRIMARY KEY,
+        meter_id INTEGER NOT NULL REFERENCES meters(id),
+        date TEXT NOT NULL,
+        final_reading INTEGER NOT NULL,
+        initial_reading INTEGER NOT NULL,
+        record_id INTEGER REFERENCES bill_records(id) ON DELETE SET NULL
+    )
+    ''')
+    # 计算用量时按分表和日期查找换表事件；record_id 为计入该事件的账单记录
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_meter_replacements_meter ON meter_replacements(meter_id, date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_meter_replacements_record ON meter_replacements(record_id)")
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS reading_adjustments (
+        record_id INTEGER NOT NULL REFERENCES bill_records(id) ON DELETE CASCADE,
+        field TEXT NOT NULL,
+        adjustment INTEGER NOT NULL,
+        PRIMARY KEY (record_id, field)
+    ) WITHOUT ROWID
+    ''')
+    # 一致性检查改为使用调整后的用量
+    conn.execute("DROP VIEW IF EXISTS bill_record_issues")
+    conn.execute(AUDIT_VIEW_SQL)
+
+
+def _migrate_latest_water_index(conn):
+    """(water_calculated, date) 索引：按日期倒序查找最近一次计算水费的记录（水表旧读数的默认值），
+    历史记录查询的水费条件也使用这个索引"""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bill_records_water ON bill_records(water_calculated, date)")
+
+
+# 较大一户的电费占总电费的比例（history 查询的 min_imbalance）。查询条件必须与表达式索引
+# idx_bill_records_imbalance 完全相同才能使用该索引；总电费为0时为 NULL，不会被选中
+IMBALANCE_SQL = "MAX(your_share, my_share) / total_bill_amount"
+
+
+def _migrate_query_indexes(conn):
+    """历史记录查询的索引：总用电量、分摊比例（表达式索引）；水费条件使用迁移8的索引"""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bill_records_usage ON bill_records(total_usage)")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_bill_records_imbalance ON bill_records(({IMBALANCE_SQL}))")
+
+
+def _migrate_audit_view(conn):
+    """按 SHARE_TOLERANCE 重新创建一致性检查视图（split_amount 的误差调整不再被当作不一致）"""
+    conn.execute("DROP VIEW IF EXISTS bill_record_issues")
+    conn.execute(AUDIT_VIEW_SQL)
+
+
+# 数据库迁移：(版本号, 说明, 迁移函数)，按版本号顺序执行。修改表结构时在末尾追加新的
+# 迁移，不要修改已发布的迁移
+SCHEMA_MIGRATIONS = (
+    (1, "账单记录表", _migrate_bill_records),
+    (2, "历史记录索引和一致性检查视图", _migrate_history_index),
+    (3, "月度汇总表", _migrate_rollups),
+    (4, "公用事业、分表、账单和读数表", _migrate_normalized),
+    (5, "重新计费方案表", _migrate_rebill),
+    (6, "分表用量统计和异常用量表", _migrate_anomalies),
+    (7, "分表位数、换表事件和用量调整表", _migrate_meter_events),
+    (8, "最近水表读数索引", _migrate_latest_water_index),
+    (9, "历史记录查询索引", _migrate_query_indexes),
+    (10, "一致性检查视图的分摊容差", _migrate_audit_view),
+)
+SCHEMA_VERSION = SCHEMA_MIGRATIONS[-1][0]
+
+
+class ConnectionManager:
+    """管理SQLite连接：每个线程复用自己的连接，并启用WAL模式
+
+    WAL模式下多个读连接可以和一个写连接同时工作，synchronous=NORMAL
+    只在检查点时同步磁盘，不再每次提交都 fsync。创建对象时不打开数据库，
+    第一次调用 connection() 时才连接，并用这个连接执行一次 setup(conn)。
+    """
+
+    def __init__(self, db_name, timeout=30, cache_size=-16000, setup=None):
         self.db_name = db_name
-        self.setup_database()
-        
-    def setup_database(self):
-        """设置SQLite数据库"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        # 检查表是否存在
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='bill_records'")
-        table_exists = cursor.fetchone()
-        
-        # 创建表格（如果不存在）
-        if not table_exists:
-            cursor.execute('''
-            CREATE TABLE IF NOT EXISTS bill_records (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                date TEXT,
-                your_old_reading INTEGER,
-                your_new_reading INTEGER,
-                your_usage INTEGER,
-                my_old_reading INTEGER,
-                my_new_reading INTEGER,
-                my_usage INTEGER,
-                total_usage INTEGER,
-                total_bill_amount REAL,
-                your_share REAL,
-                my_share REAL,
-                water_calculated INTEGER,
-                water_bill_amount REAL,
-                your_water_share REAL,
-                my_water_share REAL,
-                your_old_water INTEGER,
-                your_new_water INTEGER,
-                your_water_usage INTEGER,
-                my_old_water INTEGER,
-                my_new_water INTEGER,
-                my_water_usage INTEGER,
-                total_water_usage INTEGER
+        self.timeout = timeout
+        self.cache_size = cache_size  # 负数表示KB
+        self._setup = setup
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._setup_lock = threading.Lock()
+        self._connections = []
+
+    def _connect(self):
+        """新建连接并设置PRAGMA"""
+        import sqlite3
+        # 每个连接只在创建它的线程中使用；关闭 check_same_thread 是为了让 close_all
+        # 能在主线程关闭线程池等其他线程创建的连接
+        conn = sqlite3.connect(self.db_name, timeout=self.timeout, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size={int(self.cache_size)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    def connection(self):
+        """获取当前线程的连接（第一次使用时创建）"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            if self._setup is not None:
+                with self._setup_lock:
+                    try:
+                        if self._setup is not None:
+                            self._setup(conn)
+                            self._setup = None
+                    except BaseException:
+                        conn.close()
+                        raise
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """在一个事务中执行，成功则提交，出错则回滚"""
+        conn = self.connection()
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+    def close_all(self):
+        """关闭所有线程创建的连接（调用前其他线程应已停止使用数据库，例如线程池已关闭）"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+
+def _history_view(record, exact=False, adjustments=None):
+    """历史记录的显示值：用量按表读数（加上换表、归零的调整值）修正，颠倒的水表读数交换，
+    分摊金额偏差超过 0.1 时重新分摊。返回新的 BillRecord，不修改数据库中的记录。
+    """
+    adjustments = adjustments or {}
+    view = BillRecord(record.id, record.date, *_bill_values(record))
+
+    # 验证并修正用电量，确保与表读数一致
+    calc_your_usage = view.your_new_reading - view.your_old_reading + adjustments.get('your_usage', 0)
+    calc_my_usage = view.my_new_reading - view.my_old_reading + adjustments.get('my_usage', 0)
+    if view.your_usage != calc_your_usage or view.your_usage <= 0:
+        view.your_usage = max(0, calc_your_usage)
+    if view.my_usage != calc_my_usage or view.my_usage <= 0:
+        view.my_usage = max(0, calc_my_usage)
+    view.total_usage = view.your_usage + view.my_usage
+
+    # 如果总电费有效但分摊金额不一致，重新计算分摊
+    if view.total_bill_amount > 0 and view.total_usage > 0:
+        your_share, my_share = split_amount(view.total_bill_amount, view.your_usage, view.my_usage, exact)
+        if abs(view.your_share - your_share) > 0.1 or abs(view.my_share - my_share) > 0.1:
+            view.your_share, view.my_share = your_share, my_share
+
+    if view.water_calculated:
+        for old_key, new_key, usage_key in (('your_old_water', 'your_new_water', 'your_water_usage'),
+                                            ('my_old_water', 'my_new_water', 'my_water_usage')):
+            adjustment = adjustments.get(usage_key, 0)
+            old, new, usage = getattr(view, old_key), getattr(view, new_key), getattr(view, usage_key)
+            # 如果数据异常，可能是新旧读数颠倒了
+            if new - old + adjustment < 0 and usage > 0:
+                old, new = new, old
+                setattr(view, old_key, old)
+                setattr(view, new_key, new)
+            calc_usage = new - old + adjustment
+            if usage != calc_usage or usage < 0:
+                setattr(view, usage_key, max(0, calc_usage))
+        view.total_water_usage = view.your_water_usage + view.my_water_usage
+
+        # 如果总水费有效但分摊金额不一致，重新计算分摊
+        if view.water_bill_amount > 0 and view.total_water_usage > 0:
+            your_share, my_share = split_amount(
+                view.water_bill_amount, view.your_water_usage, view.my_water_usage, exact
+            )
+            if abs(view.your_water_share - your_share) > 0.1 or abs(view.my_water_share - my_share) > 0.1:
+                view.your_water_share, view.my_water_share = your_share, my_share
+    return view
+
+
+class TextFormatter:
+    """纯文本格式：把计算结果和历史记录渲染为文本，追加到输出缓冲（字符串列表）
+
+    各方法只向缓冲追加内容，调用者渲染完一整屏后用 write_buffer 一次写出，
+    不再逐行 print。子类改写 title、label 即可改变标题样式。
+    """
+    name = 'plain'
+
+    def title(self, icon, text):
+        """一级标题（计算结果、电费分摊、水费分摊等）"""
+        return text
+
+    def label(self, icon, text):
+        """小标题和提示项"""
+        return text
+
+    def results(self, out, record, digits=1):
+        """计算结果（display_results）"""
+        out.append(f"\n{self.title('📊', '电费水费计算结果')}\n{'-' * 30}\n")
+        self._body(out, record, digits)
+        out.append("-" * 30 + "\n")
+
+    def history_record(self, out, record, digits=1):
+        """一条历史记录（record 为 _history_view 修正后的显示值）"""
+        date = record.date if record.date is not None else "未知日期"
+        out.append(f"\n{'-' * 30}\n{self.label('📅', f'{date} [ID: {record.id}]')}\n")
+        self._body(out, record, digits)
+
+    def history_page(self, out, records, page, total_pages, digits=1):
+        """历史记录的一页"""
+        out.append(f"\n{self.title('📜', '历史记录')} (第{page}/{total_pages}页)\n")
+        for record in records:
+            self.history_record(out, record, digits)
+
+    def _body(self, out, record, digits):
+        label = self.label
+        total_your_share = record.your_share
+        total_my_share = record.my_share
+        out.append(
+            f"\n{self.title('⚡', '电费分摊')}\n"
+            f"{label('📝', '表读数:')}\n"
+            f"你家: {record.your_old_reading} → {record.your_new_reading}\n"
+            f"我家: {record.my_old_reading} → {record.my_new_reading}\n"
+        )
+        self._split(out, '电', '度', record.your_usage, record.my_usage, record.total_usage,
+                    record.total_bill_amount, record.your_share, record.my_share, digits)
+        if record.water_calculated:
+            out.append(
+                f"\n{self.title('💧', '水费分摊')}\n"
+                f"{label('📝', '表读数:')}\n"
+                f"你家: {record.your_old_water} → {record.your_new_water}\n"
+                f"我家: {record.my_old_water} → {record.my_new_water}\n"
+            )
+            self._split(out, '水', '单位', record.your_water_usage, record.my_water_usage, record.total_water_usage,
+                        record.water_bill_amount, record.your_water_share, record.my_water_share, digits)
+            total_your_share += record.your_water_share
+            total_my_share += record.my_water_share
+
+        out.append(f"\n{self.title('💵', '总费用')}\n")
+        if record.water_calculated:
+            out.append(
+                f"你家总计: ${total_your_share:.{digits}f} (电费 ${record.your_share:.{digits}f} + "
+                f"水费 ${record.your_water_share:.{digits}f})\n"
+                f"我家总计: ${total_my_share:.{digits}f} (电费 ${record.my_share:.{digits}f} + "
+                f"水费 ${record.my_water_share:.{digits}f})\n"
             )
-            ''')
         else:
-            # 检查是否缺少水费相关列
-            columns_to_check = [
-                ('your_old_water', 'INTEGER'),
-                ('your_new_water', 'INTEGER'),
-                ('your_water_usage', 'INTEGER'),
-                ('my_old_water', 'INTEGER'),
-                ('my_new_water', 'INTEGER'),
-                ('my_water_usage', 'INTEGER'),
-                ('total_water_usage', 'INTEGER')
-            ]
-            
-            # 获取当前表的所有列
-            cursor.execute("PRAGMA table_info(bill_records)")
-            existing_columns = [row[1] for row in cursor.fetchall()]
-            
-            # 添加缺少的列
-            for column_name, column_type in columns_to_check:
-                if column_name not in existing_columns:
-                    try:
-                        cursor.execute(f"ALTER TABLE bill_records ADD COLUMN {column_name} {column_type}")
-                        print(f"已添加列: {column_name}")
-                    except Exception as e:
-                        print(f"添加列时出错: {e}")
+            out.append(f"你家总计: ${total_your_share:.{digits}f}\n我家总计: ${total_my_share:.{digits}f}\n")
+
+    def _split(self, out, kind, unit, your_usage, my_usage, total_usage, amount, your_share, my_share, digits):
+        """一种费用的用量、比例和分摊金额"""
+        label = self.label
+        your_percent = your_usage / total_usage * 100 if total_usage > 0 else 0
+        my_percent = my_usage / total_usage * 100 if total_usage > 0 else 0
+        out.append(
+            f"\n{label('📈', f'用{kind}量:')}\n"
+            f"你家: {your_usage} {unit}\n"
+            f"我家: {my_usage} {unit}\n"
+            f"总用{kind}: {total_usage} {unit}\n"
+            f"\n{label('💰', f'总{kind}费:')} ${amount:.{digits}f}\n"
+            f"\n{label('📊', '分摊比例:')}\n"
+            f"你家: {your_percent:.1f}% ({your_usage}/{total_usage})\n"
+            f"我家: {my_percent:.1f}% ({my_usage}/{total_usage})\n"
+            f"\n{label('💵', '分摊金额:')}\n"
+            f"你家{kind}费: ${your_share:.{digits}f}\n"
+            f"我家{kind}费: ${my_share:.{digits}f}\n"
+        )
+
+
+class EmojiFormatter(TextFormatter):
+    """带 emoji 的文本格式（交互菜单的默认格式）"""
+    name = 'emoji'
+
+    def title(self, icon, text):
+        return f"{icon} *{text}* {icon}"
+
+    def label(self, icon, text):
+        return f"{icon} {text}"
+
+
+class JSONFormatter(TextFormatter):
+    """JSON Lines 格式：每条记录一行，字段与 BillRecord.as_dict() 相同，便于管道处理"""
+    name = 'json'
+
+    def results(self, out, record, digits=1):
+        self.history_record(out, record, digits)
+
+    def history_record(self, out, record, digits=1):
+        import json
+        out.append(json.dumps(record.as_dict(), ensure_ascii=False) + "\n")
+
+    def history_page(self, out, records, page, total_pages, digits=1):
+        for record in records:
+            self.history_record(out, record, digits)
+
+
+# 输出格式：名称 -> 格式化器
+FORMATTERS = {formatter.name: formatter for formatter in (TextFormatter(), EmojiFormatter(), JSONFormatter())}
+
+
+def write_buffer(out, stream=None):
+    """把输出缓冲一次写出"""
+    stream = stream or sys.stdout
+    stream.write("".join(out))
+    stream.flush()
+
+
+class BillCalculator:
+    def __init__(self, db_name="utility_bills.db", exact=False, tariff=None, cache_size=DEFAULT_CACHE_SIZE,
+                 style="emoji"):
+        self.db_name = db_name
+        # 精确模式：分摊金额以分为单位用整数计算，金额显示到分
+        self.exact = exact
+        self.money_digits = 2 if exact else 1
+        # 配置了电价时，没有输入总电费的账单按总用电量计算电费
+        self.tariff = tariff
+        # 批量计算（导入、calc --file）时缓存分摊结果，cache.stats() 为命中、未命中和淘汰次数
+        self.cache = LRUCache(cache_size)
+        # 计算结果和历史记录的输出格式（FORMATTERS：plain、emoji、json）
+        if style not in FORMATTERS:
+            raise ValueError(f"不支持的输出格式: {style}")
+        self.formatter = FORMATTERS[style]
+        # 不在这里打开数据库：第一次访问数据库时才连接并执行 setup_database
+        self.db = ConnectionManager(db_name, setup=self.setup_database)
+        self._meter_ids = {}
+        self._utility_ids = {}
+        # 分表用量统计（AnomalyDetector），第一次使用时读取；HTTP 服务的多个线程共用
+        self._detector = None
+        self._detector_lock = threading.Lock()
         
-        conn.commit()
-        conn.close()
+    def close(self):
+        """关闭数据库连接"""
+        self.db.close_all()
+        
+    def setup_database(self, conn=None):
+        """按 PRAGMA user_version 执行尚未应用的数据库迁移
+
+        数据库已是最新版本时只需读取一次 user_version。每个迁移在自己的事务中执行，
+        成功后更新 user_version，并记录用时。
+        """
+        conn = conn or self.db.connection()
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+
+        for target, description, migrate in SCHEMA_MIGRATIONS:
+            if target <= version:
+                continue
+            start_time = time.perf_counter()
+            # IMMEDIATE 事务先取得写锁，多个进程同时启动时只有一个会执行迁移
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if conn.execute("PRAGMA user_version").fetchone()[0] < target:
+                    migrate(conn)
+                    conn.execute(f"PRAGMA user_version = {target}")
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                _logger().exception("数据库迁移 %d（%s）失败，已回滚", target, description)
+                raise
+            _logger().info("数据库迁移 %d（%s）完成，用时 %.3f 秒",
+                        target, description, time.perf_counter() - start_time)
+            version = target
+
+    def rebuild_rollups(self, conn=None):
+        """根据 bill_records 重新生成月度汇总"""
+        _rebuild_rollups(conn or self.db.connection())
         
-    def validate_input(self, prompt, input_type="float", min_value=None, max_value=None, error_msg=None):
-        """验证用户输入"""
+    def validate_input(self, prompt, input_type="float", min_value=None, max_value=None, error_msg=None,
+                       default=None):
+        """验证用户输入；提供 default 时直接按Enter返回 default"""
         while True:
             try:
                 user_input = input(prompt)
+                if default is not None and not user_input.strip():
+                    return default
                 
                 # 检查是否为数字
                 if input_type == "float":
@@ -101,23 +1698,48 @@ class BillCalculator:
             except ValueError as e:
                 print(error_msg if error_msg else f"输入错误: {e}")
     
-    def check_meter_readings(self, old_reading, new_reading, meter_type="electric"):
-        """检查表读数的合理性"""
-        if new_reading < old_reading:
-            raise ValueError("新表读数不能小于旧表读数")
+    def show_tariff_breakdown(self, usage):
+        """显示按电价计算的电费明细，返回总电费"""
+        detail = self.tariff.breakdown(usage)
+        print(f"\n按电价计算（{usage} 度）:")
+        print(f"  分段电费: ${detail['energy_charge']:.2f}")
+        if detail['fuel_clause']:
+            print(f"  燃料调整费: ${detail['fuel_clause']:.2f}")
+        if detail['rebate']:
+            print(f"  回扣: -${detail['rebate']:.2f}")
+        if detail['fixed_charge']:
+            print(f"  固定费用: ${detail['fixed_charge']:.2f}")
+        if detail['minimum_charge_applied']:
+            print(f"  按最低收费计算: ${self.tariff.minimum_charge:.2f}")
+        print(f"  合计: ${detail['total']:.2f}")
+        return detail['total']
+
+    def check_meter_readings(self, old_reading, new_reading, meter_type="electric", household=None):
+        """检查表读数的合理性
+
+        提供 household 时按该分表的位数和换表记录计算用量（见 meter_usage），并按以往的
+        用量统计（AnomalyDetector）判断本次用量是否异常，异常时请用户确认。统计只在保存
+        记录时更新。返回用量。
+        """
+        if household is None:
+            if new_reading < old_reading:
+                raise ValueError("新表读数不能小于旧表读数")
+            return new_reading - old_reading
         
-        if meter_type == "electric":
-            # 检查电表读数是否过小
-            if new_reading < 1000 or old_reading < 1000:
-                confirm = input("表读数似乎很小，是否继续？(Y/N): ").lower()
-                if confirm != 'y':
-                    raise ValueError("用户取消了操作")
-        elif meter_type == "water":
-            # 水表读数检查逻辑：个位数或太大才提示
-            if new_reading < 10 or old_reading < 10 or new_reading > 100000 or old_reading > 100000:
-                confirm = input("水表读数似乎不太合理，是否继续？(Y/N): ").lower()
-                if confirm != 'y':
-                    raise ValueError("用户取消了操作")
+        utility = "water" if meter_type == "water" else "electricity"
+        field = next(field for field, name, kind, _, _ in LEGACY_METER_FIELDS if name == household and kind == utility)
+        meters, _ = self.legacy_meter_rules()
+        usage = _field_usage(field, old_reading, new_reading, meters)
+        meter_id = self.meter_id(household, utility, create=False)
+        detector = self.anomaly_detector()
+        score = detector.score(meter_id, usage) if meter_id is not None else None
+        if detector.is_anomaly(score):
+            unit = "单位" if utility == "water" else "度"
+            confirm = input(f"{household}本期用量 {usage} {unit}与以往差异较大（通常约 {score[0]:.0f} {unit}），"
+                            "是否继续？(Y/N): ").lower()
+            if confirm != 'y':
+                raise ValueError("用户取消了操作")
+        return usage
     
     def calculate_bills(self):
         """计算电费和水费"""
@@ -125,82 +1747,81 @@ class BillCalculator:
         print("请输入电表读数和费用信息：")
         
         try:
+            # 旧读数默认为上一张账单的新读数，直接按Enter使用
+            latest = self.latest_readings()
+            
             # 获取对方（你家）的电表读数
-            your_old_reading = self.validate_input("你家的旧电表读数: ", input_type="int", min_value=0, error_msg="请输入有效的非负整数")
+            your_old_reading = self.validate_input(_default_prompt("你家的旧电表读数", latest.get('your_old_reading')),
+                                                   input_type="int", min_value=0, error_msg="请输入有效的非负整数",
+                                                   default=latest.get('your_old_reading'))
             your_new_reading = self.validate_input("你家的新电表读数: ", input_type="int", min_value=0, error_msg="请输入有效的非负整数")
-            self.check_meter_readings(your_old_reading, your_new_reading, meter_type="electric")
+            your_usage = self.check_meter_readings(your_old_reading, your_new_reading, meter_type="electric", household="你家")
             
             # 获取我家的电表读数
-            my_old_reading = self.validate_input("我家的旧电表读数: ", input_type="int", min_value=0, error_msg="请输入有效的非负整数")
+            my_old_reading = self.validate_input(_default_prompt("我家的旧电表读数", latest.get('my_old_reading')),
+                                                 input_type="int", min_value=0, error_msg="请输入有效的非负整数",
+                                                 default=latest.get('my_old_reading'))
             my_new_reading = self.validate_input("我家的新电表读数: ", input_type="int", min_value=0, error_msg="请输入有效的非负整数")
-            self.check_meter_readings(my_old_reading, my_new_reading, meter_type="electric")
+            my_usage = self.check_meter_readings(my_old_reading, my_new_reading, meter_type="electric", household="我家")
             
-            # 计算用电量
-            your_usage = your_new_reading - your_old_reading
-            my_usage = my_new_reading - my_old_reading
+            # 计算用电量（换表或读数归零时按分表记录计算）
             total_usage = your_usage + my_usage
             
-            print(f"\n你家: {your_new_reading}-{your_old_reading}={your_usage}")
-            print(f"我家: {my_new_reading}-{my_old_reading}={my_usage}")
+            print(f"\n你家: {your_new_reading}-{your_old_reading}={your_usage}"
+                  + ("" if your_usage == your_new_reading - your_old_reading else " (已按换表/归零计算)"))
+            print(f"我家: {my_new_reading}-{my_old_reading}={my_usage}"
+                  + ("" if my_usage == my_new_reading - my_old_reading else " (已按换表/归零计算)"))
             print(f"总: {total_usage}")
             
-            # 获取总电费金额
-            total_bill_amount = self.validate_input("\n总电费金额($): ", min_value=0, error_msg="请输入有效的非负数")
+            # 获取总电费金额；配置了电价时先按电价计算，直接按Enter使用计算结果
+            estimated_amount = None
+            if self.tariff is not None:
+                estimated_amount = self.show_tariff_breakdown(total_usage)
+                total_bill_amount = self.validate_input(
+                    f"\n总电费金额($，直接按Enter使用 {estimated_amount:.2f}): ", min_value=0,
+                    error_msg="请输入有效的非负数", default=estimated_amount
+                )
+            else:
+                total_bill_amount = self.validate_input("\n总电费金额($): ", min_value=0, error_msg="请输入有效的非负数")
             
-            # 检查电费金额的合理性
-            if total_bill_amount < 100 or total_bill_amount > 10000:
+            # 检查电费金额的合理性（按电价计算的金额不需要确认）
+            if total_bill_amount != estimated_amount and (total_bill_amount < 100 or total_bill_amount > 10000):
                 confirm = input("电费金额似乎不太合理，是否继续？(Y/N): ").lower()
                 if confirm != 'y':
                     raise ValueError("用户取消了操作")
             
             # 根据各自用电量占比计算应付费用
-            your_share = round(total_bill_amount * your_usage / total_usage, 1) if total_usage > 0 else 0
-            my_share = round(total_bill_amount * my_usage / total_usage, 1) if total_usage > 0 else 0
-            
-            # 确保合计等于总金额，调整四舍五入误差
-            total_shares = round(your_share + my_share, 1)
-            if abs(total_shares - total_bill_amount) > 0.01:
-                diff = total_bill_amount - total_shares
-                # 将差额分配给较大的份额，避免较小份额变成负数
-                if your_usage >= my_usage:
-                    your_share = round(your_share + diff, 1)
-                else:
-                    my_share = round(my_share + diff, 1)
+            your_share, my_share = split_amount(total_bill_amount, your_usage, my_usage, self.exact)
             
-            print(f"\n你家: {total_bill_amount:.1f}*{your_usage}/{total_usage}={your_share:.1f}")
-            print(f"我家: {total_bill_amount:.1f}*{my_usage}/{total_usage}={my_share:.1f}")
+            print(f"\n你家: {total_bill_amount:.{self.money_digits}f}*{your_usage}/{total_usage}={your_share:.{self.money_digits}f}")
+            print(f"我家: {total_bill_amount:.{self.money_digits}f}*{my_usage}/{total_usage}={my_share:.{self.money_digits}f}")
             
             # 水费计算（可选）
             calculate_water = self.validate_input("\n是否需要计算水费？(Y/N): ", input_type="yn")
             
+            water_readings = None
             water_bill_amount = 0
-            your_water_share = 0
-            my_water_share = 0
-            water_calculated = 0
-            your_old_water = 0
-            your_new_water = 0
-            my_old_water = 0
-            my_new_water = 0
-            your_water_usage = 0
-            my_water_usage = 0
-            total_water_usage = 0
             
             if calculate_water == 'y':
-                water_calculated = 1
                 print("\n===== 水费计算 =====")
                 
                 # 获取水费信息
-                your_old_water = self.validate_input("你家的旧水表读数: ", input_type="int", min_value=0, error_msg="请输入有效的非负整数")
+                your_old_water = self.validate_input(_default_prompt("你家的旧水表读数", latest.get('your_old_water')),
+                                                     input_type="int", min_value=0, error_msg="请输入有效的非负整数",
+                                                     default=latest.get('your_old_water'))
                 your_new_water = self.validate_input("你家的新水表读数: ", input_type="int", min_value=0, error_msg="请输入有效的非负整数")
-                self.check_meter_readings(your_old_water, your_new_water, meter_type="water")
+                your_water_usage = self.check_meter_readings(your_old_water, your_new_water, meter_type="water",
+                                                             household="你家")
                 
-                my_old_water = self.validate_input("我家的旧水表读数: ", input_type="int", min_value=0, error_msg="请输入有效的非负整数")
+                my_old_water = self.validate_input(_default_prompt("我家的旧水表读数", latest.get('my_old_water')),
+                                                   input_type="int", min_value=0, error_msg="请输入有效的非负整数",
+                                                   default=latest.get('my_old_water'))
                 my_new_water = self.validate_input("我家的新水表读数: ", input_type="int", min_value=0, error_msg="请输入有效的非负整数")
-                self.check_meter_readings(my_old_water, my_new_water, meter_type="water")
+                my_water_usage = self.check_meter_readings(my_old_water, my_new_water, meter_type="water",
+                                                           household="我家")
+                water_readings = (your_old_water, your_new_water, my_old_water, my_new_water)
                 
                 # 计算用水量
-                your_water_usage = your_new_water - your_old_water
-                my_water_usage = my_new_water - my_old_water
                 total_water_usage = your_water_usage + my_water_usage
                 
                 print(f"\n你家: {your_new_water}-{your_old_water}={your_water_usage}")
@@ -211,41 +1832,22 @@ class BillCalculator:
                 water_bill_amount = self.validate_input("\n总水费金额($): ", min_value=0, error_msg="请输入有效的非负数")
                 
                 # 计算各自应付水费
-                your_water_share = round(water_bill_amount * your_water_usage / total_water_usage, 1) if total_water_usage > 0 else 0
-                my_water_share = round(water_bill_amount * my_water_usage / total_water_usage, 1) if total_water_usage > 0 else 0
+                your_water_share, my_water_share = split_amount(water_bill_amount, your_water_usage, my_water_usage, self.exact)
                 
-                # 确保合计等于总金额，调整四舍五入误差
-                total_water_shares = round(your_water_share + my_water_share, 1)
-                if abs(total_water_shares - water_bill_amount) > 0.01:
-                    diff = water_bill_amount - total_water_shares
-                    # 将差额分配给较大的份额，避免较小份额变成负数
-                    if your_water_usage >= my_water_usage:
-                        your_water_share = round(your_water_share + diff, 1)
-                    else:
-                        my_water_share = round(my_water_share + diff, 1)
-                
-                print(f"\n你家水费: {water_bill_amount:.1f}*{your_water_usage}/{total_water_usage}={your_water_share:.1f}")
-                print(f"我家水费: {water_bill_amount:.1f}*{my_water_usage}/{total_water_usage}={my_water_share:.1f}")
+                print(f"\n你家水费: {water_bill_amount:.{self.money_digits}f}*{your_water_usage}/{total_water_usage}={your_water_share:.{self.money_digits}f}")
+                print(f"我家水费: {water_bill_amount:.{self.money_digits}f}*{my_water_usage}/{total_water_usage}={my_water_share:.{self.money_digits}f}")
             
-            # 显示结果
-            self.display_results(
-                your_old_reading, your_new_reading, your_usage,
-                my_old_reading, my_new_reading, my_usage,
-                total_usage, total_bill_amount, your_share, my_share,
-                water_calculated, water_bill_amount, your_water_share, my_water_share,
-                your_old_water, your_new_water, my_old_water, my_new_water,
-                your_water_usage, my_water_usage, total_water_usage
+            meters, _ = self.legacy_meter_rules(water=water_readings is not None)
+            bill = compute_split(
+                (your_old_reading, your_new_reading, my_old_reading, my_new_reading),
+                total_bill_amount, water_readings, water_bill_amount, self.exact, meters=meters
             )
             
+            # 显示结果
+            self.display_results(bill)
+            
             # 保存记录到数据库
-            self.save_to_database(
-                your_old_reading, your_new_reading, your_usage,
-                my_old_reading, my_new_reading, my_usage,
-                total_usage, total_bill_amount, your_share, my_share,
-                water_calculated, water_bill_amount, your_water_share, my_water_share,
-                your_old_water, your_new_water, your_water_usage,
-                my_old_water, my_new_water, my_water_usage, total_water_usage
-            )
+            self.save_to_database(bill)
             
         except ValueError as e:
             print(f"错误: {e}")
@@ -254,484 +1856,304 @@ class BillCalculator:
             import traceback
             traceback.print_exc()
     
-    def display_results(self, your_old_reading, your_new_reading, your_usage,
-                       my_old_reading, my_new_reading, my_usage,
-                       total_usage, total_bill_amount, your_share, my_share,
-                       water_calculated, water_bill_amount, your_water_share, my_water_share,
-                       your_old_water, your_new_water, my_old_water, my_new_water,
-                       your_water_usage, my_water_usage, total_water_usage):
-        """显示计算结果"""
-        print("\n📊 *电费水费计算结果* 📊")
-        print("-"*30)
-        
-        print("\n⚡ *电费分摊* ⚡")
-        print("📝 表读数:")
-        print(f"你家: {your_old_reading} → {your_new_reading}")
-        print(f"我家: {my_old_reading} → {my_new_reading}")
-        
-        print("\n📈 用电量:")
-        print(f"你家: {your_usage} 度")
-        print(f"我家: {my_usage} 度")
-        print(f"总用电: {total_usage} 度")
-        
-        # 计算比例
-        your_percent = (your_usage / total_usage * 100) if total_usage > 0 else 0
-        my_percent = (my_usage / total_usage * 100) if total_usage > 0 else 0
-        
-        print(f"\n💰 总电费: ${total_bill_amount:.1f}")
-        print("\n📊 分摊比例:")
-        print(f"你家: {your_percent:.1f}% ({your_usage}/{total_usage})")
-        print(f"我家: {my_percent:.1f}% ({my_usage}/{total_usage})")
-        
-        print("\n💵 分摊金额:")
-        print(f"你家电费: ${your_share:.1f}")
-        print(f"我家电费: ${my_share:.1f}")
-        
-        total_your_share = your_share
-        total_my_share = my_share
-        
-        if water_calculated:
-            print("\n💧 *水费分摊* 💧")
-            print("📝 表读数:")
-            print(f"你家: {your_old_water} → {your_new_water}")
-            print(f"我家: {my_old_water} → {my_new_water}")
-            
-            print("\n📈 用水量:")
-            print(f"你家: {your_water_usage} 单位")
-            print(f"我家: {my_water_usage} 单位")
-            print(f"总用水: {total_water_usage} 单位")
-            
-            # 计算水费比例
-            your_water_percent = (your_water_usage / total_water_usage * 100) if total_water_usage > 0 else 0
-            my_water_percent = (my_water_usage / total_water_usage * 100) if total_water_usage > 0 else 0
-            
-            print(f"\n💰 总水费: ${water_bill_amount:.1f}")
-            print("\n📊 分摊比例:")
-            print(f"你家: {your_water_percent:.1f}% ({your_water_usage}/{total_water_usage})")
-            print(f"我家: {my_water_percent:.1f}% ({my_water_usage}/{total_water_usage})")
-            
-            print("\n💵 分摊金额:")
-            print(f"你家水费: ${your_water_share:.1f}")
-            print(f"我家水费: ${my_water_share:.1f}")
-            
-            total_your_share += your_water_share
-            total_my_share += my_water_share
-        
-        print("\n💵 *总费用* 💵")
-        if water_calculated:
-            print(f"你家总计: ${total_your_share:.1f} (电费 ${your_share:.1f} + 水费 ${your_water_share:.1f})")
-            print(f"我家总计: ${total_my_share:.1f} (电费 ${my_share:.1f} + 水费 ${my_water_share:.1f})")
-        else:
-            print(f"你家总计: ${total_your_share:.1f}")
-            print(f"我家总计: ${total_my_share:.1f}")
-        print("-"*30)
+    def display_results(self, record):
+        """显示计算结果（整个结果渲染到缓冲后一次写出）"""
+        out = []
+        self.formatter.results(out, record, self.money_digits)
+        write_buffer(out)
     
-    def save_to_database(self, your_old_reading, your_new_reading, your_usage,
-                       my_old_reading, my_new_reading, my_usage,
-                       total_usage, total_bill_amount, your_share, my_share,
-                       water_calculated, water_bill_amount, your_water_share, my_water_share,
-                       your_old_water=0, your_new_water=0, your_water_usage=0,
-                       my_old_water=0, my_new_water=0, my_water_usage=0, total_water_usage=0):
-        """保存记录到数据库"""
+    def save_to_database(self, record):
+        """保存记录到数据库，返回保存后的记录（包含 id 和日期），失败时返回 None"""
         try:
             print("\n正在保存计算结果到数据库...")
+            record = record.copy()
             
             # 验证数据正确性
-            # 1. 验证用电量是否与读数一致
-            calc_your_usage = your_new_reading - your_old_reading
-            calc_my_usage = my_new_reading - my_old_reading
+            # 1. 验证用电量是否与读数一致（换表或读数归零的分表按分表记录计算）
+            meters, replacements_used = self.legacy_meter_rules(water=record.water_calculated)
+            calc_your_usage = _field_usage('your_usage', record.your_old_reading, record.your_new_reading, meters)
+            calc_my_usage = _field_usage('my_usage', record.my_old_reading, record.my_new_reading, meters)
             
-            if calc_your_usage != your_usage:
-                print(f"警告: 你家用电量不一致 (计算值:{calc_your_usage}, 传入值:{your_usage})")
-                your_usage = calc_your_usage
+            if calc_your_usage != record.your_usage:
+                print(f"警告: 你家用电量不一致 (计算值:{calc_your_usage}, 传入值:{record.your_usage})")
+                record.your_usage = calc_your_usage
             
-            if calc_my_usage != my_usage:
-                print(f"警告: 我家用电量不一致 (计算值:{calc_my_usage}, 传入值:{my_usage})")
-                my_usage = calc_my_usage
+            if calc_my_usage != record.my_usage:
+                print(f"警告: 我家用电量不一致 (计算值:{calc_my_usage}, 传入值:{record.my_usage})")
+                record.my_usage = calc_my_usage
             
-            if your_usage + my_usage != total_usage:
-                print(f"警告: 总用电量不一致 (计算值:{your_usage + my_usage}, 传入值:{total_usage})")
-                total_usage = your_usage + my_usage
+            if record.your_usage + record.my_usage != record.total_usage:
+                print(f"警告: 总用电量不一致 (计算值:{record.your_usage + record.my_usage}, 传入值:{record.total_usage})")
+                record.total_usage = record.your_usage + record.my_usage
             
             # 2. 确保总电费不为0并且分摊金额与百分比一致
-            if total_bill_amount <= 0:
-                print(f"警告: 总电费为 ${total_bill_amount}，这可能是错误的")
-                if total_usage > 0:
+            if record.total_bill_amount <= 0:
+                print(f"警告: 总电费为 ${record.total_bill_amount}，这可能是错误的")
+                if record.total_usage > 0:
                     print("请检查电费数据")
             
             # 3. 验证电费分摊
-            if total_usage > 0:
-                expected_your_share = round(total_bill_amount * your_usage / total_usage, 1)
-                expected_my_share = round(total_bill_amount * my_usage / total_usage, 1)
-                
-                # 修正四舍五入误差
-                if abs(expected_your_share + expected_my_share - total_bill_amount) > 0.1:
-                    diff = total_bill_amount - (expected_your_share + expected_my_share)
-                    if your_usage >= my_usage:
-                        expected_your_share = round(expected_your_share + diff, 1)
-                    else:
-                        expected_my_share = round(expected_my_share + diff, 1)
+            if record.total_usage > 0:
+                expected_your_share, expected_my_share = split_amount(record.total_bill_amount, record.your_usage, record.my_usage, self.exact)
                 
-                if abs(your_share - expected_your_share) > 0.1:
-                    print(f"警告: 你家电费分摊不一致 (应为:{expected_your_share}, 传入值:{your_share})")
-                    your_share = expected_your_share
+                if abs(record.your_share - expected_your_share) > 0.1:
+                    print(f"警告: 你家电费分摊不一致 (应为:{expected_your_share}, 传入值:{record.your_share})")
+                    record.your_share = expected_your_share
                 
-                if abs(my_share - expected_my_share) > 0.1:
-                    print(f"警告: 我家电费分摊不一致 (应为:{expected_my_share}, 传入值:{my_share})")
-                    my_share = expected_my_share
+                if abs(record.my_share - expected_my_share) > 0.1:
+                    print(f"警告: 我家电费分摊不一致 (应为:{expected_my_share}, 传入值:{record.my_share})")
+                    record.my_share = expected_my_share
             
             # 4. 如果计算了水费，验证水费相关数据
-            if water_calculated:
+            if record.water_calculated:
                 # 验证用水量是否与读数一致
-                calc_your_water_usage = your_new_water - your_old_water
-                calc_my_water_usage = my_new_water - my_old_water
+                calc_your_water_usage = record.your_new_water - record.your_old_water
+                calc_my_water_usage = record.my_new_water - record.my_old_water
+                if 'your_water_usage' in meters:
+                    calc_your_water_usage = _field_usage('your_water_usage', record.your_old_water,
+                                                         record.your_new_water, meters)
+                if 'my_water_usage' in meters:
+                    calc_my_water_usage = _field_usage('my_water_usage', record.my_old_water, record.my_new_water, meters)
                 
-                # 检查水表读数是否可能颠倒了
-                if calc_your_water_usage < 0 and your_water_usage > 0:
-                    print(f"警告: 你家水表读数可能颠倒了 (旧:{your_old_water}, 新:{your_new_water})")
-                    temp = your_old_water
-                    your_old_water = your_new_water
-                    your_new_water = temp
-                    calc_your_water_usage = your_new_water - your_old_water
+                # 检查水表读数是否可能颠倒了（没有换表或归零记录时）
+                if calc_your_water_usage < 0 and record.your_water_usage > 0:
+                    print(f"警告: 你家水表读数可能颠倒了 (旧:{record.your_old_water}, 新:{record.your_new_water})")
+                    record.your_old_water, record.your_new_water = record.your_new_water, record.your_old_water
+                    calc_your_water_usage = record.your_new_water - record.your_old_water
                 
-                if calc_my_water_usage < 0 and my_water_usage > 0:
-                    print(f"警告: 我家水表读数可能颠倒了 (旧:{my_old_water}, 新:{my_new_water})")
-                    temp = my_old_water
-                    my_old_water = my_new_water
-                    my_new_water = temp
-                    calc_my_water_usage = my_new_water - my_old_water
+                if calc_my_water_usage < 0 and record.my_water_usage > 0:
+                    print(f"警告: 我家水表读数可能颠倒了 (旧:{record.my_old_water}, 新:{record.my_new_water})")
+                    record.my_old_water, record.my_new_water = record.my_new_water, record.my_old_water
+                    calc_my_water_usage = record.my_new_water - record.my_old_water
                 
-                if calc_your_water_usage != your_water_usage:
-                    print(f"警告: 你家用水量不一致 (计算值:{calc_your_water_usage}, 传入值:{your_water_usage})")
-                    your_water_usage = calc_your_water_usage
+                if calc_your_water_usage != record.your_water_usage:
+                    print(f"警告: 你家用水量不一致 (计算值:{calc_your_water_usage}, 传入值:{record.your_water_usage})")
+                    record.your_water_usage = calc_your_water_usage
                 
-                if calc_my_water_usage != my_water_usage:
-                    print(f"警告: 我家用水量不一致 (计算值:{calc_my_water_usage}, 传入值:{my_water_usage})")
-                    my_water_usage = calc_my_water_usage
+                if calc_my_water_usage != record.my_water_usage:
+                    print(f"警告: 我家用水量不一致 (计算值:{calc_my_water_usage}, 传入值:{record.my_water_usage})")
+                    record.my_water_usage = calc_my_water_usage
                 
-                if your_water_usage + my_water_usage != total_water_usage:
-                    print(f"警告: 总用水量不一致 (计算值:{your_water_usage + my_water_usage}, 传入值:{total_water_usage})")
-                    total_water_usage = your_water_usage + my_water_usage
+                if record.your_water_usage + record.my_water_usage != record.total_water_usage:
+                    print(f"警告: 总用水量不一致 (计算值:{record.your_water_usage + record.my_water_usage}, 传入值:{record.total_water_usage})")
+                    record.total_water_usage = record.your_water_usage + record.my_water_usage
                 
                 # 验证水费分摊
-                if total_water_usage > 0:
-                    expected_your_water_share = round(water_bill_amount * your_water_usage / total_water_usage, 1)
-                    expected_my_water_share = round(water_bill_amount * my_water_usage / total_water_usage, 1)
-                    
-                    # 修正四舍五入误差
-                    if abs(expected_your_water_share + expected_my_water_share - water_bill_amount) > 0.1:
-                        diff = water_bill_amount - (expected_your_water_share + expected_my_water_share)
-                        if your_water_usage >= my_water_usage:
-                            expected_your_water_share = round(expected_your_water_share + diff, 1)
-                        else:
-                            expected_my_water_share = round(expected_my_water_share + diff, 1)
+                if record.total_water_usage > 0:
+                    expected_your_water_share, expected_my_water_share = split_amount(
+                        record.water_bill_amount, record.your_water_usage, record.my_water_usage, self.exact
+                    )
                     
-                    if abs(your_water_share - expected_your_water_share) > 0.1:
-                        print(f"警告: 你家水费分摊不一致 (应为:{expected_your_water_share}, 传入值:{your_water_share})")
-                        your_water_share = expected_your_water_share
+                    if abs(record.your_water_share - expected_your_water_share) > 0.1:
+                        print(f"警告: 你家水费分摊不一致 (应为:{expected_your_water_share}, 传入值:{record.your_water_share})")
+                        record.your_water_share = expected_your_water_share
                     
-                    if abs(my_water_share - expected_my_water_share) > 0.1:
-                        print(f"警告: 我家水费分摊不一致 (应为:{expected_my_water_share}, 传入值:{my_water_share})")
-                        my_water_share = expected_my_water_share
+                    if abs(record.my_water_share - expected_my_water_share) > 0.1:
+                        print(f"警告: 我家水费分摊不一致 (应为:{expected_my_water_share}, 传入值:{record.my_water_share})")
+                        record.my_water_share = expected_my_water_share
             
-            # 连接数据库
-            conn = sqlite3.connect(self.db_name)
+            # 获取数据库连接
+            conn = self.db.connection()
             cursor = conn.cursor()
             
             # 转换为正确的数据类型
-            your_old_reading = int(your_old_reading)
-            your_new_reading = int(your_new_reading)
-            your_usage = int(your_usage)
-            my_old_reading = int(my_old_reading)
-            my_new_reading = int(my_new_reading)
-            my_usage = int(my_usage)
-            total_usage = int(total_usage)
-            total_bill_amount = float(total_bill_amount)
-            your_share = float(your_share)
-            my_share = float(my_share)
-            water_calculated = int(water_calculated)
-            water_bill_amount = float(water_bill_amount)
-            your_water_share = float(your_water_share)
-            my_water_share = float(my_water_share)
-            your_old_water = int(your_old_water)
-            your_new_water = int(your_new_water)
-            your_water_usage = int(your_water_usage)
-            my_old_water = int(my_old_water)
-            my_new_water = int(my_new_water)
-            my_water_usage = int(my_water_usage)
-            total_water_usage = int(total_water_usage)
+            record.coerce_types()
             
             # 使用参数化查询防止SQL注入
-            cursor.execute('''
-            INSERT INTO bill_records (
-                date, your_old_reading, your_new_reading, your_usage,
-                my_old_reading, my_new_reading, my_usage,
-                total_usage, total_bill_amount, your_share, my_share,
-                water_calculated, water_bill_amount, your_water_share, my_water_share,
-                your_old_water, your_new_water, your_water_usage,
-                my_old_water, my_new_water, my_water_usage, total_water_usage
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                your_old_reading, your_new_reading, your_usage,
-                my_old_reading, my_new_reading, my_usage,
-                total_usage, total_bill_amount, your_share, my_share,
-                water_calculated, water_bill_amount, your_water_share, my_water_share,
-                your_old_water, your_new_water, your_water_usage,
-                my_old_water, my_new_water, my_water_usage, total_water_usage
-            ))
+            record.date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            cursor.execute(INSERT_BILL_SQL, (record.date,) + record.values())
             
             # 获取刚插入的记录ID
-            record_id = cursor.lastrowid
+            record.id = cursor.lastrowid
+            # 换表、归零的调整值和用量统计（同一个事务）
+            self._save_meter_adjustments(conn, [(record.id, record, replacements_used)])
+            self.record_usage(conn, [(record.id, record)])
             conn.commit()
             
-            print(f"计算记录已成功保存到数据库 (ID: {record_id})")
+            print(f"计算记录已成功保存到数据库 (ID: {record.id})")
+            return record
             
         except Exception as e:
+            self.db.connection().rollback()
+            self.discard_usage_stats()
             print(f"保存到数据库时出错: {e}")
             import traceback
             traceback.print_exc()
+
+    def store_bill(self, record):
+        """保存一条已计算好的记录（例如 compute_split 的结果），不做检查也不输出提示
+
+        record 的日期为空时使用当前时间。返回包含 id 和日期的副本。
+        """
+        record = record.copy()
+        record.coerce_types()
+        record.date = record.date or datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            with self.db.transaction() as conn:
+                meters, used = self.legacy_meter_rules(record.date, record.water_calculated, conn)
+                if meters:
+                    # 有换表或会归零的分表：按分表记录重新计算用量和分摊
+                    water_readings = None
+                    if record.water_calculated:
+                        water_readings = (record.your_old_water, record.your_new_water,
+                                          record.my_old_water, record.my_new_water)
+                    date = record.date
+                    record = compute_split(
+                        (record.your_old_reading, record.your_new_reading, record.my_old_reading, record.my_new_reading),
+                        record.total_bill_amount, water_readings, record.water_bill_amount, self.exact, meters=meters
+                    )
+                    record.date = date
+                record.id = conn.execute(INSERT_BILL_SQL, (record.date,) + record.values()).lastrowid
+                self._save_meter_adjustments(conn, [(record.id, record, used)])
+                self.record_usage(conn, [(record.id, record)])
+        except BaseException:
+            self.discard_usage_stats()
+            raise
+        return record
+
+    def rebill(self, name, tariff, workers=None, partition_size=50000, cache_size=None):
+        """按新电价重新计算全部历史电费，结果保存到 rebill_results
+
+        bill_records 按 id 分成若干分区，由 ProcessPoolExecutor 并行计算，每个进程把结果
+        写到自己的临时数据库；executor.map 按分区顺序返回，主进程按同样的顺序逐个复制到
+        rebill_results，结果与进程数无关。写入期间方案状态为 running，全部完成后为 done，
+        出错时删除整个方案。同名方案会被替换。workers 默认为 CPU 核数，为1时不启动子进程。
+        每个进程用大小为 cache_size（默认与本对象的缓存相同，0 表示不缓存）的 LRU 缓存
+        保存电价和分摊结果。返回方案摘要字典，其中 cache 为各缓存的命中、未命中和淘汰次数。
+        """
+        if self.db_name == ':memory:':
+            raise ValueError("内存数据库不支持多进程重新计费")
+        import json
+        import shutil
+        import tempfile
+        start_time = time.perf_counter()
+        conn = self.db.connection()
+        first_id, last_id = conn.execute("SELECT MIN(id), MAX(id) FROM bill_records").fetchone()
+        original_amount = conn.execute(
+            "SELECT IFNULL(SUM(total_bill_amount), 0) FROM bill_monthly_rollups"
+        ).fetchone()[0]
+        workers = workers or os.cpu_count() or 1
+
+        with self.db.transaction():
+            conn.execute("DELETE FROM rebill_scenarios WHERE name = ?", (name,))
+            scenario_id = conn.execute(
+                "INSERT INTO rebill_scenarios (name, tariff, created_at) VALUES (?, ?, ?)",
+                (name, json.dumps(tariff.as_dict()), datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            ).lastrowid
+        summary = {'scenario_id': scenario_id, 'name': name, 'tariff': tariff.as_dict(), 'records': 0,
+                   'original_amount': original_amount, 'total_amount': 0.0}
+        cache_size = self.cache.maxsize if cache_size is None else cache_size
+        cache_stats = {
+            kind: {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0} for kind in ('tariff', 'split')
+        }
+
+        work_dir = tempfile.mkdtemp(prefix="rebill-")
+        executor = None
+        try:
+            tasks = []
+            if first_id is not None:
+                tasks = [
+                    (self.db_name, work_dir, scenario_id, start, min(start + partition_size - 1, last_id),
+                     tariff, self.exact, cache_size)
+                    for start in range(first_id, last_id + 1, partition_size)
+                ]
+            if workers > 1 and len(tasks) > 1:
+                import concurrent.futures
+                executor = concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(tasks)))
+                results = executor.map(_rebill_partition, tasks)
+            else:
+                results = map(_rebill_partition, tasks)
+
+            for path, count, total_amount, partition_cache_stats in results:
+                if count:
+                    # ATTACH 不能在事务中执行，每个分区单独提交
+                    conn.execute("ATTACH DATABASE ? AS partition", (path,))
+                    try:
+                        with self.db.transaction():
+                            conn.execute("INSERT INTO rebill_results SELECT * FROM partition.results")
+                    finally:
+                        conn.execute("DETACH DATABASE partition")
+                    os.remove(path)
+                summary['records'] += count
+                summary['total_amount'] += total_amount
+                for kind, counts in (partition_cache_stats or {}).items():
+                    for key, value in counts.items():
+                        cache_stats[kind][key] += value
+                elapsed = time.perf_counter() - start_time
+                rate = summary['records'] / elapsed if elapsed > 0 else 0
+                print(f"\r已重新计算 {summary['records']} 条记录 ({rate:.0f} 条/秒)", end="", flush=True)
+
+            with self.db.transaction():
+                conn.execute(
+                    "UPDATE rebill_scenarios SET status = 'done', record_count = ?, original_amount = ?, "
+                    "total_amount = ? WHERE id = ?",
+                    (summary['records'], original_amount, summary['total_amount'], scenario_id)
+                )
+        except BaseException:
+            with self.db.transaction():
+                conn.execute("DELETE FROM rebill_scenarios WHERE id = ?", (scenario_id,))
+            raise
         finally:
-            if conn:
-                conn.close()
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        summary['elapsed'] = time.perf_counter() - start_time
+        summary['cache'] = dict(cache_stats, maxsize=cache_size)
+        print(f"\r已重新计算 {summary['records']} 条记录，用时 {summary['elapsed']:.2f} 秒")
+        return summary
 
     def view_history(self):
         """查看历史记录"""
         try:
-            conn = sqlite3.connect(self.db_name)
+            conn = self.db.connection()
             cursor = conn.cursor()
             
-            # 查询所有记录
-            cursor.execute("SELECT * FROM bill_records ORDER BY date DESC")
-            records = cursor.fetchall()
+            # 统计记录数（使用索引，不加载记录内容）
+            total_records = cursor.execute("SELECT COUNT(*) FROM bill_records").fetchone()[0]
             
-            if not records:
+            if not total_records:
                 print("没有找到历史记录")
                 return
             
             # 分页设置
             page_size = 2  # 每页显示2条记录
-            total_records = len(records)
             total_pages = (total_records + page_size - 1) // page_size  # 向上取整
             current_page = 1
+            records = self.fetch_history_page(page_size)
             
             while True:
-                self.clear_screen()  # 清屏函数
-                start_idx = (current_page - 1) * page_size
-                end_idx = min(start_idx + page_size, total_records)
-                
-                print(f"\n📜 *历史记录* 📜 (第{current_page}/{total_pages}页)")
-                
-                # 显示当前页的记录
-                for i in range(start_idx, end_idx):
-                    record = records[i]
-                    try:
-                        # 提取记录ID和日期
-                        record_id = record[0]
-                        record_date = record[1] if record[1] is not None else "未知日期"
-                        print("\n" + "-"*30)
-                        print(f"📅 {record_date} [ID: {record_id}]")
-                        
-                        # 直接从数据库获取电费相关数据，处理可能的None值
-                        try:
-                            your_old_reading = int(record[2]) if record[2] is not None else 0
-                            your_new_reading = int(record[3]) if record[3] is not None else 0
-                            your_usage = int(record[4]) if record[4] is not None else 0
-                            my_old_reading = int(record[5]) if record[5] is not None else 0
-                            my_new_reading = int(record[6]) if record[6] is not None else 0
-                            my_usage = int(record[7]) if record[7] is not None else 0
-                            total_usage = int(record[8]) if record[8] is not None else 0
-                            total_bill_amount = float(record[9]) if record[9] is not None else 0.0
-                            your_share = float(record[10]) if record[10] is not None else 0.0
-                            my_share = float(record[11]) if record[11] is not None else 0.0
-                            
-                            # 验证并修正用电量，确保与表读数一致
-                            calc_your_usage = your_new_reading - your_old_reading
-                            calc_my_usage = my_new_reading - my_old_reading
-                            
-                            if your_usage != calc_your_usage or your_usage <= 0:
-                                your_usage = max(0, calc_your_usage)
-                            if my_usage != calc_my_usage or my_usage <= 0:
-                                my_usage = max(0, calc_my_usage)
-                            if total_usage != your_usage + my_usage:
-                                total_usage = your_usage + my_usage
-                            
-                            # 如果总电费有效但分摊金额不一致，重新计算分摊
-                            if total_bill_amount > 0 and total_usage > 0:
-                                expected_your_share = round(total_bill_amount * your_usage / total_usage, 1)
-                                expected_my_share = round(total_bill_amount * my_usage / total_usage, 1)
-                                
-                                # 修正四舍五入误差
-                                if round(expected_your_share + expected_my_share, 1) != total_bill_amount:
-                                    diff = total_bill_amount - round(expected_your_share + expected_my_share, 1)
-                                    if your_usage >= my_usage:
-                                        expected_your_share = round(expected_your_share + diff, 1)
-                                    else:
-                                        expected_my_share = round(expected_my_share + diff, 1)
-                                
-                                # 如果分摊金额与预期不符，使用重新计算的值
-                                if abs(your_share - expected_your_share) > 0.1 or abs(my_share - expected_my_share) > 0.1:
-                                    your_share = expected_your_share
-                                    my_share = expected_my_share
-                            
-                            # 显示电费分摊结果
-                            print("\n⚡ *电费分摊* ⚡")
-                            print("📝 表读数:")
-                            print(f"你家: {your_old_reading} → {your_new_reading}")
-                            print(f"我家: {my_old_reading} → {my_new_reading}")
-                            
-                            print("\n📈 用电量:")
-                            print(f"你家: {your_usage} 度")
-                            print(f"我家: {my_usage} 度")
-                            print(f"总用电: {total_usage} 度")
-                            
-                            # 计算电费占比，防止除以零错误
-                            if total_usage > 0:
-                                your_percent = (your_usage / total_usage * 100)
-                                my_percent = (my_usage / total_usage * 100)
-                            else:
-                                your_percent = 0.0
-                                my_percent = 0.0
-                            
-                            print(f"\n💰 总电费: ${total_bill_amount:.1f}")
-                            print("\n📊 分摊比例:")
-                            print(f"你家: {your_percent:.1f}% ({your_usage}/{total_usage})")
-                            print(f"我家: {my_percent:.1f}% ({my_usage}/{total_usage})")
-                            
-                            print("\n💵 分摊金额:")
-                            print(f"你家电费: ${your_share:.1f}")
-                            print(f"我家电费: ${my_share:.1f}")
-                            
-                            total_your_share = your_share
-                            total_my_share = my_share
-                            
-                            # 水费部分
-                            water_calculated = int(record[12]) if record[12] is not None else 0
-                            
-                            if water_calculated:
-                                try:
-                                    water_bill_amount = float(record[13]) if record[13] is not None else 0.0
-                                    your_water_share = float(record[14]) if record[14] is not None else 0.0
-                                    my_water_share = float(record[15]) if record[15] is not None else 0.0
-                                    
-                                    your_old_water = int(record[16]) if record[16] is not None else 0
-                                    your_new_water = int(record[17]) if record[17] is not None else 0
-                                    your_water_usage = int(record[18]) if record[18] is not None else 0
-                                    my_old_water = int(record[19]) if record[19] is not None else 0
-                                    my_new_water = int(record[20]) if record[20] is not None else 0
-                                    my_water_usage = int(record[21]) if record[21] is not None else 0
-                                    total_water_usage = int(record[22]) if record[22] is not None else 0
-                                    
-                                    # 验证并修正用水量，确保与表读数一致
-                                    calc_your_water_usage = your_new_water - your_old_water
-                                    calc_my_water_usage = my_new_water - my_old_water
-                                    
-                                    # 如果数据异常，可能是新旧读数颠倒了
-                                    if calc_your_water_usage < 0 and your_water_usage > 0:
-                                        # 交换新旧读数
-                                        temp = your_old_water
-                                        your_old_water = your_new_water
-                                        your_new_water = temp
-                                        calc_your_water_usage = your_new_water - your_old_water
-                                    
-                                    if calc_my_water_usage < 0 and my_water_usage > 0:
-                                        # 交换新旧读数
-                                        temp = my_old_water
-                                        my_old_water = my_new_water
-                                        my_new_water = temp
-                                        calc_my_water_usage = my_new_water - my_old_water
-                                    
-                                    if your_water_usage != calc_your_water_usage or your_water_usage < 0:
-                                        your_water_usage = max(0, calc_your_water_usage)
-                                    if my_water_usage != calc_my_water_usage or my_water_usage < 0:
-                                        my_water_usage = max(0, calc_my_water_usage)
-                                    if total_water_usage != your_water_usage + my_water_usage:
-                                        total_water_usage = your_water_usage + my_water_usage
-                                    
-                                    # 如果总水费有效但分摊金额不一致，重新计算分摊
-                                    if water_bill_amount > 0 and total_water_usage > 0:
-                                        expected_your_water_share = round(water_bill_amount * your_water_usage / total_water_usage, 1)
-                                        expected_my_water_share = round(water_bill_amount * my_water_usage / total_water_usage, 1)
-                                        
-                                        # 修正四舍五入误差
-                                        if round(expected_your_water_share + expected_my_water_share, 1) != water_bill_amount:
-                                            diff = water_bill_amount - round(expected_your_water_share + expected_my_water_share, 1)
-                                            if your_water_usage >= my_water_usage:
-                                                expected_your_water_share = round(expected_your_water_share + diff, 1)
-                                            else:
-                                                expected_my_water_share = round(expected_my_water_share + diff, 1)
-                                        
-                                        # 如果分摊金额与预期不符，使用重新计算的值
-                                        if abs(your_water_share - expected_your_water_share) > 0.1 or abs(my_water_share - expected_my_water_share) > 0.1:
-                                            your_water_share = expected_your_water_share
-                                            my_water_share = expected_my_water_share
-                                    
-                                    print("\n💧 *水费分摊* 💧")
-                                    print("📝 表读数:")
-                                    print(f"你家: {your_old_water} → {your_new_water}")
-                                    print(f"我家: {my_old_water} → {my_new_water}")
-                                    
-                                    print("\n📈 用水量:")
-                                    print(f"你家: {your_water_usage} 单位")
-                                    print(f"我家: {my_water_usage} 单位")
-                                    print(f"总用水: {total_water_usage} 单位")
-                                    
-                                    # 计算水费占比，防止除以零错误
-                                    if total_water_usage > 0:
-                                        your_water_percent = (your_water_usage / total_water_usage * 100)
-                                        my_water_percent = (my_water_usage / total_water_usage * 100)
-                                    else:
-                                        your_water_percent = 0.0
-                                        my_water_percent = 0.0
-                                    
-                                    print(f"\n💰 总水费: ${water_bill_amount:.1f}")
-                                    print("\n📊 分摊比例:")
-                                    print(f"你家: {your_water_percent:.1f}% ({your_water_usage}/{total_water_usage})")
-                                    print(f"我家: {my_water_percent:.1f}% ({my_water_usage}/{total_water_usage})")
-                                    
-                                    print("\n💵 分摊金额:")
-                                    print(f"你家水费: ${your_water_share:.1f}")
-                                    print(f"我家水费: ${my_water_share:.1f}")
-                                    
-                                    total_your_share += your_water_share
-                                    total_my_share += my_water_share
-                                except Exception as e:
-                                    print(f"处理水费数据时出错: {e}")
-                                    print("水费数据显示失败，可能数据不完整")
-                            
-                            # 显示总费用
-                            print("\n💵 *总费用* 💵")
-                            if water_calculated:
-                                print(f"你家总计: ${total_your_share:.1f} (电费 ${your_share:.1f} + 水费 ${your_water_share:.1f})")
-                                print(f"我家总计: ${total_my_share:.1f} (电费 ${my_share:.1f} + 水费 ${my_water_share:.1f})")
-                            else:
-                                print(f"你家总计: ${total_your_share:.1f}")
-                                print(f"我家总计: ${total_my_share:.1f}")
-                        except Exception as e:
-                            print(f"处理电费数据时出错: {e}")
-                            print("此记录数据不完整，建议使用'F'选项修复此记录或删除")
-                        
-                    except Exception as e:
-                        print(f"显示记录 {record_id} 时出错: {e}")
-                        print(f"此记录可能有错误，请使用'F'选项修复或删除")
-                        continue
-                
-                # 分页导航
-                print("\n" + "-"*30)
-                print("[P] 上一页 | [N] 下一页 | [数字] 跳到特定页 | [Q] 返回主菜单 | [F] 修复当前页记录 | [D] 删除记录")
+                # 清屏、整页记录和分页导航渲染到缓冲后一次写出
+                out = []
+                self.clear_screen(out)
+                self.render_history_page(out, records, current_page, total_pages)
+                out.append("\n" + "-"*30 + "\n")
+                out.append("[P] 上一页 | [N] 下一页 | [数字] 跳到特定页 | [Q] 返回主菜单 | [F] 修复当前页记录 | [D] 删除记录\n")
+                write_buffer(out)
                 
                 choice = input("请选择: ").lower()
                 
                 if choice == 'q':
                     break
                 elif choice == 'p' and current_page > 1:
+                    # 当前页为空时（记录已被删除）按页码定位
+                    if records:
+                        records = self.fetch_history_page(page_size, before=self._history_key(records[0]))
+                    else:
+                        records = self._load_history_page(current_page - 1, page_size)
                     current_page -= 1
                 elif choice == 'n' and current_page < total_pages:
-                    current_page += 1
+                    if records:
+                        next_records = self.fetch_history_page(page_size, after=self._history_key(records[-1]))
+                    else:
+                        next_records = self._load_history_page(current_page + 1, page_size)
+                    if next_records:
+                        records = next_records
+                        current_page += 1
                 elif choice == 'f':
                     # 修复当前页上的记录
-                    for i in range(start_idx, end_idx):
-                        record_id = records[i][0]
+                    for record in records:
+                        record_id = record.id
                         try:
                             # 确认是否要修复此记录
                             fix_confirm = input(f"是否要修复记录ID: {record_id}? (y/n): ").lower()
@@ -739,9 +2161,12 @@ class BillCalculator:
                                 self.fix_record(record_id)
                         except Exception as e:
                             print(f"修复记录 {record_id} 时出错: {e}")
-                    # 重新加载记录
-                    cursor.execute("SELECT * FROM bill_records ORDER BY date DESC")
-                    records = cursor.fetchall()
+                    # 只重新加载当前页；当前页为空时（记录已被删除）从第一页重新加载
+                    if records:
+                        records = self.fetch_history_page(page_size, start=self._history_key(records[0]))
+                    if not records:
+                        records = self.fetch_history_page(page_size)
+                        current_page = 1
                 elif choice == 'd':
                     # 删除记录
                     record_id = input("请输入要删除的记录ID: ")
@@ -750,20 +2175,21 @@ class BillCalculator:
                         delete_confirm = input(f"确认要删除记录ID: {record_id}? (y/n): ").lower()
                         if delete_confirm == 'y':
                             cursor.execute("DELETE FROM bill_records WHERE id = ?", (record_id,))
+                            deleted = cursor.rowcount
                             conn.commit()
                             print(f"记录ID: {record_id} 已删除")
-                            # 重新加载记录
-                            cursor.execute("SELECT * FROM bill_records ORDER BY date DESC")
-                            records = cursor.fetchall()
-                            total_records = len(records)
+                            # 重新加载当前页
+                            total_records -= deleted
                             total_pages = (total_records + page_size - 1) // page_size if total_records > 0 else 1
-                            current_page = min(current_page, total_pages) if total_pages > 0 else 1
+                            current_page = min(current_page, total_pages)
+                            records = self._load_history_page(current_page, page_size)
                     except ValueError:
                         print("请输入有效的记录ID")
                 elif choice.isdigit():
                     page_num = int(choice)
                     if 1 <= page_num <= total_pages:
                         current_page = page_num
+                        records = self._load_history_page(current_page, page_size)
                     else:
                         print(f"页码超出范围，请输入1-{total_pages}之间的数字")
                         input("按Enter键继续...")
@@ -772,21 +2198,97 @@ class BillCalculator:
                     input("按Enter键继续...")
             
         except Exception as e:
+            self.db.connection().rollback()
             print(f"查看历史记录时出错: {e}")
             import traceback
             traceback.print_exc()
-        finally:
-            if conn:
-                conn.close()
-                
+
+    @staticmethod
+    def _history_key(record):
+        """记录在历史排序中的位置 (date, id)"""
+        return record.date, record.id
+
+    def _load_history_page(self, page_num, page_size):
+        """跳到指定页：先在日期索引上定位该页第一条记录，再按键集取一页"""
+        row = self.db.connection().execute(
+            "SELECT date, id FROM bill_records ORDER BY date DESC, id DESC LIMIT 1 OFFSET ?",
+            ((page_num - 1) * page_size,)
+        ).fetchone()
+        if row is None:
+            return []
+        return self.fetch_history_page(page_size, start=tuple(row))
+
+    def fetch_history_page(self, page_size, start=None, after=None, before=None):
+        """按日期倒序取一页历史记录（键集分页，只读取这一页）
+
+        start、after、before 为记录的 (date, id)：
+        start 表示从该记录开始（包含）；after 表示该记录之后（更早）的一页；
+        before 表示该记录之前（更新）的一页。都不传时返回第一页。
+        """
+        select = f"SELECT {RECORD_COLUMNS} FROM bill_records WHERE "
+        if before is not None:
+            # 向前翻页：按升序取紧挨着的记录，再反转
+            date, record_id = before
+            if date is None:
+                segments = [
+                    ("date IS NULL AND id > ? ORDER BY id ASC", (record_id,)),
+                    ("date IS NOT NULL ORDER BY date ASC, id ASC", ()),
+                ]
+            else:
+                segments = [
+                    ("date = ? AND id > ? ORDER BY id ASC", (date, record_id)),
+                    ("date > ? ORDER BY date ASC, id ASC", (date,)),
+                ]
+        elif start is None and after is None:
+            segments = [
+                ("date IS NOT NULL ORDER BY date DESC, id DESC", ()),
+                ("date IS NULL ORDER BY id DESC", ()),
+            ]
+        else:
+            date, record_id = start if start is not None else after
+            op = '<=' if start is not None else '<'
+            if date is None:
+                segments = [(f"date IS NULL AND id {op} ? ORDER BY id DESC", (record_id,))]
+            else:
+                segments = [
+                    (f"date = ? AND id {op} ? ORDER BY id DESC", (date, record_id)),
+                    ("date < ? ORDER BY date DESC, id DESC", (date,)),
+                    ("date IS NULL ORDER BY id DESC", ()),
+                ]
+
+        # 每一段都是日期索引上的一次范围查找，取满一页即停止
+        cursor = self.db.connection().cursor()
+        cursor.row_factory = BillRecord.from_row
+        rows = []
+        for condition, params in segments:
+            rows += cursor.execute(select + condition + " LIMIT ?", params + (page_size - len(rows),)).fetchall()
+            if len(rows) >= page_size:
+                break
+        if before is not None:
+            rows.reverse()
+        return rows
+
+    def history_views(self, records):
+        """历史记录的显示值（见 _history_view），一次读取这些记录的用量调整值"""
+        if not records:
+            return []
+        ids = [record.id for record in records]
+        adjustments = self._load_adjustments(self.db.connection(), min(ids), max(ids))
+        return [_history_view(record, self.exact, adjustments.get(record.id)) for record in records]
+
+    def render_history_page(self, out, records, page, total_pages):
+        """把一页历史记录渲染到输出缓冲，金额保留一位小数"""
+        self.formatter.history_page(out, self.history_views(records), page, total_pages, self.money_digits)
+
     def fix_record(self, record_id):
         """修复特定记录的错误数据"""
         try:
-            conn = sqlite3.connect(self.db_name)
+            conn = self.db.connection()
             cursor = conn.cursor()
+            cursor.row_factory = BillRecord.from_row
             
             # 查询记录
-            cursor.execute("SELECT * FROM bill_records WHERE id = ?", (record_id,))
+            cursor.execute(f"SELECT {RECORD_COLUMNS} FROM bill_records WHERE id = ?", (record_id,))
             record = cursor.fetchone()
             
             if not record:
@@ -795,146 +2297,882 @@ class BillCalculator:
                 
             print(f"正在修复记录ID: {record_id}")
             
-            # 获取所有字段值
-            your_old_reading = int(record[2]) if record[2] is not None else 0
-            your_new_reading = int(record[3]) if record[3] is not None else 0
-            your_usage = your_new_reading - your_old_reading
-            my_old_reading = int(record[5]) if record[5] is not None else 0
-            my_new_reading = int(record[6]) if record[6] is not None else 0
-            my_usage = my_new_reading - my_old_reading
-            total_usage = your_usage + my_usage
-            
-            total_bill_amount = float(record[9]) if record[9] is not None else 0.0
+            # 根据表读数重新计算用电量（加上换表、读数归零的调整值）
+            adjustments = self._load_adjustments(conn, record_id, record_id).get(record_id, {})
+            record.your_usage = record.your_new_reading - record.your_old_reading + adjustments.get('your_usage', 0)
+            record.my_usage = record.my_new_reading - record.my_old_reading + adjustments.get('my_usage', 0)
+            record.total_usage = record.your_usage + record.my_usage
             
             # 如果总电费为0，请求用户输入
-            if total_bill_amount <= 0:
+            if record.total_bill_amount <= 0:
                 try:
-                    total_bill_amount = float(input("请输入正确的总电费金额: "))
+                    record.total_bill_amount = float(input("请输入正确的总电费金额: "))
                 except ValueError:
                     print("输入无效，设置为默认值641.0")
-                    total_bill_amount = 641.0
+                    record.total_bill_amount = 641.0
             
-            # 重新计算分摊金额
-            your_share = round(total_bill_amount * your_usage / total_usage, 1) if total_usage > 0 else 0
-            my_share = round(total_bill_amount * my_usage / total_usage, 1) if total_usage > 0 else 0
+            # 重新计算分摊金额（精确模式下按分精确分摊）
+            record.your_share, record.my_share = (
+                split_amount(record.total_bill_amount, record.your_usage, record.my_usage, self.exact)
+                if record.total_usage > 0 else (0, 0)
+            )
             
             # 水费部分
-            water_calculated = int(record[12]) if record[12] is not None else 0
-            water_bill_amount = float(record[13]) if record[13] is not None else 0.0
-            
-            if water_calculated:
-                your_old_water = int(record[16]) if record[16] is not None else 0
-                your_new_water = int(record[17]) if record[17] is not None else 0
-                your_water_usage = your_new_water - your_old_water
-                my_old_water = int(record[19]) if record[19] is not None else 0
-                my_new_water = int(record[20]) if record[20] is not None else 0
-                my_water_usage = my_new_water - my_old_water
+            if record.water_calculated:
+                record.your_water_usage = (record.your_new_water - record.your_old_water
+                                           + adjustments.get('your_water_usage', 0))
+                record.my_water_usage = record.my_new_water - record.my_old_water + adjustments.get('my_water_usage', 0)
                 
                 # 如果水表读数不合理，请求用户输入
-                if your_water_usage <= 0 or my_water_usage < 0:
+                if record.your_water_usage <= 0 or record.my_water_usage < 0:
                     print("水表读数异常，请输入正确的数值:")
                     try:
-                        your_old_water = int(input("你家的旧水表读数: "))
-                        your_new_water = int(input("你家的新水表读数: "))
-                        your_water_usage = your_new_water - your_old_water
+                        record.your_old_water = int(input("你家的旧水表读数: "))
+                        record.your_new_water = int(input("你家的新水表读数: "))
+                        record.your_water_usage = record.your_new_water - record.your_old_water
                         
-                        my_old_water = int(input("我家的旧水表读数: "))
-                        my_new_water = int(input("我家的新水表读数: "))
-                        my_water_usage = my_new_water - my_old_water
+                        record.my_old_water = int(input("我家的旧水表读数: "))
+                        record.my_new_water = int(input("我家的新水表读数: "))
+                        record.my_water_usage = record.my_new_water - record.my_old_water
                     except ValueError:
                         print("输入无效，使用默认值")
-                        your_old_water = 644
-                        your_new_water = 770
-                        your_water_usage = 126
-                        my_old_water = 163
-                        my_new_water = 164
-                        my_water_usage = 1
+                        record.your_old_water = 644
+                        record.your_new_water = 770
+                        record.your_water_usage = 126
+                        record.my_old_water = 163
+                        record.my_new_water = 164
+                        record.my_water_usage = 1
                 
-                total_water_usage = your_water_usage + my_water_usage
+                record.total_water_usage = record.your_water_usage + record.my_water_usage
                 
                 # 如果总水费为0，请求用户输入
-                if water_bill_amount <= 0:
+                if record.water_bill_amount <= 0:
                     try:
-                        water_bill_amount = float(input("请输入正确的总水费金额: "))
+                        record.water_bill_amount = float(input("请输入正确的总水费金额: "))
                     except ValueError:
                         print("输入无效，设置为默认值733.8")
-                        water_bill_amount = 733.8
+                        record.water_bill_amount = 733.8
                 
                 # 重新计算水费分摊
-                your_water_share = round(water_bill_amount * your_water_usage / total_water_usage, 1) if total_water_usage > 0 else 0
-                my_water_share = round(water_bill_amount * my_water_usage / total_water_usage, 1) if total_water_usage > 0 else 0
+                record.your_water_share, record.my_water_share = (
+                    split_amount(record.water_bill_amount, record.your_water_usage, record.my_water_usage, self.exact)
+                    if record.total_water_usage > 0 else (0, 0)
+                )
             else:
-                your_old_water = 0
-                your_new_water = 0
-                your_water_usage = 0
-                my_old_water = 0
-                my_new_water = 0
-                my_water_usage = 0
-                total_water_usage = 0
-                water_bill_amount = 0
-                your_water_share = 0
-                my_water_share = 0
+                record.your_old_water = 0
+                record.your_new_water = 0
+                record.your_water_usage = 0
+                record.my_old_water = 0
+                record.my_new_water = 0
+                record.my_water_usage = 0
+                record.total_water_usage = 0
+                record.water_bill_amount = 0
+                record.your_water_share = 0
+                record.my_water_share = 0
             
             # 更新记录
-            cursor.execute('''
-            UPDATE bill_records SET
-                your_old_reading = ?,
-                your_new_reading = ?,
-                your_usage = ?,
-                my_old_reading = ?,
-                my_new_reading = ?,
-                my_usage = ?,
-                total_usage = ?,
-                total_bill_amount = ?,
-                your_share = ?,
-                my_share = ?,
-                water_calculated = ?,
-                water_bill_amount = ?,
-                your_water_share = ?,
-                my_water_share = ?,
-                your_old_water = ?,
-                your_new_water = ?,
-                your_water_usage = ?,
-                my_old_water = ?,
-                my_new_water = ?,
-                my_water_usage = ?,
-                total_water_usage = ?
-            WHERE id = ?
-            ''', (
-                your_old_reading,
-                your_new_reading,
-                your_usage,
-                my_old_reading,
-                my_new_reading,
-                my_usage,
-                total_usage,
-                total_bill_amount,
-                your_share,
-                my_share,
-                water_calculated,
-                water_bill_amount,
-                your_water_share,
-                my_water_share,
-                your_old_water,
-                your_new_water,
-                your_water_usage,
-                my_old_water,
-                my_new_water,
-                my_water_usage,
-                total_water_usage,
-                record_id
-            ))
+            cursor.execute(UPDATE_BILL_SQL, record.values() + (record_id,))
             
             conn.commit()
             print(f"记录 {record_id} 已成功修复")
             
         except Exception as e:
+            self.db.connection().rollback()
             print(f"修复记录时出错: {e}")
             import traceback
             traceback.print_exc()
+
+    def repair_all(self, dry_run=False, batch_size=1000):
+        """按 id 分批检查全部记录，在一个事务中批量修复不一致的数据
+
+        dry_run 为 True 时只报告不修改。返回字典：checked（检查条数）、
+        repaired（需要/已经修复的 [(id, [字段...])]）、manual（需要人工处理的 id）。
+        """
+        start_time = time.perf_counter()
+        report = {'checked': 0, 'repaired': [], 'manual': []}
+        conn = self.db.connection()
+        cursor = conn.cursor()
+        cursor.row_factory = BillRecord.from_row
+        last_id = 0
+        with self.db.transaction():
+            while True:
+                rows = cursor.execute(
+                    f"SELECT {RECORD_COLUMNS} FROM bill_records WHERE id > ? ORDER BY id LIMIT ?", (last_id, batch_size)
+                ).fetchall()
+                if not rows:
+                    break
+                adjustments = self._load_adjustments(conn, rows[0].id, rows[-1].id)
+                last_id = rows[-1].id
+
+                updates = []
+                for record in rows:
+                    fixed = repair_bill_values(record, self.exact, adjustments.get(record.id))
+                    if fixed is None:
+                        report['manual'].append(record.id)
+                        continue
+                    changed = [field for field, old, new in zip(BILL_FIELDS, record.values(), fixed) if old != new]
+                    if changed:
+                        report['repaired'].append((record.id, changed))
+                        updates.append(fixed + (record.id,))
+                if updates and not dry_run:
+                    conn.executemany(UPDATE_BILL_SQL, updates)
+
+                report['checked'] += len(rows)
+                elapsed = time.perf_counter() - start_time
+                rate = report['checked'] / elapsed if elapsed > 0 else 0
+                print(f"\r已检查 {report['checked']} 条，发现 {len(report['repaired'])} 条需要修复 "
+                      f"({rate:.0f} 条/秒)", end="", flush=True)
+        print()
+        return report
+
+    def audit_records(self):
+        """在 SQLite 中一次扫描找出所有不一致的记录
+
+        只有有问题的记录会返回到 Python。返回字典：total（有问题的记录数）、
+        counts（每个检查项的记录数）、ids（有问题的记录 id 列表）。
+        """
+        checks = [name for name, _ in AUDIT_CHECKS]
+        rows = self.db.connection().execute(
+            f"SELECT id, {', '.join(checks)} FROM bill_record_issues "
+            f"WHERE {' OR '.join(checks)} ORDER BY id"
+        ).fetchall()
+        counts = {name: sum(1 for row in rows if row[i + 1]) for i, name in enumerate(checks)}
+        return {'total': len(rows), 'counts': counts, 'ids': [row[0] for row in rows]}
+
+    def show_audit(self):
+        """显示一致性检查结果"""
+        report = self.audit_records()
+        if not report['total']:
+            print("所有记录均通过一致性检查")
+            return
+        print(f"共有 {report['total']} 条记录未通过一致性检查:")
+        for name, description in AUDIT_CHECKS:
+            if report['counts'][name]:
+                print(f"  {description}: {report['counts'][name]} 条")
+        print(f"记录ID: {', '.join(str(record_id) for record_id in report['ids'])}")
+
+    def usage_report(self, period="month", start=None, end=None):
+        """按月、季度或年份统计用量和费用（只读取月度汇总表）
+
+        start、end 为 YYYY-MM 格式的月份范围（包含）。返回每个统计周期一个字典，
+        包含合计、每张账单的平均值以及每度电的平均电费。
+        """
+        period_sql = {
+            "month": "month",
+            "quarter": "CASE WHEN month = '' THEN '' ELSE substr(month, 1, 4) || '-Q' || "
+                       "((CAST(substr(month, 6, 2) AS INTEGER) + 2) / 3) END",
+            "year": "substr(month, 1, 4)",
+        }
+        if period not in period_sql:
+            raise ValueError(f"不支持的统计周期: {period}")
+
+        conditions = []
+        params = []
+        if start:
+            conditions.append("month >= ?")
+            params.append(start)
+        if end:
+            conditions.append("month <= ?")
+            params.append(end)
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+
+        columns = [name for name, _ in ROLLUP_COLUMNS]
+        cursor = self.db.connection().execute(
+            f"SELECT {period_sql[period]} AS period, {', '.join(f'SUM({name})' for name in columns)} "
+            f"FROM bill_monthly_rollups{where} GROUP BY period HAVING SUM(bill_count) > 0 ORDER BY period",
+            params
+        )
+        report = []
+        for row in cursor:
+            totals = dict(zip(columns, row[1:]))
+            bill_count = totals['bill_count']
+            water_bill_count = totals['water_bill_count']
+            report.append({
+                'period': row[0],
+                **totals,
+                'avg_usage': totals['total_usage'] / bill_count,
+                'avg_bill_amount': totals['total_bill_amount'] / bill_count,
+                'avg_your_share': totals['your_share'] / bill_count,
+                'avg_my_share': totals['my_share'] / bill_count,
+                'avg_water_usage': totals['total_water_usage'] / water_bill_count if water_bill_count else 0,
+                'avg_water_bill_amount': totals['water_bill_amount'] / water_bill_count if water_bill_count else 0,
+                'cost_per_kwh': totals['total_bill_amount'] / totals['total_usage'] if totals['total_usage'] else 0,
+            })
+        return report
+
+    def show_report(self):
+        """显示用量和费用统计报表"""
+        choice = input("统计周期: [M] 按月 | [Q] 按季度 | [Y] 按年: ").lower()
+        period = {'m': 'month', 'q': 'quarter', 'y': 'year'}.get(choice)
+        if period is None:
+            print("无效选择")
+            return
+        report = self.usage_report(period)
+        if not report:
+            print("没有找到历史记录")
+            return
+        for item in report:
+            print("\n" + "-"*30)
+            print(f"📅 {item['period'] or '未知日期'} (共 {item['bill_count']} 张账单)")
+            print(f"⚡ 总用电: {item['total_usage']} 度 (平均 {item['avg_usage']:.1f} 度/张)")
+            print(f"💰 总电费: ${item['total_bill_amount']:.1f} (平均 ${item['avg_bill_amount']:.1f}/张，"
+                  f"${item['cost_per_kwh']:.3f}/度)")
+            print(f"你家电费: ${item['your_share']:.1f} (平均 ${item['avg_your_share']:.1f}) | "
+                  f"我家电费: ${item['my_share']:.1f} (平均 ${item['avg_my_share']:.1f})")
+            if item['water_bill_count']:
+                print(f"💧 总用水: {item['total_water_usage']} 单位 | 总水费: ${item['water_bill_amount']:.1f} "
+                      f"(你家 ${item['your_water_share']:.1f}，我家 ${item['my_water_share']:.1f})")
+        print("-"*30)
+
+    def repair_records(self):
+        """交互式批量修复：先预览，确认后再修改"""
+        report = self.repair_all(dry_run=True)
+        for record_id, fields in report['repaired']:
+            print(f"记录ID: {record_id} 需要修复: {', '.join(fields)}")
+        if report['manual']:
+            print(f"以下记录缺少金额或水表读数异常，请在历史记录中用'F'选项逐条修复: "
+                  f"{', '.join(str(record_id) for record_id in report['manual'])}")
+        if not report['repaired']:
+            print("没有发现需要自动修复的记录")
+            return
+        confirm = self.validate_input(f"是否修复以上 {len(report['repaired'])} 条记录？(Y/N): ", input_type="yn")
+        if confirm == 'y':
+            report = self.repair_all()
+            print(f"已修复 {len(report['repaired'])} 条记录")
+
+    def utility_id(self, utility, conn=None):
+        """获取公用事业类型的 id，类型不存在时抛出 ValueError"""
+        utility_id = self._utility_ids.get(utility)
+        if utility_id is None:
+            conn = conn or self.db.connection()
+            row = conn.execute("SELECT id FROM utility_types WHERE name = ?", (utility,)).fetchone()
+            if row is None:
+                raise ValueError(f"未知的公用事业类型: {utility}")
+            utility_id = self._utility_ids[utility] = row[0]
+        return utility_id
+
+    def meter_id(self, household, utility="electricity", conn=None, create=True):
+        """获取分表 id，不存在时自动创建（create=False 时返回 None）"""
+        key = (household, utility)
+        meter_id = self._meter_ids.get(key)
+        if meter_id is None:
+            conn = conn or self.db.connection()
+            params = (household, self.utility_id(utility, conn))
+            if create:
+                conn.execute("INSERT OR IGNORE INTO meters (household, utility_id) VALUES (?, ?)", params)
+            row = conn.execute("SELECT id FROM meters WHERE household = ? AND utility_id = ?", params).fetchone()
+            if row is None:
+                return None
+            meter_id = self._meter_ids[key] = row[0]
+        return meter_id
+
+    def save_household_bill(self, readings, amount, utility="electricity", date=None):
+        """计算并保存一张多户账单，返回 (账单 id, HouseholdShare 列表)"""
+        shares = compute_household_split(readings, amount)
+        date = date or datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self.db.transaction() as conn:
+            cursor = conn.execute(
+                "INSERT INTO bills (date, utility_id, total_usage, total_amount) VALUES (?, ?, ?, ?)",
+                (date, self.utility_id(utility, conn), sum(share.usage for share in shares), amount)
+            )
+            bill_id = cursor.lastrowid
+            conn.executemany(
+                "INSERT INTO readings (bill_id, meter_id, old_reading, new_reading, usage, share) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (bill_id, self.meter_id(share.household, utility, conn),
+                     share.old_reading, share.new_reading, share.usage, share.share)
+                    for share in shares
+                ]
+            )
+        return bill_id, shares
+
+    def add_utility_type(self, name, unit):
+        """添加一种公用事业类型（已存在时更新单位），不需要修改表结构"""
+        with self.db.transaction() as conn:
+            conn.execute(
+                "INSERT INTO utility_types (name, unit) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET unit = excluded.unit",
+                (name, unit)
+            )
+
+    def migrate_to_normalized(self, batch_size=5000):
+        """把 bill_records 的记录迁移到 bills/meters/readings 表
+
+        按 id 分批迁移，每批一个事务，用 INSERT ... SELECT 在 SQLite 内完成。每条旧记录
+        生成一张电费账单，计算了水费的再生成一张水费账单，每张账单两户各一条读数。
+        已迁移的记录通过 bills.record_id 识别，中断后再次运行会从上次的位置继续，
+        之后新增的记录也可以再次运行迁移。返回本次迁移的记录数。
+        """
+        start_time = time.perf_counter()
+        conn = self.db.connection()
+        meter_ids = {
+            (side, utility): self.meter_id(household, utility, conn)
+            for utility, *_ in LEGACY_UTILITY_COLUMNS
+            for side, household in LEGACY_HOUSEHOLDS
+        }
+        conn.commit()
+
+        # 账单按 bill_records.id 顺序插入，每批新账单的 id 都大于插入前的最大 id，
+        # 读数按账单 id 范围和主键关联原记录，不需要为 record_id 建索引
+        statements = []
+        for utility, usage_column, amount_column, condition, columns in LEGACY_UTILITY_COLUMNS:
+            utility_id = self.utility_id(utility, conn)
+            statements.append(('''
+                INSERT INTO bills (date, utility_id, total_usage, total_amount, record_id)
+                SELECT date, ?, IFNULL({0}, 0), IFNULL({1}, 0), id
+                FROM bill_records WHERE id > ? AND id <= ? AND {2} ORDER BY id
+            '''.format(usage_column, amount_column, condition), utility_id, None))
+            for side, _ in LEGACY_HOUSEHOLDS:
+                statements.append(('''
+                    INSERT INTO readings (bill_id, meter_id, old_reading, new_reading, usage, share)
+                    SELECT b.id, ?, IFNULL(r.{0}, 0), IFNULL(r.{1}, 0), IFNULL(r.{2}, 0), IFNULL(r.{3}, 0)
+                    FROM bills AS b JOIN bill_records AS r ON r.id = b.record_id
+                    WHERE b.id > ? AND b.utility_id = ?
+                '''.format(*columns[side]), utility_id, meter_ids[side, utility]))
+
+        # 每批先插入电费账单再插入水费账单，id 最大的账单不一定对应最后迁移的记录，
+        # 因此取最大的 record_id（每次运行只读取一次）
+        last_id = conn.execute("SELECT IFNULL(MAX(record_id), 0) FROM bills").fetchone()[0]
+        migrated = 0
+        while True:
+            row = conn.execute(
+                "SELECT id FROM bill_records WHERE id > ? ORDER BY id LIMIT 1 OFFSET ?", (last_id, batch_size - 1)
+            ).fetchone()
+            upper_id = row[0] if row else conn.execute("SELECT MAX(id) FROM bill_records").fetchone()[0]
+            if upper_id is None or upper_id <= last_id:
+                break
+            with self.db.transaction():
+                first_bill_id = conn.execute("SELECT IFNULL(MAX(id), 0) FROM bills").fetchone()[0]
+                for sql, utility_id, meter_id in statements:
+                    if meter_id is None:
+                        conn.execute(sql, (utility_id, last_id, upper_id))
+                    else:
+                        conn.execute(sql, (meter_id, first_bill_id, utility_id))
+                migrated += conn.execute(
+                    "SELECT COUNT(*) FROM bill_records WHERE id > ? AND id <= ?", (last_id, upper_id)
+                ).fetchone()[0]
+            last_id = upper_id
+
+            elapsed = time.perf_counter() - start_time
+            rate = migrated / elapsed if elapsed > 0 else 0
+            print(f"\r已迁移 {migrated} 条记录 ({rate:.0f} 条/秒)", end="", flush=True)
+        print(f"\r已迁移 {migrated} 条记录，用时 {time.perf_counter() - start_time:.2f} 秒")
+        return migrated
+
+    def meter_history(self, household, utility="electricity", start=None, end=None):
+        """按日期返回一个分表的读数记录 [(日期, 旧读数, 新读数, 用量, 分摊金额), ...]"""
+        conn = self.db.connection()
+        utility_id = self.utility_id(utility, conn)
+        row = conn.execute(
+            "SELECT id FROM meters WHERE household = ? AND utility_id = ?", (household, utility_id)
+        ).fetchone()
+        if row is None:
+            return []
+        where, params = self._date_range_condition(start, end, "b.date", ["b.utility_id = ?"], [utility_id])
+        # 先按 (utility_id, date) 索引按日期顺序找到账单，再用主键取该分表的读数，不需要排序
+        return conn.execute(
+            "SELECT b.date, r.old_reading, r.new_reading, r.usage, r.share "
+            "FROM bills AS b CROSS JOIN readings AS r ON r.bill_id = b.id AND r.meter_id = ?"
+            f"{where} ORDER BY b.date, b.id",
+            [row[0]] + params
+        ).fetchall()
+
+    def household_bill(self, bill_id):
+        """读取一张多户账单的每户读数和分摊金额"""
+        rows = self.db.connection().execute(
+            "SELECT m.household, r.old_reading, r.new_reading, r.usage, r.share "
+            "FROM readings AS r JOIN meters AS m ON m.id = r.meter_id "
+            "WHERE r.bill_id = ? ORDER BY m.household",
+            (bill_id,)
+        ).fetchall()
+        return [HouseholdShare(*row) for row in rows]
+
+    def anomaly_detector(self, conn=None):
+        """用量异常检测器，第一次使用时从数据库读取统计"""
+        if self._detector is None:
+            detector = AnomalyDetector()
+            detector.load(conn or self.db.connection())
+            self._detector = detector
+        return self._detector
+
+    def record_usage(self, conn, records):
+        """把已保存的两户账单的用量计入分表统计，异常用量写入 usage_anomalies
+
+        records 为 [(记录 id, BillRecord), ...]，按时间顺序排列。需要在保存记录的同一个
+        事务中调用；事务回滚时调用方应执行 discard_usage_stats()。返回检测到的异常列表。
+        """
+        with self._detector_lock:
+            detector = self.anomaly_detector(conn)
+            observe = detector.observe
+            threshold = detector.threshold
+            meters = {}
+            anomalies = []
+            for record_id, record in records:
+                for household, utility, usage in _legacy_usages(record):
+                    meter_id = meters.get((household, utility))
+                    if meter_id is None:
+                        meter_id = meters[household, utility] = self.meter_id(household, utility, conn)
+                    score = observe(meter_id, usage)
+                    if score is not None and abs(score[1]) > threshold:
+                        expected, z = score
+                        anomalies.append({
+                            'record_id': record_id, 'household': household, 'utility': utility,
+                            'usage': usage, 'expected': round(expected, 1), 'score': round(z, 2),
+                        })
+                        conn.execute(
+                            "INSERT INTO usage_anomalies (record_id, meter_id, usage, expected, score) "
+                            "VALUES (?, ?, ?, ?, ?)",
+                            (record_id, meter_id, usage, expected, z)
+                        )
+            detector.save(conn)
+        return anomalies
+
+    def discard_usage_stats(self):
+        """丢弃内存中的统计（事务回滚后调用），下次使用时重新从数据库读取"""
+        with self._detector_lock:
+            self._detector = None
+            # 回滚的事务中新建的分表也不存在了
+            self._meter_ids = {}
+
+    def rebuild_usage_stats(self, batch_size=5000):
+        """按日期顺序重新扫描全部账单记录，重建分表用量统计（不记录异常），返回读取的记录数"""
+        detector = AnomalyDetector()
+        meters = {}
+        count = 0
+        with self._detector_lock, self.db.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = BillRecord.from_row
+            cursor.execute(f"SELECT {RECORD_COLUMNS} FROM bill_records ORDER BY date, id")
+            while True:
+                records = cursor.fetchmany(batch_size)
+                if not records:
+                    break
+                for record in records:
+                    for household, utility, usage in _legacy_usages(record):
+                        key = (household, utility)
+                        if key not in meters:
+                            meters[key] = self.meter_id(household, utility, conn)
+                        detector.update(meters[key], usage)
+                count += len(records)
+            cursor.close()
+            conn.execute("DELETE FROM meter_usage_stats")
+            detector.save(conn)
+            self._detector = detector
+        return count
+
+    def list_anomalies(self, limit=50):
+        """最近检测到的异常用量，按检测顺序倒序"""
+        rows = self.db.connection().execute(
+            "SELECT a.record_id, r.date, m.household, u.name, a.usage, a.expected, a.score "
+            "FROM usage_anomalies AS a JOIN meters AS m ON m.id = a.meter_id "
+            "JOIN utility_types AS u ON u.id = m.utility_id "
+            "LEFT JOIN bill_records AS r ON r.id = a.record_id "
+            "ORDER BY a.id DESC LIMIT ?",
+            (limit,)
+        ).fetchall()
+        return [
+            {'record_id': record_id, 'date': date, 'household': household, 'utility': utility,
+             'usage': usage, 'expected': round(expected, 1), 'score': round(score, 2)}
+            for record_id, date, household, utility, usage, expected, score in rows
+        ]
+
+    def set_meter_digits(self, household, utility, digits):
+        """设置分表的位数（None 表示不会归零），读数变小时按 10**digits 归零计算用量"""
+        if digits is not None and not 1 <= digits <= 12:
+            raise ValueError("表的位数应在 1 到 12 之间")
+        with self.db.transaction() as conn:
+            conn.execute("UPDATE meters SET digits = ? WHERE id = ?", (digits, self.meter_id(household, utility, conn)))
+
+    def add_meter_replacement(self, household, utility, final_reading, initial_reading, date=None):
+        """记录一次换表：旧表的最后读数和新表的初始读数
+
+        换表事件计入日期不早于它的下一张账单：该账单的用量 = 旧表走过的读数 + 新表走过的读数。
+        返回事件 id。
+        """
+        if final_reading < 0 or initial_reading < 0:
+            raise ValueError("表读数不能为负数")
+        date = date or datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self.db.transaction() as conn:
+            return conn.execute(
+                "INSERT INTO meter_replacements (meter_id, date, final_reading, initial_reading) VALUES (?, ?, ?, ?)",
+                (self.meter_id(household, utility, conn), date, final_reading, initial_reading)
+            ).lastrowid
+
+    def meter_info(self, household, utility="electricity"):
+        """分表的位数和换表记录"""
+        conn = self.db.connection()
+        meter_id = self.meter_id(household, utility, conn, create=False)
+        info = {'household': household, 'utility': utility, 'digits': None, 'replacements': []}
+        if meter_id is None:
+            return info
+        info['digits'] = conn.execute("SELECT digits FROM meters WHERE id = ?", (meter_id,)).fetchone()[0]
+        info['replacements'] = [
+            {'id': event_id, 'date': date, 'final_reading': final_reading,
+             'initial_reading': initial_reading, 'record_id': record_id}
+            for event_id, date, final_reading, initial_reading, record_id in conn.execute(
+                "SELECT id, date, final_reading, initial_reading, record_id FROM meter_replacements "
+                "WHERE meter_id = ? ORDER BY date, id", (meter_id,)
+            )
+        ]
+        return info
+
+    def _meter_rule_source(self, conn):
+        """读取两户账单各分表的位数和尚未计入账单的换表事件，返回函数 rules(date, water)
+
+        rules 返回 (meters, 换表事件 id 列表)：meters 为 compute_split 的 {用量列: (位数, 换表事件)}，
+        包含日期不晚于 date 的未计入事件，这些事件随后不再返回（water 为 False 时不使用水表的
+        事件）。批量导入时只在开始时按 (meter_id, date) 索引查询一次，之后每行只是内存操作。
+        """
+        digits = {}
+        pending = {}
+        for field, household, utility, _, _ in LEGACY_METER_FIELDS:
+            meter_id = self.meter_id(household, utility, conn, create=False)
+            if meter_id is None:
+                continue
+            meter_digits = conn.execute("SELECT digits FROM meters WHERE id = ?", (meter_id,)).fetchone()[0]
+            events = conn.execute(
+                "SELECT id, date, final_reading, initial_reading FROM meter_replacements "
+                "WHERE meter_id = ? AND record_id IS NULL ORDER BY date, id",
+                (meter_id,)
+            ).fetchall()
+            if meter_digits or events:
+                digits[field] = meter_digits
+                pending[field] = collections.deque(events)
+
+        def rules(date, water=True):
+            meters = {}
+            used = []
+            for field, events in pending.items():
+                if not water and field.endswith('_water_usage'):
+                    continue
+                replacements = []
+                while events and events[0][1] <= date:
+                    event_id, _, final_reading, initial_reading = events.popleft()
+                    replacements.append((final_reading, initial_reading))
+                    used.append(event_id)
+                meters[field] = (digits[field], replacements)
+            return meters, used
+
+        if not pending:
+            return lambda date, water=True: ({}, [])
+        return rules
+
+    def legacy_meter_rules(self, date=None, water=True, conn=None):
+        """一张两户账单的 (meters, 换表事件 id 列表)，见 _meter_rule_source"""
+        date = date or datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        return self._meter_rule_source(conn or self.db.connection())(date, water)
+
+    def _save_meter_adjustments(self, conn, items):
+        """保存账单用量的调整值并把换表事件标记为已计入
+
+        items 为 [(记录 id, BillRecord, 换表事件 id 列表), ...]。调整值 = 用量 - (新读数 - 旧读数)，
+        为0时不保存。
+        """
+        adjustments = []
+        events = []
+        for record_id, record, used in items:
+            for field, _, utility, old_field, new_field in LEGACY_METER_FIELDS:
+                if utility == 'water' and not record.water_calculated:
+                    continue
+                adjustment = getattr(record, field) - (getattr(record, new_field) - getattr(record, old_field))
+                if adjustment:
+                    adjustments.append((record_id, field, adjustment))
+            events.extend((record_id, event_id) for event_id in used)
+        if adjustments:
+            conn.executemany(
+                "INSERT OR REPLACE INTO reading_adjustments (record_id, field, adjustment) VALUES (?, ?, ?)",
+                adjustments
+            )
+        if events:
+            conn.executemany("UPDATE meter_replacements SET record_id = ? WHERE id = ?", events)
+
+    def _load_adjustments(self, conn, first_id, last_id):
+        """id 在 [first_id, last_id] 之间的记录的用量调整值 {记录 id: {用量列: 调整值}}"""
+        adjustments = {}
+        for record_id, field, adjustment in conn.execute(
+            "SELECT record_id, field, adjustment FROM reading_adjustments WHERE record_id BETWEEN ? AND ?",
+            (first_id, last_id)
+        ):
+            adjustments.setdefault(record_id, {})[field] = adjustment
+        return adjustments
+
+    def latest_readings(self, conn=None):
+        """最近一张账单的新读数 {旧读数列: 读数}，作为下一张账单旧读数的默认值
+
+        电表读数取日期最新的记录，水表读数取最近一次计算水费的记录（没有时不包含水表的列）。
+        两次查询都按日期索引倒序只读一行（水表使用迁移8创建的 (water_calculated, date) 索引，
+        历史记录查询的水费条件也使用它），耗时与记录数无关。
+        """
+        conn = conn or self.db.connection()
+        latest = {}
+        row = conn.execute(
+            "SELECT your_new_reading, my_new_reading FROM bill_records ORDER BY date DESC, id DESC LIMIT 1"
+        ).fetchone()
+        if row is not None:
+            latest['your_old_reading'], latest['my_old_reading'] = row
+        row = conn.execute(
+            "SELECT your_new_water, my_new_water FROM bill_records WHERE water_calculated = 1 "
+            "ORDER BY date DESC, id DESC LIMIT 1"
+        ).fetchone()
+        if row is not None:
+            latest['your_old_water'], latest['my_old_water'] = row
+        return latest
+
+    def calculate_household_bills(self):
+        """交互式计算多户电费"""
+        print("\n===== 多户电费分摊 =====")
+        try:
+            count = self.validate_input("共有几户: ", input_type="int", min_value=2,
+                                        error_msg="请输入不少于2的整数")
+            readings = []
+            for i in range(count):
+                household = input(f"第{i + 1}户名称: ").strip() or f"第{i + 1}户"
+                old_reading = self.validate_input(f"{household}的旧电表读数: ", input_type="int", min_value=0,
+                                                  error_msg="请输入有效的非负整数")
+                new_reading = self.validate_input(f"{household}的新电表读数: ", input_type="int", min_value=0,
+                                                  error_msg="请输入有效的非负整数")
+                readings.append((household, old_reading, new_reading))
+            if self.tariff is not None:
+                estimated_amount = self.show_tariff_breakdown(sum(new - old for _, old, new in readings))
+                amount = self.validate_input(f"\n总电费金额($，直接按Enter使用 {estimated_amount:.2f}): ", min_value=0,
+                                             error_msg="请输入有效的非负数", default=estimated_amount)
+            else:
+                amount = self.validate_input("\n总电费金额($): ", min_value=0, error_msg="请输入有效的非负数")
+
+            bill_id, shares = self.save_household_bill(readings, amount)
+            total_usage = sum(share.usage for share in shares)
+            print(f"\n💰 总电费: ${amount:.2f}  总用电: {total_usage} 度")
+            for share in shares:
+                percent = share.usage / total_usage * 100 if total_usage > 0 else 0
+                print(f"{share.household}: {share.old_reading} → {share.new_reading} = {share.usage} 度 "
+                      f"({percent:.1f}%)  ${share.share:.2f}")
+            print(f"计算记录已成功保存到数据库 (账单ID: {bill_id})")
+        except ValueError as e:
+            print(f"错误: {e}")
+
+    def import_csv(self, path, chunk_size=1000, anomalies=None):
+        """从 CSV 文件批量导入表读数并保存计算结果
+
+        逐行读取并计算，每 chunk_size 行用 executemany 写入一次。整个导入在同一个
+        事务中完成，任何一行校验失败都会回滚，数据库保持不变。用量按行的顺序计入
+        分表统计，异常用量不需要确认，写入 usage_anomalies 表并追加到 anomalies 列表
+        （如果提供）。返回导入的行数。
+        """
+        start_time = time.perf_counter()
+        imported = 0
+        found = []
+        import csv
+
+        def write_chunk(conn, chunk, bills, adjusted):
+            conn.executemany(INSERT_BILL_SQL, chunk)
+            # 同一个事务中只有本连接写入，新记录的 id 是连续的
+            last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+            first_id = last_id - len(chunk) + 1
+            if adjusted:
+                self._save_meter_adjustments(conn, [(first_id + i, bills[i], used) for i, used in adjusted])
+            found.extend(self.record_usage(conn, zip(range(first_id, last_id + 1), bills)))
+
+        try:
+            with self.db.transaction() as conn:
+                # 换表或会归零的分表（通常没有）：每行按日期取得计算规则
+                meter_rules = self._meter_rule_source(conn)
+                # 旧读数留空的行使用上一行（第一行为数据库中最近一张账单）的新读数
+                previous = self.latest_readings(conn)
+                with open(path, newline='', encoding='utf-8-sig') as f:
+                    reader = csv.DictReader(f)
+                    chunk = []
+                    bills = []
+                    # 使用了分表规则的行：(在 chunk 中的位置, 计入的换表事件)
+                    adjusted = []
+                    for line_no, row in enumerate(reader, start=2):
+                        date = (row.get('date') or '').strip() or datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                        try:
+                            # 分表规则需要在按电价计算电费之前取得
+                            meters, used = meter_rules(date, bool((row.get('water_bill_amount') or '').strip()))
+                            args = parse_reading_row(row, self.tariff, previous, meters)
+                            bill = compute_split(*args, exact=self.exact, cache=self.cache, meters=meters)
+                        except (KeyError, TypeError, ValueError) as e:
+                            raise ValueError(f"第 {line_no} 行数据无效: {e}") from e
+                        if meters:
+                            adjusted.append((len(chunk), used))
+                        chunk.append((date,) + bill.values())
+                        bills.append(bill)
+
+                        if len(chunk) >= chunk_size:
+                            write_chunk(conn, chunk, bills, adjusted)
+                            imported += len(chunk)
+                            chunk = []
+                            bills = []
+                            adjusted = []
+                    if chunk:
+                        write_chunk(conn, chunk, bills, adjusted)
+                        imported += len(chunk)
+        except BaseException:
+            self.discard_usage_stats()
+            raise
+
+        elapsed = time.perf_counter() - start_time
+        rate = imported / elapsed if elapsed > 0 else 0
+        print(f"已导入 {imported} 条记录，用时 {elapsed:.2f} 秒 ({rate:.0f} 行/秒)")
+        if found:
+            print(f"发现 {len(found)} 个异常用量，已记录到 usage_anomalies 表")
+        if anomalies is not None:
+            anomalies.extend(found)
+        return imported
+
+    def import_readings(self):
+        """交互式批量导入"""
+        path = input("请输入CSV文件路径: ").strip()
+        try:
+            self.import_csv(path)
+        except FileNotFoundError:
+            print(f"找不到文件: {path}")
+        except ValueError as e:
+            print(f"导入失败，数据库未做任何修改: {e}")
+
+    def _date_range_condition(self, start_date=None, end_date=None, column="date", conditions=None, params=None):
+        """生成按日期筛选的 WHERE 子句和参数
+
+        日期格式为 YYYY-MM-DD（包含当天）或完整的 YYYY-MM-DD HH:MM:SS。
+        conditions/params 为需要一起组合的其他条件及其参数。
+        """
+        conditions = list(conditions or [])
+        params = list(params or [])
+        if start_date:
+            conditions.append(f"{column} >= ?")
+            params.append(start_date)
+        if end_date:
+            if len(end_date) == 10:
+                # 只给出日期时包含当天全部记录
+                next_day = datetime.datetime.strptime(end_date, "%Y-%m-%d") + datetime.timedelta(days=1)
+                conditions.append(f"{column} < ?")
+                params.append(next_day.strftime("%Y-%m-%d"))
+            else:
+                conditions.append(f"{column} <= ?")
+                params.append(end_date)
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        return where, params
+
+    def export_history(self, out, fmt="csv", start_date=None, end_date=None, batch_size=500):
+        """把历史记录按日期顺序流式导出为 CSV 或 JSON Lines
+
+        out 为可写的文本文件对象。每次只从数据库取 batch_size 条记录，
+        内存占用与表的大小无关。返回导出的记录数。
+        """
+        if fmt not in ("csv", "jsonl"):
+            raise ValueError(f"不支持的导出格式: {fmt}")
+        where, params = self._date_range_condition(start_date, end_date)
+        cursor = self.db.connection().cursor()
+        cursor.execute(f"SELECT * FROM bill_records{where} ORDER BY date, id", params)
+        columns = [description[0] for description in cursor.description]
+
+        if fmt == "csv":
+            import csv
+            writer = csv.writer(out)
+            writer.writerow(columns)
+        else:
+            import json
+        exported = 0
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            if fmt == "csv":
+                writer.writerows(rows)
+            else:
+                out.write("".join(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n" for row in rows))
+            exported += len(rows)
+        cursor.close()
+        return exported
+
+    def export_file(self, path, fmt="csv", start_date=None, end_date=None):
+        """导出历史记录到文件，path 为 '-' 时写到标准输出"""
+        if path == '-':
+            return self.export_history(sys.stdout, fmt, start_date, end_date)
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            return self.export_history(f, fmt, start_date, end_date)
+
+    def compile_history_query(self, start=None, end=None, min_usage=None, max_usage=None, water=None,
+                              min_imbalance=None, limit=None):
+        """把历史记录查询条件编译为参数化 SQL，返回 (sql, params)
+
+        start、end 为日期范围（格式同 export_history）；min_usage、max_usage 为总用电量范围
+        （包含）；water 为 True/False 时只选计算了/没有计算水费的记录；min_imbalance 为较大
+        一户电费所占的最低百分比（例如 70）。结果按日期倒序排列。
+
+        用 INDEXED BY 指定一个索引驱动查询：有日期范围时用日期索引（同时筛选水费时用
+        (water_calculated, date)），否则依次为分摊比例、总用电量、是否计算水费的索引，其余条件
+        在读到的记录上筛选。按日期索引查找时结果不需要排序，可以边读边输出；SQLite 无法使用
+        指定的索引时执行会报错，不会退化为全表扫描。
+        """
+        conditions = []
+        params = []
+        if water is not None:
+            conditions.append("water_calculated = ?")
+            params.append(1 if water else 0)
+        if min_usage is not None:
+            conditions.append("total_usage >= ?")
+            params.append(min_usage)
+        if max_usage is not None:
+            conditions.append("total_usage <= ?")
+            params.append(max_usage)
+        if min_imbalance is not None:
+            conditions.append(f"{IMBALANCE_SQL} >= ?")
+            params.append(min_imbalance / 100)
+        where, params = self._date_range_condition(start, end, conditions=conditions, params=params)
+
+        if water is not None and (start or end or (min_imbalance is None and min_usage is None and max_usage is None)):
+            index = "idx_bill_records_water"
+        elif start or end:
+            index = "idx_bill_records_date"
+        elif min_imbalance is not None:
+            index = "idx_bill_records_imbalance"
+        elif min_usage is not None or max_usage is not None:
+            index = "idx_bill_records_usage"
+        else:
+            index = "idx_bill_records_date"
+
+        sql = f"SELECT {RECORD_COLUMNS} FROM bill_records INDEXED BY {index}{where} ORDER BY date DESC, id DESC"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return sql, params
+
+    def explain_history_query(self, **filters):
+        """查询的执行计划（EXPLAIN QUERY PLAN 每一行的说明）"""
+        sql, params = self.compile_history_query(**filters)
+        return [row[3] for row in self.db.connection().execute("EXPLAIN QUERY PLAN " + sql, params)]
+
+    def query_history(self, batch_size=500, **filters):
+        """按 compile_history_query 的条件流式读取历史记录，逐条返回 BillRecord
+
+        每次只从数据库取 batch_size 条，内存占用与结果数量无关。
+        """
+        sql, params = self.compile_history_query(**filters)
+        cursor = self.db.connection().cursor()
+        cursor.row_factory = BillRecord.from_row
+        cursor.execute(sql, params)
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
         finally:
-            if conn:
-                conn.close()
+            cursor.close()
+
+    def export_records(self):
+        """交互式导出历史记录"""
+        path = input("请输入导出文件路径: ").strip()
+        fmt = "jsonl" if path.lower().endswith((".jsonl", ".json")) else "csv"
+        start_date = input("开始日期 (YYYY-MM-DD，留空不限): ").strip() or None
+        end_date = input("结束日期 (YYYY-MM-DD，留空不限): ").strip() or None
+        try:
+            exported = self.export_file(path, fmt, start_date, end_date)
+            print(f"已导出 {exported} 条记录到 {path}")
+        except (OSError, ValueError) as e:
+            print(f"导出失败: {e}")
 
     def display_menu(self):
         """显示主菜单"""
@@ -944,6 +3182,13 @@ class BillCalculator:
             print("\n请选择功能:")
             print("1. 计算电费和水费")
             print("2. 查看历史记录")
+            print("3. 批量导入表读数 (CSV)")
+            print("4. 导出历史记录 (CSV/JSONL)")
+            print("5. 检查并批量修复记录")
+            print("6. 数据一致性检查")
+            print("7. 用量和费用统计报表")
+            print("8. 多户电费分摊")
+            print("9. 把历史记录迁移到按公用事业分表的数据结构")
             print("0. 退出程序")
             
             choice = input("\n请输入选项编号: ")
@@ -953,6 +3198,27 @@ class BillCalculator:
                 input("\n按Enter键返回主菜单...")
             elif choice == '2':
                 self.view_history()
+            elif choice == '3':
+                self.import_readings()
+                input("\n按Enter键返回主菜单...")
+            elif choice == '4':
+                self.export_records()
+                input("\n按Enter键返回主菜单...")
+            elif choice == '5':
+                self.repair_records()
+                input("\n按Enter键返回主菜单...")
+            elif choice == '6':
+                self.show_audit()
+                input("\n按Enter键返回主菜单...")
+            elif choice == '7':
+                self.show_report()
+                input("\n按Enter键返回主菜单...")
+            elif choice == '8':
+                self.calculate_household_bills()
+                input("\n按Enter键返回主菜单...")
+            elif choice == '9':
+                self.migrate_to_normalized()
+                input("\n按Enter键返回主菜单...")
             elif choice == '0':
                 print("\n感谢使用电费计算程序，再见！")
                 break
@@ -960,17 +3226,339 @@ class BillCalculator:
                 print("无效选择，请重试。")
                 input("\n按Enter键继续...")
                 
-    def clear_screen(self):
-        """清除屏幕内容"""
-        if os.name == 'nt':  # Windows
-            os.system('cls')
-        else:  # Mac/Linux
-            os.system('clear')
-
-def main():
-    calculator = BillCalculator()
+    def clear_screen(self, out=None):
+        """清除屏幕内容（ANSI 转义序列，不启动子进程）；输出不是终端时不清屏
+
+        提供 out 时把转义序列追加到输出缓冲，和这一屏的内容一起写出。
+        """
+        if sys.stdout.isatty():
+            if out is not None:
+                out.append("\033[H\033[2J\033[3J")
+                return
+            sys.stdout.write("\033[H\033[2J\033[3J")
+            sys.stdout.flush()
+
+# 命令行退出码
+EXIT_OK = 0
+EXIT_ERROR = 1          # 输入数据无效、文件或数据库错误
+EXIT_USAGE = 2          # 参数错误（argparse）
+EXIT_NEEDS_REPAIR = 3   # repair 发现需要修复或需要人工处理的记录
+
+
+def _write_json(data, out=None):
+    """把结果以 JSON 写到标准输出"""
+    import json
+    out = out or sys.stdout
+    json.dump(data, out, ensure_ascii=False)
+    out.write("\n")
+
+
+def _open_input(path):
+    """打开 CSV 输入文件，'-' 表示标准输入"""
+    if path == '-':
+        return contextlib.nullcontext(sys.stdin)
+    return open(path, newline='', encoding='utf-8-sig')
+
+
+def _cli_calc(calculator, args):
+    """calc: 计算账单，输出 JSON；--file 时逐行输出 JSON Lines"""
+    if args.file:
+        import csv
+        import json
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        conn = calculator.db.connection()
+        meter_rules = calculator._meter_rule_source(conn)
+        previous = calculator.latest_readings(conn)
+        with _open_input(args.file) as f:
+            for line_no, row in enumerate(csv.DictReader(f), start=2):
+                date = (row.get('date') or '').strip() or None
+                try:
+                    meters, _ = meter_rules(date or now, bool((row.get('water_bill_amount') or '').strip()))
+                    row_args = parse_reading_row(row, calculator.tariff, previous, meters)
+                    bill = compute_split(*row_args, exact=calculator.exact, cache=calculator.cache, meters=meters)
+                except (KeyError, TypeError, ValueError) as e:
+                    raise ValueError(f"第 {line_no} 行数据无效: {e}") from e
+                bill.date = date
+                sys.stdout.write(json.dumps(bill.as_dict(), ensure_ascii=False) + "\n")
+        return EXIT_OK
+
+    amount = args.amount
+    # 换表或会归零的分表按分表记录计算用量
+    meters, _ = calculator.legacy_meter_rules(water=args.water is not None)
+    if args.readings is not None and amount is None and calculator.tariff is not None:
+        your_old, your_new, my_old, my_new = args.readings
+        amount = calculator.tariff.amount(_field_usage('your_usage', your_old, your_new, meters)
+                                          + _field_usage('my_usage', my_old, my_new, meters))
+    if args.readings is None or amount is None:
+        raise ValueError("需要 --readings 和 --amount（配置了 --tariff 时可省略 --amount），或使用 --file")
+    if (args.water is None) != (args.water_amount is None):
+        raise ValueError("--water 和 --water-amount 需要同时提供")
+    bill = compute_split(args.readings, amount, args.water, args.water_amount or 0, exact=calculator.exact,
+                         meters=meters)
+    if args.save:
+        # save_to_database 的提示信息写到标准错误，标准输出只有 JSON
+        with contextlib.redirect_stdout(sys.stderr):
+            bill = calculator.save_to_database(bill)
+        if bill is None:
+            return EXIT_ERROR
+    _write_json(bill.as_dict())
+    return EXIT_OK
+
+
+def _cli_import(calculator, args):
+    """import: 从 CSV 文件批量导入"""
+    anomalies = []
+    with contextlib.redirect_stdout(sys.stderr):
+        imported = calculator.import_csv(args.file, chunk_size=args.chunk_size, anomalies=anomalies)
+    _write_json({'imported': imported, 'anomalies': anomalies})
+    return EXIT_OK
+
+
+def _cli_anomalies(calculator, args):
+    """anomalies: 列出最近检测到的异常用量；--rebuild 时先按历史记录重建统计"""
+    result = {}
+    if args.rebuild:
+        result['rebuilt_from'] = calculator.rebuild_usage_stats()
+    result['anomalies'] = calculator.list_anomalies(args.limit)
+    _write_json(result)
+    return EXIT_OK
+
+
+def _cli_meter(calculator, args):
+    """meter: 设置分表位数、记录换表，输出分表的位数和换表记录"""
+    if args.digits is not None:
+        calculator.set_meter_digits(args.household, args.utility, args.digits or None)
+    if args.replace:
+        final_reading, initial_reading = args.replace
+        calculator.add_meter_replacement(args.household, args.utility, final_reading, initial_reading, args.date)
+    _write_json(calculator.meter_info(args.household, args.utility))
+    return EXIT_OK
+
+
+def _cli_export(calculator, args):
+    """export: 导出历史记录（CSV 或 JSON Lines）"""
+    calculator.export_file(args.output, args.format, args.start, args.end)
+    return EXIT_OK
+
+
+def _cli_history(calculator, args):
+    """history: 按日期倒序输出最近的记录
+
+    没有指定 --style 时输出记录的 JSON 数组；指定时按该格式输出修正后的显示值，
+    每次取一页（500 条）渲染到缓冲后一次写出。
+    """
+    if args.style is None:
+        records = calculator.fetch_history_page(args.limit)
+        _write_json([record.as_dict() for record in records])
+        return EXIT_OK
+    remaining = args.limit
+    after = None
+    while remaining > 0:
+        records = calculator.fetch_history_page(min(remaining, 500), after=after)
+        if not records:
+            break
+        out = []
+        for view in calculator.history_views(records):
+            calculator.formatter.history_record(out, view, calculator.money_digits)
+        write_buffer(out)
+        remaining -= len(records)
+        after = calculator._history_key(records[-1])
+    return EXIT_OK
+
+
+def _cli_query(calculator, args):
+    """query: 按日期、总用电量、水费和分摊比例查询历史记录，流式输出（默认每行一个 JSON）"""
+    filters = dict(start=args.start, end=args.end, min_usage=args.min_usage, max_usage=args.max_usage,
+                   water=args.water, min_imbalance=args.min_imbalance, limit=args.limit)
+    if args.explain:
+        sql, params = calculator.compile_history_query(**filters)
+        _write_json({'sql': sql, 'params': params, 'plan': calculator.explain_history_query(**filters)})
+        return EXIT_OK
+    formatter = FORMATTERS[args.style or 'json']
+    out = []
+    for record in calculator.query_history(**filters):
+        formatter.history_record(out, record, calculator.money_digits)
+        if len(out) >= 500:
+            write_buffer(out)
+            out = []
+    write_buffer(out)
+    return EXIT_OK
+
+
+def _cli_repair(calculator, args):
+    """repair: 检查并修复全部记录，输出修复报告"""
+    with contextlib.redirect_stdout(sys.stderr):
+        report = calculator.repair_all(dry_run=args.dry_run)
+    _write_json({
+        'checked': report['checked'],
+        'dry_run': args.dry_run,
+        'repaired': [{'id': record_id, 'fields': fields} for record_id, fields in report['repaired']],
+        'manual': report['manual'],
+    })
+    if report['manual'] or (args.dry_run and report['repaired']):
+        return EXIT_NEEDS_REPAIR
+    return EXIT_OK
+
+
+def _cli_rebill(calculator, args):
+    """rebill: 按新电价重新计算全部历史电费"""
+    if args.rate is not None:
+        tariff = Tariff(args.rate, args.fixed_charge)
+    elif calculator.tariff is not None:
+        tariff = calculator.tariff
+    else:
+        raise ValueError("需要 --rate 或 --tariff")
+    with contextlib.redirect_stdout(sys.stderr):
+        summary = calculator.rebill(args.name, tariff, args.workers, args.partition_size, args.cache_size)
+    _write_json(summary)
+    return EXIT_OK
+
+
+def _cli_report(calculator, args):
+    """report: 按月、季度或年份统计用量和费用"""
+    _write_json(calculator.usage_report(args.period, args.start, args.end))
+    return EXIT_OK
+
+
+def _amount_arg(value):
+    """argparse 的金额类型：有限的非负数（nan、inf 和负数按参数错误处理）"""
+    import argparse
+    try:
+        amount = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"无效的金额: {value}")
+    if not math.isfinite(amount) or amount < 0:
+        raise argparse.ArgumentTypeError(f"金额必须是有限的非负数: {value}")
+    return amount
+
+
+def build_parser():
+    """命令行参数：不带子命令时进入交互菜单"""
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog="electricity_bill_calculator.py",
+        description="香港电费和水费计算程序。不带子命令时进入交互菜单，子命令的结果以 JSON 输出。",
+    )
+    parser.add_argument("--db", default="utility_bills.db", help="数据库文件（默认 utility_bills.db）")
+    parser.add_argument("--exact", action="store_true", help="分摊金额以分为单位精确计算")
+    parser.add_argument("--tariff", help="电价配置 JSON 文件：没有总电费的账单按用电量计算电费")
+    parser.add_argument("--style", choices=tuple(FORMATTERS),
+                        help="计算结果和历史记录的显示格式（交互菜单默认 emoji）")
+    # 子命令也接受 --db、--exact、--tariff 和 --style，写在子命令之后时覆盖前面的值
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--db", default=argparse.SUPPRESS, help="数据库文件")
+    common.add_argument("--exact", action="store_true", default=argparse.SUPPRESS, help="分摊金额以分为单位精确计算")
+    common.add_argument("--tariff", default=argparse.SUPPRESS, help="电价配置 JSON 文件")
+    common.add_argument("--style", choices=tuple(FORMATTERS), default=argparse.SUPPRESS,
+                        help="显示格式（history 指定时按该格式输出）")
+    commands = parser.add_subparsers(dest="command", metavar="命令")
+
+    calc = commands.add_parser("calc", parents=[common], help="计算账单")
+    calc.add_argument("--readings", type=int, nargs=4, metavar=("你家旧", "你家新", "我家旧", "我家新"),
+                      help="电表读数")
+    calc.add_argument("--amount", type=_amount_arg, help="总电费金额（配置了 --tariff 时可省略，按用电量计算）")
+    calc.add_argument("--water", type=int, nargs=4, metavar=("你家旧", "你家新", "我家旧", "我家新"),
+                      help="水表读数（可选）")
+    calc.add_argument("--water-amount", type=_amount_arg, help="总水费金额")
+    # --file 只输出结果，批量保存使用 import
+    calc_source = calc.add_mutually_exclusive_group()
+    calc_source.add_argument("--file", help="批量计算：CSV 文件（格式同导入，'-' 表示标准输入），输出 JSON Lines")
+    calc_source.add_argument("--save", action="store_true", help="保存到数据库（只用于单张账单，批量保存请用 import）")
+    calc.set_defaults(handler=_cli_calc)
+
+    import_parser = commands.add_parser("import", parents=[common], help="从 CSV 文件批量导入并保存")
+    import_parser.add_argument("file", help="CSV 文件")
+    import_parser.add_argument("--chunk-size", type=int, default=1000, help="每次写入的行数")
+    import_parser.set_defaults(handler=_cli_import)
+
+    export = commands.add_parser("export", parents=[common], help="导出历史记录")
+    export.add_argument("--format", choices=("csv", "jsonl"), default="jsonl", help="导出格式（默认 jsonl）")
+    export.add_argument("--start", help="开始日期 YYYY-MM-DD")
+    export.add_argument("--end", help="结束日期 YYYY-MM-DD（包含当天）")
+    export.add_argument("-o", "--output", default="-", help="输出文件（默认标准输出）")
+    export.set_defaults(handler=_cli_export)
+
+    history = commands.add_parser("history", parents=[common], help="最近的历史记录")
+    history.add_argument("--limit", type=int, default=20, help="记录条数（默认 20）")
+    history.set_defaults(handler=_cli_history)
+
+    query = commands.add_parser("query", parents=[common], help="按条件查询历史记录")
+    query.add_argument("--start", help="开始日期 YYYY-MM-DD")
+    query.add_argument("--end", help="结束日期 YYYY-MM-DD（包含当天）")
+    query.add_argument("--min-usage", type=int, help="总用电量下限（包含）")
+    query.add_argument("--max-usage", type=int, help="总用电量上限（包含）")
+    water = query.add_mutually_exclusive_group()
+    water.add_argument("--water", action="store_const", const=True, help="只查询计算了水费的记录")
+    water.add_argument("--no-water", dest="water", action="store_const", const=False, help="只查询没有计算水费的记录")
+    query.add_argument("--min-imbalance", type=float, help="较大一户电费所占的最低百分比，例如 70")
+    query.add_argument("--limit", type=int, help="最多返回的记录数")
+    query.add_argument("--explain", action="store_true", help="只输出 SQL 和执行计划")
+    query.set_defaults(handler=_cli_query)
+
+    repair = commands.add_parser("repair", parents=[common], help="检查并修复全部记录")
+    repair.add_argument("--dry-run", action="store_true", help="只检查不修改")
+    repair.set_defaults(handler=_cli_repair)
+
+    rebill = commands.add_parser("rebill", parents=[common], help="按新电价重新计算全部历史电费")
+    rebill.add_argument("--name", required=True, help="方案名称（同名方案会被替换）")
+    rebill.add_argument("--rate", type=float, help="每度电费（不指定时使用 --tariff 的分段电价）")
+    rebill.add_argument("--fixed-charge", type=float, default=0.0, help="每张账单的固定费用")
+    rebill.add_argument("--workers", type=int, help="进程数（默认为 CPU 核数）")
+    rebill.add_argument("--partition-size", type=int, default=50000, help="每个分区的记录数")
+    rebill.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE,
+                        help=f"每个进程缓存的电价和分摊结果条数（默认 {DEFAULT_CACHE_SIZE}，0 表示不缓存）")
+    rebill.set_defaults(handler=_cli_rebill)
+
+    anomalies = commands.add_parser("anomalies", parents=[common], help="最近检测到的异常用量")
+    anomalies.add_argument("--limit", type=int, default=50, help="记录条数（默认 50）")
+    anomalies.add_argument("--rebuild", action="store_true", help="先按全部历史记录重建分表用量统计")
+    anomalies.set_defaults(handler=_cli_anomalies)
+
+    meter = commands.add_parser("meter", parents=[common], help="分表位数和换表记录")
+    meter.add_argument("household", choices=("你家", "我家"), help="住户")
+    meter.add_argument("utility", choices=("electricity", "water"), nargs="?", default="electricity", help="电表或水表")
+    meter.add_argument("--digits", type=int, help="表的位数，读数超过后归零（0 表示不会归零）")
+    meter.add_argument("--replace", type=int, nargs=2, metavar=("FINAL", "INITIAL"),
+                       help="记录换表：旧表最后读数和新表初始读数")
+    meter.add_argument("--date", help="换表日期（默认为现在），计入日期不早于它的下一张账单")
+    meter.set_defaults(handler=_cli_meter)
+
+    report = commands.add_parser("report", parents=[common], help="用量和费用统计")
+    report.add_argument("--period", choices=("month", "quarter", "year"), default="month", help="统计周期")
+    report.add_argument("--start", help="开始月份 YYYY-MM")
+    report.add_argument("--end", help="结束月份 YYYY-MM")
+    report.set_defaults(handler=_cli_report)
+    return parser
+
+
+def main(argv=None):
+    import logging
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    args = build_parser().parse_args(sys.argv[1:] if argv is None else argv)
+    tariff = None
+    if args.tariff:
+        try:
+            tariff = load_tariff(args.tariff)
+        except (OSError, ValueError, TypeError) as e:
+            _write_json({'error': f"无法读取电价配置: {e}"}, sys.stderr)
+            return EXIT_ERROR
+    calculator = BillCalculator(args.db, exact=args.exact, tariff=tariff, style=args.style or "emoji")
     
-    calculator.display_menu()
+    try:
+        if args.command is None:
+            calculator.display_menu()
+            return EXIT_OK
+        try:
+            return args.handler(calculator, args)
+        except BrokenPipeError:
+            # 输出被管道另一端提前关闭（例如 | head），不再写任何内容
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            return EXIT_ERROR
+        except Exception as e:
+            _write_json({'error': str(e)}, sys.stderr)
+            return EXIT_ERROR
+    finally:
+        calculator.close()
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    sys.exit(main())